@@ -62,7 +62,8 @@ def run_experiment(visualize_results=True):
                                     force_download=True,
                                     force_memmaps=True,
                                     force_grids=True,
-                                    force_split=True)
+                                    force_split=True,
+                                    split_policy='auto')
 
     best_params_file = get_best_params(config, model_id)
     test_enz_from_grids(config, model_id, best_params_file, mode='test')
@@ -4,6 +4,11 @@ import theano
 from os import path
 
 from protfun.utils import construct_hierarchical_tree
+from protfun.utils.data_utils import pyramid_grid_filename, sparse_voxels_filename
+from protfun.utils.sparse_voxels import occupied_voxels, build_sparse_inputs, transform_voxels
+from protfun.utils.radius_graph import build_graph_inputs
+from protfun.utils.np_utils import CUBE_SYMMETRIES, apply_cube_symmetry, translate_grid, \
+    load_bounding_box, crop_around_box, block_average
 from protfun.utils.log import get_logger
 
 log = get_logger("data_feed")
@@ -114,13 +119,15 @@ class EnzymeDataFeeder(DataFeeder):
     __metaclass__ = abc.ABCMeta
 
     def __init__(self, data_manager, minibatch_size, init_samples_per_class,
-                 prediction_depth):
+                 prediction_depth, fold=None):
         """
         :param data_manager: data manager to download and process the protein files.
         :param minibatch_size: see docs for DataFeeder.
         :param init_samples_per_class: see docs for DataFeeder.
         :param prediction_depth: integer depth in the EC tree of enzymes proteins, it is the
             depth on which we do prediction (e.g. 3)
+        :param fold: (optional) id of the cross-validation fold of the data manager, whose
+            training and validation sets are provided instead of the regular ones
         """
         super(EnzymeDataFeeder, self).__init__(minibatch_size,
                                                init_samples_per_class)
@@ -129,6 +136,7 @@ class EnzymeDataFeeder(DataFeeder):
         # the enzymes data
         self.data_manager = data_manager
         self.prediction_depth = prediction_depth
+        self.fold = fold
 
     def iterate_test_data(self):
         """
@@ -164,30 +172,28 @@ class EnzymeDataFeeder(DataFeeder):
         """
         See DataFeeder's doc.
         """
-        return self.data_manager.get_training_set()
+        return self.data_manager.get_training_set(fold=self.fold)
 
     def get_val_data(self):
         """
         See DataFeeder's doc.
         """
-        return self.data_manager.get_validation_set()
+        return self.data_manager.get_validation_set(fold=self.fold)
 
     def _iter_minibatches(self, iter_mode='train'):
         """
         Internal method, does the actual iteration over mini-batches.
         """
         if iter_mode == "train":
-            samples, labels = self.data_manager.get_training_set()
-            data_dir = self.data_manager.dirs['data_train']
+            samples, labels = self.get_train_data()
         elif iter_mode == "test":
-            samples, labels = self.data_manager.get_test_set()
-            data_dir = self.data_manager.dirs['data_test']
+            samples, labels = self.get_test_data()
         elif iter_mode == "val":
-            samples, labels = self.data_manager.get_validation_set()
-            data_dir = self.data_manager.dirs['data_train']
+            samples, labels = self.get_val_data()
         else:
             log.error("iter_mode can only be 'train', 'val' or 'test'")
             raise ValueError
+        data_dir = self.data_manager.get_samples_dir(iter_mode)
 
         # group the enzymes data by the specified prediction depth,
         # the EC categories at that depth will be treated as labels.
@@ -200,6 +206,31 @@ class EnzymeDataFeeder(DataFeeder):
             map(list, zip(
                 *[(cls, len(prots)) for cls, prots in grouped_samples.items() if len(prots) > 0]))
         data_size = sum(data_sizes)
+
+        if iter_mode == 'train':
+            minibatches = self._random_minibatches(grouped_samples, represented_classes,
+                                                   data_size)
+        else:
+            minibatches = self._exact_minibatches(grouped_samples, represented_classes)
+
+        for prots_in_minibatch in minibatches:
+            next_samples = self._form_samples_minibatch(prot_codes=prots_in_minibatch,
+                                                        from_dir=data_dir)
+            if iter_mode == 'train':
+                next_samples = self._augment_samples(next_samples)
+            next_samples = self._finalize_samples(next_samples)
+
+            # labels are accessed at a fixed hierarchical depth counting from the root
+            next_targets = [labels.take(prots_in_minibatch,
+                                        depth=self.prediction_depth).astype(intX)]
+
+            yield prots_in_minibatch, next_samples, next_targets
+
+    def _random_minibatches(self, grouped_samples, represented_classes, data_size):
+        """
+        Internal method, generates the protein codes of the training mini-batches, drawn at random
+        in a class-balanced way. All mini-batches are full.
+        """
         num_classes = len(represented_classes)
 
         # determine the effective data size, based on samples_per_class
@@ -224,18 +255,25 @@ class EnzymeDataFeeder(DataFeeder):
             class_choices = np.random.choice(represented_classes, size=self.minibatch_size,
                                              replace=True)
 
-            prots_in_minibatch = [np.random.choice(grouped_samples[class_][:self.samples_per_class])
-                                  for class_ in class_choices]
+            yield [np.random.choice(grouped_samples[class_][:self.samples_per_class])
+                   for class_ in class_choices]
 
-            next_samples = self._form_samples_minibatch(prot_codes=prots_in_minibatch,
-                                                        from_dir=data_dir)
-
-            # labels are accessed at a fixed hierarchical depth counting from the root
-            next_targets = [np.vstack(
-                [labels[prot_code][self.prediction_depth - 1].astype(intX) for prot_code in
-                 prots_in_minibatch])]
+    def _exact_minibatches(self, grouped_samples, represented_classes):
+        """
+        Internal method, generates the protein codes of the validation / test mini-batches: every
+        protein (among the first samples_per_class of each class) is provided exactly once, in a
+        fixed order. The last mini-batch holds the remaining proteins and may be smaller.
+        """
+        seen = set()
+        prot_codes = list()
+        for class_ in sorted(represented_classes):
+            for prot_code in grouped_samples[class_][:self.samples_per_class]:
+                if prot_code not in seen:
+                    seen.add(prot_code)
+                    prot_codes.append(prot_code)
 
-            yield prots_in_minibatch, next_samples, next_targets
+        for start in xrange(0, len(prot_codes), self.minibatch_size):
+            yield prot_codes[start:start + self.minibatch_size]
 
     @abc.abstractmethod
     def _form_samples_minibatch(self, prot_codes, from_dir):
@@ -248,23 +286,88 @@ class EnzymeDataFeeder(DataFeeder):
         """
         raise NotImplementedError
 
+    def _augment_samples(self, samples):
+        """
+        Internal method, hook for feeders that augment the training mini-batches on the CPU.
+        By default the samples are returned unchanged.
+        :param samples: the minibatch formed by _form_samples_minibatch
+        :return: the augmented minibatch
+        """
+        return samples
+
+    def _finalize_samples(self, samples):
+        """
+        Internal method, hook for feeders that form the model inputs only after the
+        (optional) augmentation. By default the samples are returned unchanged.
+        :param samples: the (augmented) minibatch
+        :return: the list of model inputs
+        """
+        return samples
+
 
 class EnzymesMolDataFeeder(EnzymeDataFeeder):
     """
     EnzymesMolDataFeeder is an enzyme protein feeder, that can provide mini-batches of
     [coordinates, vdwradii, n_atoms], for each enzyme protein in the mini-batch.
+
+    In graph mode, it provides the inputs of a graph network instead: the features of all atoms
+    in the mini-batch together with the edges of their radius graph (see
+    protfun.utils.radius_graph.build_graph_inputs). The neighbor lists are built here, on the CPU,
+    so the cost of a mini-batch scales with the number of atoms and not with a grid volume.
     """
 
     def __init__(self, data_manager, minibatch_size, init_samples_per_class,
-                 prediction_depth):
+                 prediction_depth, fold=None, graph=False, radius=4.5, max_neighbors=16):
         """
         See doc for EnzymeDataFeeder.
+        :param graph: whether to provide radius graph inputs instead of padded atom arrays
+        :param radius: in graph mode, the cutoff distance (in Angstrom) of the edges
+        :param max_neighbors: in graph mode, only the max_neighbors nearest neighbors of each atom
+            are connected to it (None for all atoms within the radius)
         """
         super(EnzymesMolDataFeeder, self).__init__(data_manager, minibatch_size,
                                                    init_samples_per_class,
-                                                   prediction_depth)
+                                                   prediction_depth, fold=fold)
+        self.graph = graph
+        self.radius = radius
+        self.max_neighbors = max_neighbors
 
     def _form_samples_minibatch(self, prot_codes, from_dir):
+        if self.graph:
+            return self._form_graph_minibatch(prot_codes, from_dir)
+        return self._form_padded_minibatch(prot_codes, from_dir)
+
+    def _form_graph_minibatch(self, prot_codes, from_dir):
+        """
+        Forms the radius graph inputs [atoms, senders, receivers, distances, segments, counts]
+        of the proteins with PDB code in prot_codes. The features of each atom are its van der
+        Waals radius and its partial charge, loaded from the files 'vdwradii.memmap' and
+        'charges.memmap' under from_dir/<prot_code>. The charges are only stored when the
+        proteins are pre-processed with use_esp, otherwise they are set to 0.
+
+        See doc in EnzymesDataFeeder for parameters.
+        """
+        molecules = []
+        for prot_id in prot_codes:
+            path_to_prot = path.join(from_dir, prot_id.upper())
+            coords = np.memmap(path.join(path_to_prot, 'coords.memmap'), mode='r',
+                               dtype=floatX).reshape(-1, 3)
+            vdwradii = np.memmap(path.join(path_to_prot, 'vdwradii.memmap'), mode='r',
+                                 dtype=floatX)
+            charges_file = path.join(path_to_prot, 'charges.memmap')
+            if path.exists(charges_file):
+                # atoms without an assigned charge are stored as NaN
+                charges = np.nan_to_num(np.memmap(charges_file, mode='r', dtype=floatX))
+            else:
+                charges = np.zeros_like(vdwradii)
+            molecules.append((np.asarray(coords), np.stack([vdwradii, charges], axis=1)))
+
+        atoms, senders, receivers, distances, segments, counts = build_graph_inputs(
+            molecules, radius=self.radius, max_neighbors=self.max_neighbors)
+        return [atoms.astype(floatX), senders, receivers, distances.astype(floatX), segments,
+                counts.astype(floatX)]
+
+    def _form_padded_minibatch(self, prot_codes, from_dir):
         """
         Forms a minibatch of [coords, vdwradii, n_atoms] for each of the proteins with PDB
         code in prot_codes. Expects that the data to be loaded is located under from_dir/<prot_code>
@@ -272,11 +375,11 @@ class EnzymesMolDataFeeder(EnzymeDataFeeder):
 
         See doc in EnzymesDataFeeder for parameters.
         """
-        assert len(prot_codes) == self.minibatch_size, \
-            "prot_codes must be of the same size as minibatch_size"
+        # the last mini-batch of an evaluation pass may be smaller than minibatch_size
+        n_mols = len(prot_codes)
         coords_tmp = []
         vdwradii_tmp = []
-        n_atoms = np.zeros((self.minibatch_size,), dtype=intX)
+        n_atoms = np.zeros((n_mols,), dtype=intX)
         for i, prot_id in enumerate(prot_codes):
             path_to_prot = path.join(from_dir, prot_id.upper())
             coords_tmp.append(
@@ -288,10 +391,10 @@ class EnzymesMolDataFeeder(EnzymeDataFeeder):
             n_atoms[i] = vdwradii_tmp[i].shape[0]
 
         max_atoms = max(n_atoms)
-        coords = np.zeros((self.minibatch_size, max_atoms, 3), dtype=floatX)
-        vdwradii = np.zeros((self.minibatch_size, max_atoms), dtype=floatX)
+        coords = np.zeros((n_mols, max_atoms, 3), dtype=floatX)
+        vdwradii = np.zeros((n_mols, max_atoms), dtype=floatX)
 
-        for i in range(self.minibatch_size):
+        for i in range(n_mols):
             coords[i, :n_atoms[i], :] = coords_tmp[i]
             vdwradii[i, :n_atoms[i]] = vdwradii_tmp[i]
 
@@ -309,43 +412,239 @@ class EnzymesGridFeeder(EnzymeDataFeeder):
 
     def __init__(self, data_manager, minibatch_size,
                  init_samples_per_class, prediction_depth,
-                 num_channels, grid_size):
+                 num_channels, grid_size, augment=False, max_translation=0,
+                 translation_mode='roll', crop_buckets=None, crop_coverage=1.0,
+                 grid_level=None, fold=None, dtype=floatX):
         """
         See EnzymeDataFeeder for remaining parameters.
         :param num_channels: how many channels do the electron density grids have (normally it
             should be 1).
         :param grid_size: what is the number of points on each side of the electron density grid,
             e.g. 128
+        :param augment: whether to augment the training grids on the CPU, by applying a random
+            one of the 24 rotations of the cube (axes transposes and flips) to each grid.
+        :param max_translation: when augmenting, the grids are also translated by a random integer
+            number of voxels in [-max_translation, max_translation] along each axis.
+        :param translation_mode: 'roll' or 'pad', see protfun.utils.np_utils.translate_grid
+        :param crop_buckets: (optional) list of canonical grid sides, e.g. [32, 48, 64]. If given,
+            the grids are cropped around the bounding box of each protein (recorded during the
+            pre-processing) to the smallest bucket side that fits the proteins, so that the
+            network does not process the empty padding around small proteins. A single side is
+            chosen for the whole data set, as the networks end with dense layers.
+        :param crop_coverage: the fraction of proteins in the training set whose bounding box must
+            fit into the chosen bucket side; the remaining (largest) proteins are cropped
+            centrally.
+        :param grid_level: (optional) side of the grid pyramid level to feed, e.g. 32 for a
+            coarse network. The level is loaded from the processed data if it was emitted during
+            the pre-processing (see grid_pyramid in EnzymeDataManager), otherwise it is
+            block-averaged from the full resolution grid on the fly.
+        :param dtype: dtype of the provided grids, e.g. 'float16' for mixed precision training
         """
         super(EnzymesGridFeeder, self).__init__(data_manager, minibatch_size,
                                                 init_samples_per_class,
-                                                prediction_depth)
+                                                prediction_depth, fold=fold)
         self.num_channels = num_channels
         self.grid_size = grid_size
+        self.level_side = grid_level or grid_size
+        if grid_size % self.level_side != 0:
+            log.error("The grid level side must divide the grid size")
+            raise ValueError
+        self.augment = augment
+        self.max_translation = max_translation
+        self.translation_mode = translation_mode
+        self.dtype = dtype
+
+        self.crop_buckets = sorted(crop_buckets) if crop_buckets else None
+        self.crop_side = None
+        self.bounding_boxes = dict()
+        if self.crop_buckets is not None:
+            if self.crop_buckets[-1] > self.level_side:
+                log.error("The crop buckets must not be larger than the grid (level) size")
+                raise ValueError
+            self.crop_side = self._choose_crop_side(crop_coverage)
+            log.info("Cropping the grids to a side of {}".format(self.crop_side))
+
+    def get_input_side(self):
+        """
+        :return: the number of points on each side of the grids provided by this feeder
+        """
+        if self.crop_buckets is None:
+            return self.level_side
+        return self.crop_side
+
+    def _bucket_for(self, prot_code):
+        """
+        :return: the smallest bucket side into which the bounding box of the protein fits
+        """
+        box = self._get_bounding_box(prot_code)
+        extent = np.max(box[3:] - box[:3] + 1)
+        for side in self.crop_buckets:
+            if extent <= side:
+                return side
+        return self.crop_buckets[-1]
+
+    def _choose_crop_side(self, coverage):
+        """
+        Picks the smallest bucket side, which fits the bounding boxes of the given fraction of
+        the proteins in the training set. The validation and test proteins are not looked at.
+        """
+        prot_codes = set()
+        samples, _ = self.get_train_data()
+        for prots in samples.values():
+            prot_codes |= set(prots)
+        buckets = np.sort([self._bucket_for(p) for p in prot_codes])
+        if len(buckets) == 0:
+            return self.crop_buckets[-1]
+        return int(buckets[min(len(buckets) - 1, int(np.ceil(coverage * len(buckets))) - 1)])
+
+    def _get_bounding_box(self, prot_code):
+        """
+        Loads (and caches) the bounding box of a protein from the processed data. For data
+        processed before the bounding boxes were recorded, it is computed from the grid.
+        The box is returned in the voxel coordinates of the fed grid level.
+        """
+        if prot_code not in self.bounding_boxes:
+            prot_dir = path.join(self.data_manager.dirs['data_processed'], prot_code.upper())
+            self.bounding_boxes[prot_code] = load_bounding_box(prot_dir, self.grid_size,
+                                                               self.level_side, dtype=floatX)
+        return self.bounding_boxes[prot_code]
 
     def _form_samples_minibatch(self, prot_codes, from_dir):
         """
         Forms a minibatch of electron density grids for each of the proteins with PDB
         code in prot_codes. Expects that the data to be loaded is located under from_dir/<prot_code>
-        for each protein, in a file  'grid.memmap'.
+        for each protein, in a file  'grid.memmap' (or 'grid_<side>.memmap' for a coarser
+        level of the grid pyramid).
 
         See doc in EnzymesDataFeeder for parameters.
         """
-        assert len(prot_codes) == self.minibatch_size, \
-            "prot_codes must be of the same size as minibatch_size"
+        crop_side = self.crop_side
         grids = list()
         for prot_id in prot_codes:
             path_to_prot = path.join(from_dir, prot_id.upper())
-            grids.append(
-                np.memmap(path.join(path_to_prot, 'grid.memmap'), mode='r',
-                          dtype=floatX).reshape((1, -1,
-                                                 self.grid_size,
-                                                 self.grid_size,
-                                                 self.grid_size)))
+            grid = self._load_grid(path_to_prot)
+            if crop_side is not None:
+                grid = crop_around_box(grid, self._get_bounding_box(prot_id), crop_side)
+            grids.append(grid)
 
         stacked = np.vstack(grids)
 
         # a small hack to work around the molecules that still contain ESP
         # channel
         # TODO: remove this when the code is run on only electron density grids
-        return [stacked[:, stacked.shape[1] - self.num_channels:]]
+        return [stacked[:, stacked.shape[1] - self.num_channels:].astype(self.dtype, copy=False)]
+
+    def _load_grid(self, path_to_prot):
+        """
+        Loads the grid of a protein at the fed pyramid level, shaped (1, channels, side, side,
+        side). A missing level is block-averaged from the full resolution grid.
+        """
+        level_file = path.join(path_to_prot, pyramid_grid_filename(self.grid_size,
+                                                                   self.level_side))
+        if path.exists(level_file):
+            return np.memmap(level_file, mode='r', dtype=floatX).reshape(
+                (1, -1) + (self.level_side,) * 3)
+        grid = np.memmap(path.join(path_to_prot, 'grid.memmap'), mode='r',
+                         dtype=floatX).reshape((1, -1) + (self.grid_size,) * 3)
+        return block_average(grid, self.grid_size // self.level_side).astype(floatX)
+
+    def _augment_samples(self, samples):
+        """
+        Applies a random rotation of the cube and (optionally) a random integer translation to
+        each grid in the minibatch. No interpolation takes place.
+        """
+        if not self.augment:
+            return samples
+        grids = samples[0]
+        augmented = np.empty_like(grids)
+        for i in range(grids.shape[0]):
+            symmetry = CUBE_SYMMETRIES[np.random.randint(len(CUBE_SYMMETRIES))]
+            grid = apply_cube_symmetry(grids[i], symmetry)
+            if self.max_translation > 0:
+                shift = np.random.randint(-self.max_translation, self.max_translation + 1,
+                                          size=3)
+                grid = translate_grid(grid, shift, mode=self.translation_mode)
+            augmented[i] = grid
+        return [augmented]
+
+
+class EnzymesSparseGridFeeder(EnzymesGridFeeder):
+    """
+    EnzymesSparseGridFeeder provides the inputs of the sparse networks (see
+    SparseDisjointClassifier): the occupied voxels of the proteins in the mini-batch together with
+    their neighbor and children maps on each resolution level. The occupied voxels are loaded
+    from the pre-processed data (see sparse_threshold in EnzymeDataManager), or extracted from the
+    grids on the fly if they were not pre-processed.
+
+    When augmenting, the random rotations of the cube and translations are applied to the voxel
+    coordinates, before the neighbor maps are built.
+    """
+
+    def __init__(self, data_manager, minibatch_size, init_samples_per_class, prediction_depth,
+                 num_channels, grid_size, n_levels, threshold=0., augment=False,
+                 max_translation=0, grid_level=None, fold=None):
+        """
+        See EnzymesGridFeeder for remaining parameters. The grids are never cropped.
+        :param n_levels: number of resolution levels of the sparse network
+        :param threshold: voxels with all channels <= threshold are considered empty, must match
+            the pre-processed occupied voxels (otherwise they are extracted again)
+        """
+        super(EnzymesSparseGridFeeder, self).__init__(data_manager, minibatch_size,
+                                                      init_samples_per_class, prediction_depth,
+                                                      num_channels, grid_size, augment=augment,
+                                                      max_translation=max_translation,
+                                                      translation_mode='roll',
+                                                      grid_level=grid_level, fold=fold)
+        self.n_levels = n_levels
+        self.threshold = threshold
+
+    def _form_samples_minibatch(self, prot_codes, from_dir):
+        """
+        Loads the occupied voxels (coordinates and channel values) for each of the proteins with
+        PDB code in prot_codes.
+
+        See doc in EnzymesDataFeeder for parameters.
+        """
+        voxels = list()
+        for prot_id in prot_codes:
+            path_to_prot = path.join(from_dir, prot_id.upper())
+            voxels.append(self._load_voxels(path_to_prot))
+        return voxels
+
+    def _load_voxels(self, path_to_prot):
+        voxels_file = path.join(path_to_prot, sparse_voxels_filename(self.level_side))
+        if path.exists(voxels_file):
+            with np.load(voxels_file) as f:
+                if float(f['threshold']) == self.threshold:
+                    values = f['values']
+                    return f['coords'], values[:, values.shape[1] - self.num_channels:]
+        grid = self._load_grid(path_to_prot)
+        coords, values = occupied_voxels(grid[:, grid.shape[1] - self.num_channels:],
+                                         self.threshold)
+        return coords, values
+
+    def _augment_samples(self, samples):
+        """
+        Applies a random rotation of the cube and (optionally) a random integer translation
+        (wrapping around the borders) to the voxel coordinates of each protein.
+        """
+        if not self.augment:
+            return samples
+        augmented = list()
+        for coords, values in samples:
+            symmetry = CUBE_SYMMETRIES[np.random.randint(len(CUBE_SYMMETRIES))]
+            shift = None
+            if self.max_translation > 0:
+                shift = np.random.randint(-self.max_translation, self.max_translation + 1,
+                                          size=3)
+            augmented.append((transform_voxels(coords, self.level_side, symmetry, shift), values))
+        return augmented
+
+    def _finalize_samples(self, samples):
+        """
+        Builds the sparse network inputs, see protfun.utils.sparse_voxels.build_sparse_inputs.
+        """
+        inputs = build_sparse_inputs(samples, side=self.level_side, n_levels=self.n_levels)
+        inputs[0] = inputs[0].astype(floatX)
+        inputs[-1] = inputs[-1].astype(floatX)
+        return inputs
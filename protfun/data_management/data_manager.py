@@ -1,12 +1,14 @@
 import shutil
 import abc
+import itertools
 import numpy as np
 import os
 
 import protfun.data_management.preprocess as prep
 from protfun.data_management.label_factory import LabelFactory
 from protfun.data_management.validation import EnzymeValidator
-from protfun.utils import save_pickle, load_pickle, construct_hierarchical_tree
+from protfun.utils import save_pickle, load_pickle, construct_hierarchical_tree, link_tree, \
+    LINK_METHODS
 from protfun.utils.log import get_logger
 
 log = get_logger("data_manager")
@@ -64,7 +66,7 @@ class DataManager(object):
         raise NotImplementedError
 
     @staticmethod
-    def split_data_on_sublevel(data_dict, percentage, hierarchical_depth):
+    def split_data_on_sublevel(data_dict, percentage, hierarchical_depth, seed=None):
         """
         Performs a "strict" split by taking the nodes in the EC tree in the level **below**
         hierarchical_depth, and placing the proteins under each of those nodes **disjointly**
@@ -73,28 +75,29 @@ class DataManager(object):
         E.g. if hierarchical_depth=3, then each EC tree node on level 4 will be put in
         either the first part, or in the second part of the split.
 
+        The split runs in time linear in the number of proteins. Without a seed, the largest child
+        nodes are put into the second part first (deterministic). With a seed, the child nodes
+        are put into the second part in a random order, which is reproducible for the same seed.
+
         :param data_dict: a dictionary with keys categories and value per key - list of pdb codes
         :param percentage: the portion of the data in % that should be put into the first split
         :param hierarchical_depth: depth for the classification, the nodes on the level **below**
             this depth are each put into one of the two parts of the split
+        :param seed: (optional) seed for a random (but reproducible) split
         :return: a tuple of the two splits as data dictionaries
         """
-        import itertools
         first_data_dict = dict()
         second_data_dict = dict()
 
-        target_classes = set(['.'.join(cls.split('.')[:hierarchical_depth]) for cls in data_dict])
-
-        for target_cls in target_classes:
-            children = [(cls, enzymes) for cls, enzymes in data_dict.items() if
-                        cls.startswith(target_cls + '.')]
-            target_cls_prots = set(itertools.chain.from_iterable(zip(*children)[1]))
+        for children in DataManager._ordered_children(data_dict, hierarchical_depth, seed):
+            target_cls_prots = set()
+            for _, enzymes in children:
+                target_cls_prots.update(enzymes)
             required_count = ((100 - percentage) * len(target_cls_prots)) // 100
-            sorted_children = sorted(children, key=lambda x: len(x[1]), reverse=True)
             collected_so_far = set()
-            for cls, enzymes in sorted_children:
+            for cls, enzymes in children:
                 if len(collected_so_far) < required_count:
-                    collected_so_far |= set(enzymes)
+                    collected_so_far.update(enzymes)
                     second_data_dict[cls] = enzymes
                 else:
                     first_data_dict[cls] = enzymes
@@ -102,7 +105,69 @@ class DataManager(object):
         return first_data_dict, second_data_dict
 
     @staticmethod
-    def split_data_on_level(data_dict, percentage, level=3):
+    def k_fold_split_on_sublevel(data_dict, k, hierarchical_depth, seed=None):
+        """
+        Performs a "strict" k-fold split in one pass: each EC tree node on the level **below**
+        hierarchical_depth is put (with all of its proteins) into exactly one of k folds, such
+        that the folds are as balanced as possible within each node on hierarchical_depth.
+
+        Usage::
+            >>> folds = DataManager.k_fold_split_on_sublevel(data_dict, k=5, hierarchical_depth=3)
+            >>> test_dict = folds[0]
+            >>> train_dict = DataManager.merge_data(folds[1:])
+
+        :param data_dict: a dictionary with keys categories and value per key - list of pdb codes
+        :param k: the number of folds
+        :param hierarchical_depth: depth for the classification, see split_data_on_sublevel
+        :param seed: (optional) seed for a random (but reproducible) assignment of the nodes
+        :return: a list of k data dictionaries
+        """
+        if k < 2:
+            log.error("A k-fold split needs at least 2 folds")
+            raise ValueError
+        folds = [dict() for _ in range(k)]
+        fold_sizes = [0] * k
+        for children in DataManager._ordered_children(data_dict, hierarchical_depth, seed):
+            # put each child into the fold with the fewest proteins of this ancestor (ties are
+            # broken by the overall fold sizes), proteins already in a fold are not counted again
+            fold_prots = [set() for _ in range(k)]
+            for cls, enzymes in children:
+                fold = min(range(k), key=lambda i: (len(fold_prots[i]), fold_sizes[i]))
+                fold_sizes[fold] -= len(fold_prots[fold])
+                fold_prots[fold].update(enzymes)
+                fold_sizes[fold] += len(fold_prots[fold])
+                folds[fold][cls] = enzymes
+        return folds
+
+    @staticmethod
+    def _ordered_children(data_dict, hierarchical_depth, seed=None):
+        """
+        Groups the classes in data_dict under their ancestor on hierarchical_depth in a single
+        pass over the classes.
+
+        :return: a list with one list of (class, proteins) children for each ancestor, ordered
+            by decreasing size or, if seed is given, randomly
+        """
+        tree = dict()
+        for cls, enzymes in data_dict.items():
+            path = cls.split('.')
+            if len(path) > hierarchical_depth:
+                tree.setdefault('.'.join(path[:hierarchical_depth]), []).append((cls, enzymes))
+
+        rng = None if seed is None else np.random.RandomState(seed)
+        ordered = list()
+        for target_cls in sorted(tree):
+            children = tree[target_cls]
+            if rng is None:
+                children = sorted(children, key=lambda x: len(x[1]), reverse=True)
+            else:
+                children = sorted(children)
+                children = [children[i] for i in rng.permutation(len(children))]
+            ordered.append(children)
+        return ordered
+
+    @staticmethod
+    def split_data_on_level(data_dict, percentage, level=3, rng=np.random):
         """
         performs a *naive* split, i.e. splitting proteins codes within a leaf-node from the
         hierarchical category tree, or a *semi-naive* split when spliting on a higher level node.
@@ -112,6 +177,7 @@ class DataManager(object):
         :param data_dict: a dictionary with keys categories and value per key - list of pdb codes
         :param percentage: the portion of the data in % that should be put into the first split
         :param level: the hierarchical tree depth level on which the split is made.
+        :param rng: the random number generator, e.g. a seeded np.random.RandomState
         :return: a tuple of the two splits as data dictionaries
         """
         if not 0 <= percentage <= 100:
@@ -129,7 +195,7 @@ class DataManager(object):
         else:
             merged_on_level = data_dict
         # take percentage of data points from each hierarchical leaf class
-        for cls, samples in merged_on_level.items():
+        for cls, samples in sorted(merged_on_level.items()):
             num_samples = len(samples)
             first_part_size = int((num_samples * percentage) // 100)
             second_part_size = num_samples - first_part_size
@@ -138,8 +204,8 @@ class DataManager(object):
                     "Data size of leaf class: {0} percentage: {1}".format(num_samples, percentage))
                 log.warning(
                     "Class {} will not be represented in one part of the split.".format(cls))
-            first_samples = np.random.choice(samples, replace=False,
-                                             size=int((num_samples * percentage) // 100.0))
+            first_samples = rng.choice(sorted(samples), replace=False,
+                                       size=int((num_samples * percentage) // 100.0))
             second_samples = np.setdiff1d(samples, first_samples, assume_unique=True)
 
             if level < 4:
@@ -156,6 +222,41 @@ class DataManager(object):
 
         return first_data_dict, second_data_dict
 
+    @staticmethod
+    def k_fold_split_on_level(data_dict, k, level=3, rng=np.random):
+        """
+        Performs a *naive* k-fold split in one pass: the proteins within each node on the given
+        level of the EC tree are shuffled and dealt into the k folds in turns.
+
+        :param data_dict: a dictionary with keys categories and value per key - list of pdb codes
+        :param k: the number of folds
+        :param level: the hierarchical tree depth level on which the split is made.
+        :param rng: the random number generator, e.g. a seeded np.random.RandomState
+        :return: a list of k data dictionaries
+        """
+        if k < 2:
+            log.error("A k-fold split needs at least 2 folds")
+            raise ValueError
+        prots2classes_dict = dict()
+        for cls, prot_codes in data_dict.items():
+            for p in prot_codes:
+                prots2classes_dict.setdefault(p, []).append(cls)
+        merged_on_level = construct_hierarchical_tree(data_dict, prediction_depth=level)
+
+        folds = [{key: [] for key in data_dict.keys()} for _ in range(k)]
+        assigned = set()
+        # the dealing continues across the nodes, so that the folds stay balanced overall
+        dealt = 0
+        for _, samples in sorted(merged_on_level.items()):
+            samples = sorted(set(samples) - assigned)
+            assigned.update(samples)
+            for sample_index in rng.permutation(len(samples)):
+                p = samples[sample_index]
+                for full_cls in prots2classes_dict[p]:
+                    folds[dealt % k][full_cls].append(p)
+                dealt += 1
+        return folds
+
     @staticmethod
     def merge_data(data=None):
         """
@@ -199,7 +300,19 @@ class EnzymeDataManager(DataManager):
                  percentage_test=30,
                  percentage_val=30,
                  split_strategy='strict',
-                 add_sidechain_channels=True):
+                 add_sidechain_channels=True,
+                 grid_pyramid=None,
+                 sparse_threshold=None,
+                 incremental=True,
+                 collect_garbage=False,
+                 split_materialization='link',
+                 split_policy='confirm',
+                 split_seed=None,
+                 n_folds=None,
+                 pdb_mirror=None,
+                 download_workers=8,
+                 ec2pdb_url=None,
+                 ec2pdb_mapping=None):
         """
         :param data_dir: the path to the root data directory
         :param force_download: forces the downloading of the protein pdb files should be done
@@ -214,6 +327,46 @@ class EnzymeDataManager(DataManager):
         :param split_strategy: split strategy to use, 'naive' or 'strict'
         :param add_sidechain_channels: boolean, whether to use 24-channel grid density maps (with
             all sidechains as channels) or 1 channel grid density map
+        :param grid_pyramid: (optional) list of smaller grid sides, for which block-averaged
+            versions of the grids are derived from the grid_size grids, e.g. [64, 32]
+        :param sparse_threshold: (optional) if given, the occupied voxels (density above the
+            threshold) of the grids and their pyramid levels are stored as well, as inputs for
+            the sparse networks (see EnzymesSparseGridFeeder)
+        :param incremental: if True, the pre-processing is run even if it is not forced, but only
+            proteins whose PDB file changed, or whose artifacts are missing or were produced
+            with different parameters, are processed again (see ArtifactManifest). If False,
+            the pre-processing is skipped entirely unless forced.
+        :param collect_garbage: if True, the pre-processing removes the processed data of the
+            proteins that are no longer part of the data set (e.g. of enzyme classes that were
+            dropped from enzyme_classes), see EnzymeDataProcessor
+        :param split_materialization: how the proteins of the train / test splits are put into
+            their directories:
+            'link' - the processed files are hard-, reflinked or symlinked (copied only if the
+                     filesystem supports none of those)
+            'copy' - the processed files are copied
+            'manifest' - nothing is materialized, only the split indices are stored and the
+                     proteins are read from the processed directory (see get_samples_dir)
+        :param split_policy: what happens when a split is forced and a split already exists:
+            'confirm' - ask on the command line whether the test set should be split again,
+                        otherwise only the train / validation split is made again
+            'auto' - split again without asking (for unattended pipelines)
+            'never' - keep the existing split (a split is only made if there is none)
+        :param split_seed: (optional) seed for the random split. If given, the split is
+            reproducible and it is cached under misc/splits, keyed by the seed, the split
+            strategy, the percentages and the split proteins, so that repeated runs with the
+            same parameters reuse it instead of splitting and materializing it again.
+        :param n_folds: (optional) if given, the train and validation proteins are additionally
+            split into n_folds cross-validation folds (with the split_strategy). The folds are
+            only index files (under misc/folds), the proteins are read from the existing train
+            directory, and a fold is selected with the fold parameter of get_training_set and
+            get_validation_set (see also the fold parameter of the data feeders).
+        :param pdb_mirror: (optional) path or file:// URL of a local PDB mirror directory or
+            tarball, from which the PDB files are taken instead of downloading them
+        :param download_workers: number of concurrent PDB downloads (and EC2PDB page requests)
+        :param ec2pdb_url: (optional) URL template of the EC2PDB pages, see EnzymeFetcher
+        :param ec2pdb_mapping: (optional) path to a local CSV dump of the EC to PDB mapping (e.g.
+            SIFTS pdb_chain_enzyme.csv.gz), if given it is used instead of crawling EC2PDB, see
+            EnzymeMappingFetcher
         """
         super(EnzymeDataManager, self).__init__(data_dir=data_dir,
                                                 force_download=force_download,
@@ -228,6 +381,26 @@ class EnzymeDataManager(DataManager):
         self.max_hierarchical_depth = hierarchical_depth
         self.split_strategy = split_strategy
         self.add_sidechain_channels = add_sidechain_channels
+        self.grid_pyramid = grid_pyramid or list()
+        self.sparse_threshold = sparse_threshold
+        self.incremental = incremental
+        self.collect_garbage = collect_garbage
+        if split_materialization not in ['link', 'copy', 'manifest']:
+            log.error("split_materialization can only be 'link', 'copy' or 'manifest'")
+            raise ValueError
+        self.split_materialization = split_materialization
+        if split_policy not in ['confirm', 'auto', 'never']:
+            log.error("split_policy can only be 'confirm', 'auto' or 'never'")
+            raise ValueError
+        self.split_policy = split_policy
+        self.split_seed = split_seed
+        self.n_folds = n_folds
+        self.folds = None
+        self.fold_datasets = dict()
+        self.pdb_mirror = pdb_mirror
+        self.download_workers = download_workers
+        self.ec2pdb_url = ec2pdb_url or prep.EnzymeFetcher.DEFAULT_PAGE_URL
+        self.ec2pdb_mapping = ec2pdb_mapping
 
         self.validator = EnzymeValidator(enz_classes=enzyme_classes,
                                          dirs=self.dirs)
@@ -245,10 +418,18 @@ class EnzymeDataManager(DataManager):
 
         # Download the data if required
         if self.force_download:
-            ef = prep.EnzymeFetcher(categories=self.enzyme_classes,
-                                    enzyme_dir=self.dirs['data_raw'])
+            if self.ec2pdb_mapping is not None:
+                ef = prep.EnzymeMappingFetcher(categories=self.enzyme_classes,
+                                               mapping_file=self.ec2pdb_mapping)
+            else:
+                ef = prep.EnzymeFetcher(categories=self.enzyme_classes,
+                                        enzyme_dir=self.dirs['data_raw'],
+                                        page_url=self.ec2pdb_url,
+                                        cache_dir=os.path.join(self.dirs['misc'], "http_cache"),
+                                        n_workers=self.download_workers)
             self.all_proteins = ef.fetch_enzymes()
-            prep.download_pdbs(base_dir=self.dirs['data_raw'], protein_codes=self.all_proteins)
+            prep.download_pdbs(base_dir=self.dirs['data_raw'], protein_codes=self.all_proteins,
+                               n_workers=self.download_workers, mirror=self.pdb_mirror)
             save_pickle(file_path=os.path.join(self.dirs["data_raw"], "all_prot_codes.pickle"),
                         data=self.all_proteins)
             self._save_enzyme_list(target_dir=self.dirs["data_raw"],
@@ -264,8 +445,8 @@ class EnzymeDataManager(DataManager):
         log.info("Total number of downloaded proteins found is {0}. Failed to download {1}".
                  format(n_successful, n_failed))
 
-        # Process the data if required
-        if self.force_memmaps or self.force_grids:
+        # Process the data if required, incrementally only the changed proteins are processed
+        if self.force_memmaps or self.force_grids or self.incremental:
             edp = prep.EnzymeDataProcessor(protein_codes=self.all_proteins,
                                            from_dir=self.dirs['data_raw'],
                                            target_dir=self.dirs['data_processed'],
@@ -273,7 +454,10 @@ class EnzymeDataManager(DataManager):
                                            force_process_grids=self.force_grids,
                                            force_process_memmaps=self.force_memmaps,
                                            add_sidechain_channels=self.add_sidechain_channels,
-                                           use_esp=False)
+                                           use_esp=False,
+                                           grid_pyramid=self.grid_pyramid,
+                                           sparse_threshold=self.sparse_threshold,
+                                           collect_garbage=self.collect_garbage)
             self.valid_proteins = edp.process()
             self.validator.check_class_representation(self.valid_proteins, clean_dict=True)
             save_pickle(
@@ -286,84 +470,22 @@ class EnzymeDataManager(DataManager):
             self.valid_proteins = load_pickle(
                 file_path=os.path.join(self.dirs["data_processed"], "valid_prot_codes.pickle"))
             self.validator.check_class_representation(self.valid_proteins, clean_dict=True)
+            if len(self.grid_pyramid) > 0 or self.sparse_threshold is not None:
+                # only the missing resolution levels (and occupied voxels) are derived from the
+                # existing grids
+                for prot_code in set(itertools.chain.from_iterable(self.valid_proteins.values())):
+                    prot_dir = os.path.join(self.dirs['data_processed'], prot_code.upper())
+                    prep.process_grid_pyramid(prot_dir=prot_dir, grid_size=self.grid_size,
+                                              level_sides=self.grid_pyramid)
+                    if self.sparse_threshold is not None:
+                        prep.process_sparse_voxels(
+                            prot_dir=prot_dir, grid_size=self.grid_size,
+                            level_sides=[self.grid_size] + self.grid_pyramid,
+                            threshold=self.sparse_threshold)
 
         # Split test / val data set if required
         if self.force_split:
-            resp = raw_input(
-                "Do you really want to split a test set into a separate directory?" +
-                " This will change the existing test set / train set split! y/[n]\n")
-            if resp.startswith('y'):
-                if self.split_strategy == 'naive':
-                    test_dataset, trainval_data = self.split_data_on_level(
-                        self.valid_proteins,
-                        percentage=self.p_test, level=3)
-                    val_dataset, train_dataset = self.split_data_on_level(
-                        trainval_data,
-                        percentage=self.p_val, level=3)
-                elif self.split_strategy == 'strict':
-                    test_dataset, trainval_data = self.split_data_on_sublevel(
-                        self.valid_proteins,
-                        percentage=self.p_test, hierarchical_depth=3)
-                    val_dataset, train_dataset = self.split_data_on_sublevel(
-                        trainval_data,
-                        percentage=self.p_val, hierarchical_depth=3)
-                else:
-                    log.error("Split strategy can be 'naive' or 'strict'")
-                    raise ValueError
-
-                self.validator.check_splitting(self.valid_proteins, trainval_data, test_dataset)
-                self.validator.check_splitting(trainval_data, train_dataset, val_dataset)
-
-                # recreate the train and test dirs
-                shutil.rmtree(self.dirs['data_train'])
-                os.makedirs(self.dirs['data_train'])
-                shutil.rmtree(self.dirs['data_test'])
-                os.makedirs(self.dirs['data_test'])
-
-                # save val and train sets under dirs["data_train"], copy over all corresponding
-                # data samples
-                self._copy_processed(target_dir=self.dirs["data_train"],
-                                     proteins_dict=trainval_data)
-                self._save_enzyme_list(target_dir=self.dirs["data_train"],
-                                       proteins_dict=trainval_data)
-                save_pickle(file_path=[os.path.join(self.dirs["data_train"],
-                                                    "train_prot_codes.pickle"),
-                                       os.path.join(self.dirs["data_train"],
-                                                    "val_prot_codes.pickle")],
-                            data=[train_dataset, val_dataset])
-
-                # save test set under dirs["data_test"], copy over all
-                # corresponding data samples
-                self._copy_processed(target_dir=self.dirs["data_test"],
-                                     proteins_dict=test_dataset)
-                self._save_enzyme_list(target_dir=self.dirs["data_test"],
-                                       proteins_dict=test_dataset)
-                save_pickle(file_path=os.path.join(self.dirs["data_test"],
-                                                   "test_prot_codes.pickle"),
-                            data=test_dataset)
-            else:
-                # only reinitialize the train and validation sets
-                # the existing train and val pickles need to be merged and split
-                # again
-                train_dataset, val_dataset = load_pickle(
-                    file_path=[os.path.join(self.dirs["data_train"],
-                                            "train_prot_codes.pickle"),
-                               os.path.join(self.dirs["data_train"],
-                                            "val_prot_codes.pickle")])
-                trainval_data = self.merge_data(
-                    data=[train_dataset, val_dataset])
-
-                # split them again
-                val_dataset, train_dataset = self.split_data_on_level(
-                    trainval_data,
-                    percentage=self.p_val, level=3)
-
-                self.validator.check_splitting(trainval_data, train_dataset, val_dataset)
-
-                save_pickle(
-                    file_path=[os.path.join(self.dirs["data_train"], "train_prot_codes.pickle"),
-                               os.path.join(self.dirs["data_train"], "val_prot_codes.pickle")],
-                    data=[train_dataset, val_dataset])
+            self._split_data()
         else:
             log.info("Skipping splitting step")
 
@@ -380,7 +502,214 @@ class EnzymeDataManager(DataManager):
         # generate labels based on the data-sets
         lf = LabelFactory(self.train_dataset, self.val_dataset, self.test_dataset,
                           hierarchical_depth=self.max_hierarchical_depth)
-        self.train_labels, self.val_labels, self.test_labels = lf.generate_hierarchical_labels()
+        self.train_labels, self.val_labels, self.test_labels = lf.generate_hierarchical_labels(
+            cache_dir=os.path.join(self.dirs['misc'], "labels"))
+
+        if self.n_folds is not None:
+            trainval_dataset = self.merge_data([self.train_dataset, self.val_dataset])
+            self.folds = self._load_or_make_folds(trainval_dataset)
+            # the labels of all train and val. proteins, the class columns are the same as for
+            # the regular split, since the union of the classes is the same
+            lf = LabelFactory(trainval_dataset, dict(), self.test_dataset,
+                              hierarchical_depth=self.max_hierarchical_depth)
+            self.trainval_labels, _, _ = lf.generate_hierarchical_labels(
+                cache_dir=os.path.join(self.dirs['misc'], "labels"))
+
+    def _load_or_make_folds(self, trainval_dataset):
+        """
+        Loads the cross-validation folds of the train and val. proteins from misc/folds, or
+        splits them into folds and persists them. The folds are keyed by the proteins, the
+        split strategy, the number of folds and the seed.
+
+        :param trainval_dataset: data dictionary of all train and validation proteins
+        :return: list of n_folds data dictionaries
+        """
+        import hashlib
+        proteins = sorted((cls, sorted(prots)) for cls, prots in trainval_dataset.items())
+        key = hashlib.sha1(repr((self.n_folds, self.split_strategy, self.split_seed,
+                                 proteins))).hexdigest()[:16]
+        folds_file = os.path.join(self.dirs['misc'], "folds", "{}.pickle".format(key))
+        if os.path.exists(folds_file):
+            log.info("Loading the {} cross-validation folds {}".format(self.n_folds, key))
+            return load_pickle(folds_file)
+
+        if self.split_strategy == 'naive':
+            rng = np.random if self.split_seed is None else np.random.RandomState(
+                self.split_seed)
+            folds = self.k_fold_split_on_level(trainval_dataset, k=self.n_folds, level=3,
+                                               rng=rng)
+        elif self.split_strategy == 'strict':
+            folds = self.k_fold_split_on_sublevel(trainval_dataset, k=self.n_folds,
+                                                  hierarchical_depth=3, seed=self.split_seed)
+        else:
+            log.error("Split strategy can be 'naive' or 'strict'")
+            raise ValueError
+        for fold in range(self.n_folds):
+            validation_set = folds[fold]
+            training_set = self.merge_data([f for i, f in enumerate(folds) if i != fold])
+            self.validator.check_splitting(trainval_dataset, training_set, validation_set)
+
+        if not os.path.exists(os.path.dirname(folds_file)):
+            os.makedirs(os.path.dirname(folds_file))
+        save_pickle(file_path=folds_file, data=folds)
+        log.info("Created {} cross-validation folds {}".format(self.n_folds, key))
+        return folds
+
+    def _fold_datasets(self, fold):
+        """
+        :return: the (training, validation) data dictionaries of a cross-validation fold
+        """
+        if self.folds is None:
+            log.error("No cross-validation folds were made, set n_folds")
+            raise ValueError
+        if not 0 <= fold < self.n_folds:
+            log.error("Fold must be in [0, {})".format(self.n_folds))
+            raise ValueError
+        if fold not in self.fold_datasets:
+            training_set = self.merge_data([f for i, f in enumerate(self.folds) if i != fold])
+            self.fold_datasets[fold] = (training_set, self.folds[fold])
+        return self.fold_datasets[fold]
+
+    def _split_data(self):
+        """
+        Splits the valid proteins into train / validation / test sets according to the
+        split_policy, materializes the split directories and persists the split pickles.
+        """
+        split_files = [os.path.join(self.dirs["data_train"], "train_prot_codes.pickle"),
+                       os.path.join(self.dirs["data_train"], "val_prot_codes.pickle"),
+                       os.path.join(self.dirs["data_test"], "test_prot_codes.pickle")]
+        split_exists = all([os.path.exists(f) for f in split_files])
+        if self.split_policy == 'never' and split_exists:
+            log.info("Keeping the existing split (split_policy is 'never')")
+            return
+
+        split_key = self._split_key()
+        key_file = os.path.join(self.dirs["data_test"], "split_key.txt")
+        if split_key is not None and split_exists and os.path.exists(key_file):
+            with open(key_file, 'r') as f:
+                if f.read().strip() == split_key:
+                    log.info("The same split ({}) is already in place".format(split_key))
+                    return
+
+        if self.split_policy == 'confirm' and split_exists:
+            resp = raw_input(
+                "Do you really want to split a test set into a separate directory?" +
+                " This will change the existing test set / train set split! y/[n]\n")
+            split_test = resp.startswith('y')
+        else:
+            split_test = True
+
+        rng = np.random if self.split_seed is None else np.random.RandomState(self.split_seed)
+        if not split_test:
+            # only reinitialize the train and validation sets
+            # the existing train and val pickles need to be merged and split
+            # again
+            train_dataset, val_dataset = load_pickle(file_path=split_files[:2])
+            trainval_data = self.merge_data(
+                data=[train_dataset, val_dataset])
+
+            # split them again
+            val_dataset, train_dataset = self.split_data_on_level(
+                trainval_data,
+                percentage=self.p_val, level=3, rng=rng)
+
+            self.validator.check_splitting(trainval_data, train_dataset, val_dataset)
+
+            save_pickle(file_path=split_files[:2], data=[train_dataset, val_dataset])
+            if os.path.exists(key_file):
+                os.remove(key_file)
+            return
+
+        cache_dir = None if split_key is None else os.path.join(self.dirs['misc'], "splits",
+                                                                 split_key)
+        cache_files = None if cache_dir is None else \
+            [os.path.join(cache_dir, os.path.basename(f)) for f in split_files]
+        if cache_dir is not None and os.path.exists(cache_dir) and \
+                not all(os.path.exists(f) for f in cache_files):
+            # left over by an interrupted run (before the cache was written atomically)
+            log.warning("Removing the incomplete cached split {}".format(split_key))
+            shutil.rmtree(cache_dir)
+        if cache_dir is not None and os.path.exists(cache_dir):
+            log.info("Reusing the cached split {}".format(split_key))
+            train_dataset, val_dataset, test_dataset = load_pickle(file_path=cache_files)
+            trainval_data = self.merge_data(data=[train_dataset, val_dataset])
+        else:
+            if self.split_strategy == 'naive':
+                test_dataset, trainval_data = self.split_data_on_level(
+                    self.valid_proteins,
+                    percentage=self.p_test, level=3, rng=rng)
+                val_dataset, train_dataset = self.split_data_on_level(
+                    trainval_data,
+                    percentage=self.p_val, level=3, rng=rng)
+            elif self.split_strategy == 'strict':
+                test_dataset, trainval_data = self.split_data_on_sublevel(
+                    self.valid_proteins,
+                    percentage=self.p_test, hierarchical_depth=3, seed=self.split_seed)
+                val_dataset, train_dataset = self.split_data_on_sublevel(
+                    trainval_data,
+                    percentage=self.p_val, hierarchical_depth=3, seed=self.split_seed)
+            else:
+                log.error("Split strategy can be 'naive' or 'strict'")
+                raise ValueError
+
+            self.validator.check_splitting(self.valid_proteins, trainval_data, test_dataset)
+            self.validator.check_splitting(trainval_data, train_dataset, val_dataset)
+
+            if cache_dir is not None:
+                # the pickles are written into a temporary sibling directory, which is renamed
+                # only when all of them are complete
+                tmp_dir = "{}.{}.tmp".format(cache_dir, os.getpid())
+                if os.path.exists(tmp_dir):
+                    shutil.rmtree(tmp_dir)
+                os.makedirs(tmp_dir)
+                save_pickle(
+                    file_path=[os.path.join(tmp_dir, os.path.basename(f)) for f in split_files],
+                    data=[train_dataset, val_dataset, test_dataset])
+                try:
+                    os.rename(tmp_dir, cache_dir)
+                except OSError:
+                    # the same split was cached concurrently
+                    shutil.rmtree(tmp_dir)
+
+        # recreate the train and test dirs
+        shutil.rmtree(self.dirs['data_train'])
+        os.makedirs(self.dirs['data_train'])
+        shutil.rmtree(self.dirs['data_test'])
+        os.makedirs(self.dirs['data_test'])
+
+        # save val and train sets under dirs["data_train"], copy over all corresponding
+        # data samples
+        self._copy_processed(target_dir=self.dirs["data_train"],
+                             proteins_dict=trainval_data)
+        self._save_enzyme_list(target_dir=self.dirs["data_train"],
+                               proteins_dict=trainval_data)
+        save_pickle(file_path=split_files[:2], data=[train_dataset, val_dataset])
+
+        # save test set under dirs["data_test"], copy over all
+        # corresponding data samples
+        self._copy_processed(target_dir=self.dirs["data_test"],
+                             proteins_dict=test_dataset)
+        self._save_enzyme_list(target_dir=self.dirs["data_test"],
+                               proteins_dict=test_dataset)
+        save_pickle(file_path=split_files[2], data=test_dataset)
+
+        # written last, marks the split as complete
+        if split_key is not None:
+            with open(key_file, 'w') as f:
+                f.write(split_key)
+
+    def _split_key(self):
+        """
+        :return: a key identifying the split of the valid proteins with the current split
+            parameters, or None if the split is not seeded (and hence not reproducible)
+        """
+        if self.split_seed is None:
+            return None
+        import hashlib
+        proteins = sorted((cls, sorted(prots)) for cls, prots in self.valid_proteins.items())
+        params = (self.split_seed, self.split_strategy, self.p_test, self.p_val,
+                  self.split_materialization, proteins)
+        return hashlib.sha1(repr(params)).hexdigest()[:16]
 
     def _select_enzymes(self, dataset):
         """
@@ -414,32 +743,66 @@ class EnzymeDataManager(DataManager):
             self.all_proteins[cls] = list(
                 set(self.all_proteins[cls]) - set(failed[cls]))
 
-    def get_training_set(self):
-        return self.train_dataset, self.train_labels
+    def get_training_set(self, fold=None):
+        """
+        :param fold: (optional) id of the cross-validation fold, whose training set is returned
+        :return: the training data dictionary and labels
+        """
+        if fold is None:
+            return self.train_dataset, self.train_labels
+        return self._fold_datasets(fold)[0], self.trainval_labels
 
-    def get_validation_set(self):
-        return self.val_dataset, self.val_labels
+    def get_validation_set(self, fold=None):
+        """
+        :param fold: (optional) id of the cross-validation fold, whose validation set is returned
+        :return: the validation data dictionary and labels
+        """
+        if fold is None:
+            return self.val_dataset, self.val_labels
+        return self._fold_datasets(fold)[1], self.trainval_labels
 
     def get_test_set(self):
         return self.test_dataset, self.test_labels
 
+    def get_samples_dir(self, split):
+        """
+        Resolves the directory under which the proteins of a data split can be loaded (each in
+        its own <prot_code> subdirectory).
+
+        :param split: 'train', 'val' or 'test'
+        :return: the directory path
+        """
+        if split not in ['train', 'val', 'test']:
+            log.error("split can only be 'train', 'val' or 'test'")
+            raise ValueError
+        if self.split_materialization == 'manifest':
+            return self.dirs['data_processed']
+        return self.dirs['data_test'] if split == 'test' else self.dirs['data_train']
+
     def _copy_processed(self, target_dir, proteins_dict):
         """
         After the data is split, the test proteins are moved to a separate directory so that they do
-        not interfere with the training and validation proteins. This method copies the proteins
-        from one directory to another.
+        not interfere with the training and validation proteins. This method materializes the
+        proteins from the processed directory in the target directory, by linking or copying
+        the files depending on split_materialization. Nothing is done for 'manifest'.
 
         :param target_dir: the target directory to which proteins are copied
         :param proteins_dict: the source directory from which proteins are copied
         :return:
         """
+        if self.split_materialization == 'manifest':
+            return
         src_dir = self.dirs["data_processed"]
-        for prot_codes in proteins_dict.values():
-            for prot_code in prot_codes:
-                os.system("cp -R %s %s" % (
-                    os.path.join(src_dir, prot_code.upper()),
-                    os.path.join(target_dir, ".")))
-                log.info("Copied {0} to {1}".format(prot_code, target_dir))
+        methods = LINK_METHODS if self.split_materialization == 'link' else ('copy',)
+        prot_codes = set(itertools.chain.from_iterable(proteins_dict.values()))
+        for prot_code in prot_codes:
+            used = link_tree(os.path.join(src_dir, prot_code.upper()),
+                             os.path.join(target_dir, prot_code.upper()),
+                             methods=methods)
+            # do not retry the methods which are not supported by the filesystem
+            methods = methods[methods.index(used):]
+        log.info("Materialized {0} proteins in {1} ({2})".format(len(prot_codes), target_dir,
+                                                                 methods[0]))
 
     @staticmethod
     def _save_enzyme_list(target_dir, proteins_dict):
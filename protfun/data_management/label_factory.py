@@ -1,6 +1,82 @@
+import hashlib
+import os
+import shutil
 import numpy as np
 
 
+class HierarchicalLabels(object):
+    """
+    HierarchicalLabels holds the labels of all proteins in a data set as one dense int8 matrix
+    per hierarchical depth (one row per protein, one column per class at that depth), together
+    with an index from protein code to matrix row.
+
+    Indexing with a protein code returns the list of label vectors for all depths, as for the
+    dictionaries of labels used before. Labels for a whole minibatch are gathered with take().
+
+    Usage::
+        >>> labels = HierarchicalLabels.load("data/misc/labels/<key>/train.npz")
+        >>> labels['1A0A'][2]  # label vector at depth 3
+        >>> labels.take(['1A0A', '1A0B'], depth=3)  # matrix of shape (2, n_classes_at_depth_3)
+    """
+
+    def __init__(self, prot_codes, matrices, classes_at_depth):
+        """
+        :param prot_codes: list of protein codes, in the order of the matrix rows
+        :param matrices: list of int8 label matrices, one for each depth
+        :param classes_at_depth: list of the (sorted) class names for each depth, in the order
+            of the matrix columns
+        """
+        self.prot_codes = list(prot_codes)
+        self.rows = {prot_code: i for i, prot_code in enumerate(self.prot_codes)}
+        self.matrices = matrices
+        self.classes_at_depth = classes_at_depth
+
+    def __getitem__(self, prot_code):
+        row = self.rows[prot_code]
+        return [matrix[row] for matrix in self.matrices]
+
+    def __contains__(self, prot_code):
+        return prot_code in self.rows
+
+    def __len__(self):
+        return len(self.prot_codes)
+
+    def keys(self):
+        return list(self.prot_codes)
+
+    def take(self, prot_codes, depth):
+        """
+        :param prot_codes: list of protein codes
+        :param depth: the hierarchical depth (counting from 1)
+        :return: the label matrix of the proteins at the given depth, with rows in the order of
+            prot_codes
+        """
+        rows = np.array([self.rows[prot_code] for prot_code in prot_codes], dtype=np.int64)
+        return self.matrices[depth - 1][rows]
+
+    def save(self, path):
+        """
+        Saves the labels as an .npz file.
+        """
+        arrays = {'prot_codes': np.array(self.prot_codes, dtype=str)}
+        for h, (matrix, classes) in enumerate(zip(self.matrices, self.classes_at_depth)):
+            arrays['labels_{}'.format(h)] = matrix
+            arrays['classes_{}'.format(h)] = np.array(classes, dtype=str)
+        np.savez(path, **arrays)
+
+    @staticmethod
+    def load(path):
+        """
+        Loads labels saved with save().
+        """
+        with np.load(path) as f:
+            depth = len([key for key in f.files if key.startswith('labels_')])
+            return HierarchicalLabels(
+                prot_codes=f['prot_codes'].tolist(),
+                matrices=[f['labels_{}'.format(h)] for h in range(depth)],
+                classes_at_depth=[f['classes_{}'.format(h)].tolist() for h in range(depth)])
+
+
 class LabelFactory(object):
     """
     LabelFactory is generating the labels from the hierarchical structure of the data classes.
@@ -20,7 +96,7 @@ class LabelFactory(object):
         self.test_dict = test_dict
         self.h_depth = hierarchical_depth
 
-    def generate_hierarchical_labels(self):
+    def generate_hierarchical_labels(self, cache_dir=None):
         """
         Generates a hierarchical labels consisting in one-hot encoded vectors for each class-level.
         If a protein is present in more classes then the one-hot labels are merged. For example [0,0,1] and [0,1,0]
@@ -33,60 +109,83 @@ class LabelFactory(object):
             >>> te = {'3.1.1': ['j'], '2.1.8': ['k']}
             >>> lf = LabelFactory(tr, va, te, 3)
             >>> tr, va, te = lf.generate_hierarchical_labels()
-            >>> print(tr)
-            >>> print(va)
-            >>> print(te)
+            >>> print(tr['a'])
+            >>> print(va['h'])
 
-            >>> {'a': [array([1, 1], dtype=int32), array([1, 1], dtype=int32), array([1, 0, 0, 0, 1, 0], dtype=int32)],
-            >>>  'c': [array([1, 0], dtype=int32), array([1, 0], dtype=int32), array([1, 0, 0, 0, 0, 0], dtype=int32)],
-            >>>  'b': [array([1, 0], dtype=int32), array([1, 0], dtype=int32), array([1, 0, 0, 0, 0, 0], dtype=int32)],
-            >>>  'e': [array([1, 0], dtype=int32), array([1, 0], dtype=int32), array([0, 1, 0, 0, 0, 0], dtype=int32)],
-            >>>  'd': [array([1, 0], dtype=int32), array([1, 0], dtype=int32), array([0, 1, 0, 0, 0, 0], dtype=int32)],
-            >>>  'g': [array([1, 0], dtype=int32), array([1, 0], dtype=int32), array([0, 0, 1, 0, 0, 0], dtype=int32)],
-            >>>  'f': [array([1, 0], dtype=int32), array([1, 0], dtype=int32), array([0, 0, 1, 0, 0, 0], dtype=int32)]}
+            >>> [array([1, 1], dtype=int8), array([1, 1], dtype=int8), array([1, 0, 0, 0, 1, 0], dtype=int8)]
+            >>> [array([0, 1], dtype=int8), array([0, 1], dtype=int8), array([0, 0, 0, 0, 0, 1], dtype=int8)]
 
-            >>> {'i': [array([1, 0], dtype=int32), array([1, 0], dtype=int32), array([1, 0, 0, 0, 0, 0], dtype=int32)],
-            >>>  'h': [array([0, 1], dtype=int32), array([0, 1], dtype=int32), array([0, 0, 0, 0, 0, 1], dtype=int32)]}
-            >>> {'k': [array([1, 0], dtype=int32), array([1, 0], dtype=int32), array([0, 0, 0, 1, 0, 0], dtype=int32)],
-            >>>  'j': [array([0, 1], dtype=int32), array([0, 1], dtype=int32), array([0, 0, 0, 0, 1, 0], dtype=int32)]}
-
-        :return: a tuple of three data dictionaries for training, validation and testing
+        :param cache_dir: (optional) directory in which the generated labels are persisted, keyed
+            by the data dictionaries and the depth. If labels for the same data were already
+            generated, they are loaded instead.
+        :return: a tuple of three HierarchicalLabels for training, validation and testing
         """
+        if cache_dir is not None:
+            labels_dir = os.path.join(cache_dir, self._labels_key())
+            label_files = [os.path.join(labels_dir, split + '.npz')
+                           for split in ['train', 'val', 'test']]
+            if os.path.exists(labels_dir):
+                return tuple(HierarchicalLabels.load(f) for f in label_files)
 
         # merge all classes form train, val and test data dicts
         all_classes = list(set(
             self.train_dict.keys() + self.val_dict.keys() + self.test_dict.keys()))
 
-        train_labels = dict()
-        val_labels = dict()
-        test_labels = dict()
-
         # for each of the hierarchical levels in depth, check how many different protein classes
         # there are for the given example, this would result in:
         # [['2', '3'], ['2.1', '3.1'], ['2.1.2', '2.1.3', '2.1.4', '2.1.8', '3.1.1', '3.1.2']]
         unique_labels_at_depth = [
             sorted(list(set(['.'.join(x.split('.')[:h + 1]) for x in all_classes])))
             for h in range(self.h_depth)]
-
-        # go over all sets (train, test, val) and for each go over all items (i.e. class and list
-        # of protein codes) and for each item go over all protein codes and create a label for each
-        # class-level
-        for data_dict, label_dict in zip(
-                [self.train_dict, self.val_dict, self.test_dict],
-                [train_labels, val_labels, test_labels]):
-            for cls, enzymes in data_dict.items():
-                for enz in enzymes:
-                    if enz not in label_dict.keys():
-                        label_dict[enz] = [
-                            np.zeros(len(unique_labels_at_depth[h]),
-                                     dtype=np.int32) for h in
-                            range(self.h_depth)]
-                    for h in range(self.h_depth):
-                        class_index = unique_labels_at_depth[h].index(
-                            '.'.join(cls.split('.')[:h + 1]))
-                        label_dict[enz][h][class_index] = 1
-
-        return train_labels, val_labels, test_labels
+        # the column of each class (at its own depth) in the label matrices
+        class_columns = [{cls: i for i, cls in enumerate(classes)}
+                         for classes in unique_labels_at_depth]
+
+        labels = tuple(self._label_matrices(data_dict, unique_labels_at_depth, class_columns)
+                       for data_dict in [self.train_dict, self.val_dict, self.test_dict])
+
+        if cache_dir is not None:
+            tmp_dir = labels_dir + '.tmp'
+            if os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir)
+            os.makedirs(tmp_dir)
+            for split_labels, label_file in zip(labels, label_files):
+                split_labels.save(os.path.join(tmp_dir, os.path.basename(label_file)))
+            os.rename(tmp_dir, labels_dir)
+        return labels
+
+    def _label_matrices(self, data_dict, unique_labels_at_depth, class_columns):
+        """
+        Builds the HierarchicalLabels of a single data dictionary: all (protein, class) pairs
+        are collected into row and column index arrays first, and then set in one go for each
+        depth.
+        """
+        rows_index = dict()
+        rows, leaf_classes = [], []
+        for cls, enzymes in data_dict.items():
+            for enz in enzymes:
+                rows.append(rows_index.setdefault(enz, len(rows_index)))
+                leaf_classes.append(cls)
+        prot_codes = sorted(rows_index, key=rows_index.get)
+        rows = np.array(rows, dtype=np.int64)
+
+        matrices = list()
+        for h in range(self.h_depth):
+            columns_of = {cls: class_columns[h]['.'.join(cls.split('.')[:h + 1])]
+                          for cls in data_dict}
+            columns = np.array([columns_of[cls] for cls in leaf_classes], dtype=np.int64)
+            matrix = np.zeros((len(prot_codes), len(unique_labels_at_depth[h])), dtype=np.int8)
+            matrix[rows, columns] = 1
+            matrices.append(matrix)
+        return HierarchicalLabels(prot_codes, matrices, unique_labels_at_depth)
+
+    def _labels_key(self):
+        """
+        :return: a key identifying the data dictionaries and the depth the labels are made for
+        """
+        dicts = [sorted((cls, sorted(prots)) for cls, prots in data_dict.items())
+                 for data_dict in [self.train_dict, self.val_dict, self.test_dict]]
+        return hashlib.sha1(repr((self.h_depth, dicts))).hexdigest()[:16]
 
 
 if __name__ == "__main__":
@@ -96,6 +195,5 @@ if __name__ == "__main__":
     te = {'3.1.1': ['j'], '2.1.8': ['k']}
     lf = LabelFactory(tr, va, te, 3)
     tr, va, te = lf.generate_hierarchical_labels()
-    print(tr)
-    print(va)
-    print(te)
+    for labels in [tr, va, te]:
+        print({prot_code: labels[prot_code] for prot_code in labels.keys()})
@@ -1,2 +1,4 @@
-from protein_fetcher import EnzymeFetcher, download_pdbs
-from preprocessor import EnzymeDataProcessor, GODataProcessor
+from protein_fetcher import EnzymeFetcher, EnzymeMappingFetcher, PDBDownloader, download_pdbs
+from preprocessor import EnzymeDataProcessor, GODataProcessor, process_grid_pyramid, \
+    process_sparse_voxels
+from manifest import ArtifactManifest
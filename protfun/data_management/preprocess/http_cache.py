@@ -0,0 +1,166 @@
+import cPickle
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from protfun.utils.log import get_logger
+
+log = get_logger("http_cache")
+
+
+class RateLimiter(object):
+    """
+    Thread-safe rate limiter, spaces out the calls to wait() such that at most
+    max_per_second of them return per second.
+    """
+
+    def __init__(self, max_per_second=None):
+        """
+        :param max_per_second: maximal rate, None for no limit
+        """
+        self.interval = 0. if not max_per_second else 1. / max_per_second
+        self.lock = threading.Lock()
+        self.next_time = 0.
+
+    def wait(self):
+        if self.interval == 0.:
+            return
+        with self.lock:
+            now = time.time()
+            wait_for = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_for > 0:
+            time.sleep(wait_for)
+
+
+class CachedHTTPClient(object):
+    """
+    CachedHTTPClient performs HTTP GET requests and persists the responses on disk, one file per
+    URL. A cached response is revalidated with a conditional request (If-None-Match /
+    If-Modified-Since, from the ETag and Last-Modified headers of the cached response), so that an
+    unchanged page is not transferred again. Responses younger than max_age are used without
+    any request at all.
+
+    The client can be shared by multiple threads, the requests are rate limited.
+
+    Usage::
+        >>> client = CachedHTTPClient(cache_dir="data/misc/http_cache", max_requests_per_second=5)
+        >>> html = client.get_text("https://www.ebi.ac.uk/...")
+    """
+
+    def __init__(self, cache_dir=None, max_requests_per_second=None, max_age=None, timeout=60,
+                 retries=3):
+        """
+        :param cache_dir: directory in which the responses are persisted. If None, they are kept
+            in a temporary directory, which is removed by close().
+        :param max_requests_per_second: (optional) rate limit for the requests
+        :param max_age: (optional) age in seconds, below which cached responses are not
+            revalidated. If None, cached responses are always revalidated.
+        :param timeout: timeout of the requests in seconds
+        :param retries: how many times a failed request is retried (with exponential backoff)
+        """
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.timeout = timeout
+        self.retries = retries
+        self.rate_limiter = RateLimiter(max_requests_per_second)
+        self.stats = {'hits': 0, 'revalidated': 0, 'fetched': 0}
+        # the temporary directory is created on the first request (again after close())
+        self.is_temporary = cache_dir is None
+        self.lock = threading.Lock()
+        if cache_dir is not None and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def close(self):
+        """
+        Removes the temporary cache directory, if the client was created without a cache_dir.
+        A persistent cache_dir is left untouched.
+        """
+        with self.lock:
+            if self.is_temporary and self.cache_dir is not None:
+                shutil.rmtree(self.cache_dir, ignore_errors=True)
+                self.cache_dir = None
+
+    def _get_cache_dir(self):
+        with self.lock:
+            if self.cache_dir is None:
+                self.cache_dir = tempfile.mkdtemp(prefix="http_cache_")
+            return self.cache_dir
+
+    def get_text(self, url):
+        """
+        :param url: the URL to GET
+        :return: the body of the response as text
+        :raises: IOError if the page can not be fetched (and is not cached)
+        """
+        import requests
+
+        cache_file = os.path.join(self._get_cache_dir(),
+                                  hashlib.sha1(url).hexdigest() + '.pickle')
+        cached = self._load(cache_file)
+        if cached is not None and self.max_age is not None and \
+                time.time() - cached['time'] < self.max_age:
+            self.stats['hits'] += 1
+            return cached['body']
+
+        headers = dict()
+        if cached is not None:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        response = None
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.wait()
+            try:
+                response = requests.get(url, headers=headers, timeout=self.timeout)
+                if response.status_code < 500:
+                    break
+            except requests.RequestException as e:
+                log.debug("Request for {} failed: {}".format(url, e))
+            if attempt < self.retries:
+                time.sleep(2 ** attempt)
+
+        if response is None or response.status_code >= 500:
+            if cached is not None:
+                log.warning("Could not revalidate {}, using the cached page".format(url))
+                return cached['body']
+            raise IOError("Could not fetch {}".format(url))
+
+        if response.status_code == 304 and cached is not None:
+            self.stats['revalidated'] += 1
+            cached['time'] = time.time()
+            self._save(cache_file, cached)
+            return cached['body']
+
+        self.stats['fetched'] += 1
+        entry = {'url': url,
+                 'time': time.time(),
+                 'etag': response.headers.get('ETag'),
+                 'last_modified': response.headers.get('Last-Modified'),
+                 'body': response.text}
+        if response.status_code == 200:
+            self._save(cache_file, entry)
+        return entry['body']
+
+    @staticmethod
+    def _load(cache_file):
+        if not os.path.exists(cache_file):
+            return None
+        try:
+            with open(cache_file, 'rb') as f:
+                return cPickle.load(f)
+        except (EOFError, ValueError, cPickle.UnpicklingError):
+            return None
+
+    @staticmethod
+    def _save(cache_file, entry):
+        # unique temp file per thread, the rename is atomic
+        tmp_file = "{}.{}.tmp".format(cache_file, threading.current_thread().ident)
+        with open(tmp_file, 'wb') as f:
+            cPickle.dump(entry, f, protocol=cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_file, cache_file)
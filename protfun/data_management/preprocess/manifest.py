@@ -0,0 +1,171 @@
+import cPickle
+import hashlib
+import os
+import shutil
+
+from protfun.utils.log import get_logger
+
+log = get_logger("manifest")
+
+# bump whenever the pre-processing code changes the produced memmaps or grids, this invalidates
+# all artifacts recorded with a previous version
+PROCESSOR_VERSION = 1
+
+
+def file_sha1(file_path, chunk_size=1 << 20):
+    """
+    Computes the SHA1 hex digest of a file's contents, reading it in chunks.
+
+    :param file_path: path to the file
+    :param chunk_size: number of bytes read at once
+    :return: the hex digest string
+    """
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        chunk = f.read(chunk_size)
+        while chunk:
+            sha1.update(chunk)
+            chunk = f.read(chunk_size)
+    return sha1.hexdigest()
+
+
+def params_key(**params):
+    """
+    Computes a short, order independent key for a set of processing parameters. The processor
+    version is always part of the key.
+
+    Usage::
+        >>> params_key(grid_size=64, add_sidechain_channels=False)
+
+    :param params: the parameters that influence a processing step
+    :return: a hex string
+    """
+    params['processor_version'] = PROCESSOR_VERSION
+    return hashlib.sha1(repr(sorted(params.items()))).hexdigest()[:16]
+
+
+class ArtifactManifest(object):
+    """
+    ArtifactManifest records, for every pre-processed protein, the hash of the PDB file the
+    artifacts were produced from and the parameters key of each processing step (e.g. 'memmaps',
+    'grid'). An artifact is up to date only if both still match, which allows the pre-processing
+    to recompute only the proteins whose PDB file or processing parameters changed.
+
+    The PDB file hashes are cached together with the file's size and modification time, so that
+    unchanged files are not read again on every run.
+
+    Usage::
+        >>> manifest = ArtifactManifest.load("data/processed/manifest.pickle")
+        >>> pdb_hash = manifest.pdb_hash("1A0A", "data/raw/1A0A/pdb1a0a.ent")
+        >>> if not manifest.is_current("1A0A", "grid", pdb_hash, params_key(grid_size=64)):
+        >>>     # recompute the grid ...
+        >>>     manifest.record("1A0A", "grid", pdb_hash, params_key(grid_size=64))
+        >>> manifest.save()
+    """
+
+    def __init__(self, path, entries=None):
+        """
+        :param path: the file in which the manifest is persisted
+        :param entries: (optional) the already recorded entries, a dict with keys protein codes
+        """
+        self.path = path
+        self.entries = entries or dict()
+
+    @staticmethod
+    def load(path):
+        """
+        Loads the manifest from path, or creates an empty one if it does not exist yet.
+
+        :param path: the file in which the manifest is persisted
+        :return: the ArtifactManifest
+        """
+        if not os.path.exists(path):
+            return ArtifactManifest(path)
+        with open(path, 'rb') as f:
+            return ArtifactManifest(path, entries=cPickle.load(f))
+
+    def save(self):
+        """
+        Persists the manifest atomically (writes a temp file and renames it).
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            cPickle.dump(self.entries, f, protocol=cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.path)
+
+    def pdb_hash(self, prot_code, pdb_file):
+        """
+        Returns the content hash of the protein's PDB file, re-hashing it only if its size or
+        modification time changed since it was last hashed.
+
+        :param prot_code: the PDB code of the protein
+        :param pdb_file: path to the raw PDB file
+        :return: the SHA1 hex digest, or None if the file does not exist
+        """
+        if not os.path.exists(pdb_file):
+            return None
+        stat = os.stat(pdb_file)
+        entry = self.entries.setdefault(prot_code, dict())
+        if entry.get('pdb_stat') != (stat.st_size, stat.st_mtime):
+            entry['pdb_stat'] = (stat.st_size, stat.st_mtime)
+            entry['pdb_sha1'] = file_sha1(pdb_file)
+        return entry['pdb_sha1']
+
+    def is_known(self, prot_code, step):
+        """
+        :return: True if the processing step was ever recorded for the protein
+        """
+        return step in self.entries.get(prot_code, dict()).get('steps', dict())
+
+    def is_current(self, prot_code, step, pdb_hash, key):
+        """
+        :param prot_code: the PDB code of the protein
+        :param step: the name of the processing step, e.g. 'grid'
+        :param pdb_hash: the current hash of the protein's PDB file
+        :param key: the current parameters key of the step (see params_key)
+        :return: True if the step's artifacts were produced from the same PDB file with the
+            same parameters
+        """
+        steps = self.entries.get(prot_code, dict()).get('steps', dict())
+        return steps.get(step) == (pdb_hash, key)
+
+    def record(self, prot_code, step, pdb_hash, key):
+        """
+        Records that the step's artifacts were produced for the protein.
+        """
+        entry = self.entries.setdefault(prot_code, dict())
+        entry.setdefault('steps', dict())[step] = (pdb_hash, key)
+
+    def invalidate(self, prot_code, step=None):
+        """
+        Forgets a single processing step (or all steps if step is None) of the protein.
+        """
+        steps = self.entries.get(prot_code, dict()).get('steps', dict())
+        if step is None:
+            steps.clear()
+        else:
+            steps.pop(step, None)
+
+    def collect_garbage(self, target_dir, keep_codes):
+        """
+        Removes the artifacts of all recorded proteins that are not in keep_codes, i.e. that
+        are no longer part of the data set or could not be processed. Only directories of
+        proteins recorded in the manifest are ever removed, and the removed codes are logged
+        before anything is deleted.
+
+        :param target_dir: the directory of the pre-processed data, containing a subdirectory
+            for each protein
+        :param keep_codes: set of protein codes whose artifacts are still needed
+        :return: the list of the removed protein codes
+        """
+        keep_codes = set(keep_codes)
+        orphans = sorted(pc for pc in self.entries if pc not in keep_codes)
+        if len(orphans) > 0:
+            log.info("Removing the orphaned artifacts of {} proteins: {}".format(
+                len(orphans), ", ".join(orphans)))
+        for pc in orphans:
+            prot_dir = os.path.join(target_dir, pc.upper())
+            if os.path.isdir(prot_dir):
+                shutil.rmtree(prot_dir)
+            del self.entries[pc]
+        return orphans
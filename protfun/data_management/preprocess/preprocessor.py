@@ -4,9 +4,11 @@ import numpy as np
 import csv
 import StringIO
 import theano
+import theano.tensor as T
 import lasagne
 import cPickle
 import itertools
+import shutil
 
 import prody as pd
 import rdkit.Chem as Chem
@@ -15,6 +17,10 @@ import rdkit.Chem.rdMolTransforms as rdMT
 import rdkit.Chem.rdmolops as rdMO
 
 from protfun.layers import MoleculeMapLayer
+from protfun.data_management.preprocess.manifest import ArtifactManifest, params_key
+from protfun.utils.np_utils import bounding_box, block_average
+from protfun.utils.data_utils import pyramid_grid_filename, sparse_voxels_filename
+from protfun.utils.sparse_voxels import occupied_voxels
 from protfun.utils.log import get_logger
 
 log = get_logger("preprocessor")
@@ -42,10 +48,15 @@ class EnzymeDataProcessor(DataProcessor):
 
     Does pre-processing of the downloaded PDB files.
     numpy.memmap's are created for molecules (from the PDB files with no errors)
+
+    The processing is incremental: an ArtifactManifest in the target directory records from
+    which PDB file contents and with which parameters the artifacts of each protein were
+    produced, and only proteins with missing or stale artifacts are processed again.
     """
 
     def __init__(self, from_dir, target_dir, protein_codes, grid_size, force_process_grids=False,
-                 force_process_memmaps=False, add_sidechain_channels=True, use_esp=False):
+                 force_process_memmaps=False, add_sidechain_channels=True, use_esp=False,
+                 grid_pyramid=None, sparse_threshold=None, collect_garbage=False):
         """
         :param from_dir: base data directory
         :param target_dir: target directory for the pre-processed data
@@ -57,20 +68,49 @@ class EnzymeDataProcessor(DataProcessor):
         :param add_sidechain_channels: whether additional channels should be added to the default
             ones (density)
         :param use_esp: whether electrostatic potential should be used
+        :param grid_pyramid: (optional) list of smaller grid sides (each dividing grid_size), for
+            which downsampled versions of the grids are stored as well, e.g. [64, 32] for a
+            grid_size of 128
+        :param sparse_threshold: (optional) if given, the occupied voxels of the grids (and of
+            each pyramid level), i.e. voxels with a density above the threshold, are stored as
+            well, as inputs for the sparse networks
+        :param collect_garbage: if True, the processed directories of the proteins that are
+            recorded in the manifest, but are not in protein_codes any more, are removed at the
+            end of process(). Proteins whose PDB file is missing (e.g. a failed download) are
+            always kept.
         """
         super(EnzymeDataProcessor, self).__init__(from_dir=from_dir,
                                                   target_dir=target_dir)
         self.prot_codes = protein_codes
+        self.grid_size = grid_size
+        self.grid_pyramid = grid_pyramid or list()
+        self.sparse_threshold = sparse_threshold
+        self.collect_garbage = collect_garbage
         self.force_process_grids = force_process_grids
         self.force_process_memmaps = force_process_memmaps
         self.use_esp = use_esp
         self.add_sidechain_channels = add_sidechain_channels
         if add_sidechain_channels:
             self.molecule_processor = PDBSideChainProcessor()
-            self.grid_processor = GridSideChainProcessor(grid_size=grid_size)
         else:
             self.molecule_processor = PDBMoleculeProcessor()
-            self.grid_processor = GridProcessor(grid_size=grid_size)
+        # the grid processor compiles a theano function, so it is created only if needed
+        self._grid_processor = None
+
+        # keys of the parameters, which the memmaps and the grids depend on
+        self.memmaps_key = params_key(add_sidechain_channels=add_sidechain_channels,
+                                      use_esp=use_esp)
+        self.grid_key = params_key(add_sidechain_channels=add_sidechain_channels,
+                                   use_esp=use_esp, grid_size=grid_size)
+
+    @property
+    def grid_processor(self):
+        if self._grid_processor is None:
+            if self.add_sidechain_channels:
+                self._grid_processor = GridSideChainProcessor(grid_size=self.grid_size)
+            else:
+                self._grid_processor = GridProcessor(grid_size=self.grid_size)
+        return self._grid_processor
 
     def process(self):
         """
@@ -93,37 +133,55 @@ class EnzymeDataProcessor(DataProcessor):
             itertools.chain.from_iterable(self.prot_codes.values()))
         prot_codes = list(set(prot_codes))
         prot_codes = sorted(prot_codes)
+        manifest = ArtifactManifest.load(os.path.join(self.target_dir, 'manifest.pickle'))
+        n_processed = 0
         for i, pc in enumerate(prot_codes):
-            # skip if we know this protein cannot be processed
-            if pc in invalid_codes:
-                continue
             prot_dir = os.path.join(self.target_dir, pc.upper())
             f_path = os.path.join(self.from_dir, pc.upper(),
                                   'pdb' + pc.lower() + '.ent')
+            pdb_hash = manifest.pdb_hash(pc, f_path)
+
+            # skip if we know this protein cannot be processed, unless its PDB file or the
+            # processing changed since
+            if pc in invalid_codes:
+                if not self._is_stale(manifest, pc, 'invalid', pdb_hash, self.memmaps_key,
+                                      exists=True):
+                    continue
+                invalid_codes.discard(pc)
 
             # if required, process the memmaps for the protein again
             memmap_exists = self.memmaps_exists(prot_dir,
                                                 num_channels=CNS if self.add_sidechain_channels else 1)
-            if not memmap_exists or self.force_process_memmaps:
+            memmaps_stale = self.force_process_memmaps or self._is_stale(
+                manifest, pc, 'memmaps', pdb_hash, self.memmaps_key, exists=memmap_exists,
+                adoptable=memmap_exists and self.memmaps_consistent(prot_dir))
+            if memmaps_stale:
                 # attempt to process the molecule from the PDB file
                 mol = self.molecule_processor.process_molecule(f_path)
                 if mol is None:
                     log.warning(
                         "Ignoring PDB file {} for invalid molecule".format(pc))
+                    self._discard(manifest, pc, prot_dir, pdb_hash)
                     invalid_codes.add(pc)
                     continue
                 # persist the molecule and add the resulting memmaps to mol_info
                 # if processing was successful
                 self._persist_processed(prot_dir=prot_dir, mol=mol)
+                manifest.record(pc, 'memmaps', pdb_hash, self.memmaps_key)
             else:
                 log.info("Skipping already processed PDB file: {}".format(pc))
 
             # if required, process the ESP and density grids as well
-            if not self.grid_exists(prot_dir) or self.force_process_grids:
+            grid_exists = self.grid_exists(prot_dir)
+            grid_stale = self.force_process_grids or memmaps_stale or self._is_stale(
+                manifest, pc, 'grid', pdb_hash, self.grid_key, exists=grid_exists,
+                adoptable=grid_exists and self.grid_matches(prot_dir))
+            if grid_stale:
                 grid = self.grid_processor.process(prot_dir)
                 if grid is None:
                     log.warning(
                         "Ignoring PDB file {}, grid could not be processed".format(pc))
+                    self._discard(manifest, pc, prot_dir, pdb_hash)
                     invalid_codes.add(pc)
                     continue
                 if not os.path.exists(prot_dir):
@@ -132,25 +190,124 @@ class EnzymeDataProcessor(DataProcessor):
                 self.save_to_memmap(
                     file_path=os.path.join(prot_dir, "grid.memmap"), data=grid,
                     dtype=floatX)
+                self._persist_bounding_box(prot_dir, grid)
+                manifest.record(pc, 'grid', pdb_hash, self.grid_key)
+                n_processed += 1
+            elif not self.bounding_box_exists(prot_dir):
+                # grids processed before the bounding boxes were introduced
+                self._persist_bounding_box(prot_dir, self.load_grid(prot_dir, self.grid_size))
+            manifest.invalidate(pc, 'invalid')
+
+            # derive the lower resolution levels from the full resolution grid
+            process_grid_pyramid(prot_dir, self.grid_size, self.grid_pyramid,
+                                 force=grid_stale)
+            if self.sparse_threshold is not None:
+                process_sparse_voxels(prot_dir, self.grid_size,
+                                      [self.grid_size] + self.grid_pyramid,
+                                      threshold=self.sparse_threshold, force=grid_stale)
 
             # copy the PDB file to the target directory
-            if not os.path.exists(
+            if memmaps_stale or not os.path.exists(
                     os.path.join(prot_dir, 'pdb' + pc.lower() + '.ent')):
                 os.system("cp %s %s" % (
                     f_path,
                     os.path.join(prot_dir, 'pdb' + pc.lower() + '.ent')))
 
+            # persist the progress from time to time, in case the processing is interrupted
+            if (i + 1) % 500 == 0:
+                manifest.save()
+
+        if self.collect_garbage:
+            # remove the artifacts of proteins that are no longer in the data set, but never
+            # those of proteins that are only missing their PDB file, e.g. after a failed download
+            keep_codes = set(prot_codes)
+            for pc in manifest.entries:
+                if not os.path.exists(os.path.join(self.from_dir, pc.upper(),
+                                                   'pdb' + pc.lower() + '.ent')):
+                    keep_codes.add(pc)
+            manifest.collect_garbage(self.target_dir, keep_codes=keep_codes)
+        manifest.save()
+
         # persist the invalid codes for next time
         with open(invalid_codes_path, 'wb') as f:
             cPickle.dump(invalid_codes, f)
 
         log.info(
-            "Total proteins: {} Invalid proteins: {}".format(len(prot_codes), len(invalid_codes)))
+            "Total proteins: {} Invalid proteins: {} (Re-)processed proteins: {}".format(
+                len(prot_codes), len(invalid_codes), n_processed))
         for cls, prots in self.prot_codes.items():
             valid_codes[cls] = [pc for pc in prots if pc not in invalid_codes]
 
         return valid_codes
 
+    def process_pdb_file(self, pdb_file, prot_dir, grid_lock=None):
+        """
+        Processes a single PDB file into prot_dir: the memmaps of the molecule, its grid, bounding
+        box and grid pyramid levels. Unlike process(), nothing is recorded in the manifest of the
+        data set, so it can be used for proteins outside of the data set, e.g. for inference.
+
+        :param pdb_file: path to the PDB file
+        :param prot_dir: the directory for the processed protein
+        :param grid_lock: (optional) a lock that is held while the grid is computed, as the
+            compiled grid function must not be called from multiple threads at once
+        :return: the grid, or None if the molecule or its grid could not be processed
+        """
+        mol = self.molecule_processor.process_molecule(pdb_file)
+        if mol is None:
+            log.warning("Ignoring PDB file {} for invalid molecule".format(pdb_file))
+            return None
+        self._persist_processed(prot_dir=prot_dir, mol=mol)
+        if grid_lock is None:
+            grid = self.grid_processor.process(prot_dir)
+        else:
+            with grid_lock:
+                grid = self.grid_processor.process(prot_dir)
+        if grid is None:
+            log.warning("Ignoring PDB file {}, grid could not be processed".format(pdb_file))
+            return None
+        self.save_to_memmap(file_path=os.path.join(prot_dir, "grid.memmap"), data=grid,
+                            dtype=floatX)
+        self._persist_bounding_box(prot_dir, grid)
+        process_grid_pyramid(prot_dir, self.grid_size, self.grid_pyramid, force=True)
+        return grid
+
+    @staticmethod
+    def _is_stale(manifest, prot_code, step, pdb_hash, key, exists, adoptable=True):
+        """
+        Decides if the artifacts of a processing step must be recomputed for a protein.
+        Artifacts that exist, but were produced before the manifest was introduced, are adopted
+        only if they are consistent with the current parameters (adoptable), e.g. a grid of the
+        current size and number of channels.
+
+        :param manifest: the ArtifactManifest of the target directory
+        :param prot_code: the PDB code of the protein
+        :param step: the name of the processing step
+        :param pdb_hash: the current hash of the protein's PDB file
+        :param key: the parameters key of the step
+        :param exists: whether the artifacts of the step exist on disk
+        :param adoptable: whether existing artifacts that are not in the manifest match the
+            current parameters of the step
+        :return: True if the step must be run again
+        """
+        if not exists:
+            return True
+        if manifest.is_current(prot_code, step, pdb_hash, key):
+            return False
+        if not manifest.is_known(prot_code, step) and adoptable:
+            manifest.record(prot_code, step, pdb_hash, key)
+            return False
+        return True
+
+    def _discard(self, manifest, prot_code, prot_dir, pdb_hash):
+        """
+        Removes the (partial) artifacts of a protein that could not be processed and remembers
+        from which PDB file contents it failed.
+        """
+        manifest.invalidate(prot_code)
+        manifest.record(prot_code, 'invalid', pdb_hash, self.memmaps_key)
+        if os.path.isdir(prot_dir):
+            shutil.rmtree(prot_dir)
+
     def _persist_processed(self, prot_dir, mol):
         """
         Saves the processed molecule on disk.
@@ -166,6 +323,27 @@ class EnzymeDataProcessor(DataProcessor):
                 os.path.join(prot_dir, '{0}.memmap'.format(key)),
                 value, dtype=floatX)
 
+    def _persist_bounding_box(self, prot_dir, grid):
+        """
+        Saves the tight bounding box (in voxels) of the occupied part of the protein's grid. It
+        is used by the grid feeders to crop the grids to a smaller side.
+        :param prot_dir: the directory of the processed protein
+        :param grid: the computed grid of the protein
+        """
+        self.save_to_memmap(file_path=os.path.join(prot_dir, "bbox.memmap"),
+                            data=bounding_box(grid), dtype=intX)
+
+    @staticmethod
+    def load_grid(prot_dir, grid_size):
+        """
+        Loads the (read-only) grid of a processed protein.
+        :param prot_dir: the directory of the processed protein
+        :param grid_size: number of points on the side of the grid
+        :return: memmap of shape (1, n_channels, grid_size, grid_size, grid_size)
+        """
+        return np.memmap(os.path.join(prot_dir, "grid.memmap"), mode='r',
+                         dtype=floatX).reshape((1, -1, grid_size, grid_size, grid_size))
+
     @staticmethod
     def save_to_memmap(file_path, data, dtype):
         """
@@ -206,10 +384,88 @@ class EnzymeDataProcessor(DataProcessor):
                    os.path.exists(os.path.join(prot_dir, 'charges.memmap')) and \
                    os.path.exists(os.path.join(prot_dir, 'vdwradii.memmap'))
 
+    @staticmethod
+    def memmaps_consistent(prot_dir):
+        """
+        Checks that the coordinates and the vdW radii memmaps of a protein describe the same
+        number of atoms.
+        :param prot_dir: the directory where the protein memmaps are stored
+        """
+        coords_size = os.path.getsize(os.path.join(prot_dir, 'coords.memmap'))
+        vdwradii_size = os.path.getsize(os.path.join(prot_dir, 'vdwradii.memmap'))
+        return coords_size > 0 and coords_size == 3 * vdwradii_size
+
     @staticmethod
     def grid_exists(prot_dir):
         return os.path.exists(os.path.join(prot_dir, "grid.memmap"))
 
+    def grid_matches(self, prot_dir):
+        """
+        Checks that an existing grid has the current grid size and number of channels, i.e.
+        that grid.memmap has the size n_channels * grid_size ** 3 * itemsize.
+        :param prot_dir: the directory where the protein grid is stored
+        """
+        n_channels = CNS if self.add_sidechain_channels else 1
+        expected_size = n_channels * self.grid_size ** 3 * np.dtype(floatX).itemsize
+        return os.path.getsize(os.path.join(prot_dir, "grid.memmap")) == expected_size
+
+    @staticmethod
+    def bounding_box_exists(prot_dir):
+        return os.path.exists(os.path.join(prot_dir, "bbox.memmap"))
+
+
+def process_grid_pyramid(prot_dir, grid_size, level_sides, force=False):
+    """
+    Computes the levels of the resolution pyramid of an already processed protein grid by
+    exact block-averaging of the full resolution grid, i.e. without rasterizing the molecule
+    again. Levels that already exist are skipped unless forced.
+
+    :param prot_dir: the directory of the processed protein
+    :param grid_size: number of points on the side of the full resolution grid
+    :param level_sides: list of sides of the pyramid levels, each must divide grid_size
+    :param force: recompute the levels even if they exist
+    """
+    grid = None
+    for side in level_sides:
+        if side == grid_size:
+            continue
+        if grid_size % side != 0:
+            log.error("Pyramid level {} does not divide the grid size {}".format(side, grid_size))
+            raise ValueError
+        level_file = os.path.join(prot_dir, pyramid_grid_filename(grid_size, side))
+        if os.path.exists(level_file) and not force:
+            continue
+        if grid is None:
+            grid = EnzymeDataProcessor.load_grid(prot_dir, grid_size)
+        EnzymeDataProcessor.save_to_memmap(file_path=level_file,
+                                           data=block_average(grid, grid_size // side),
+                                           dtype=floatX)
+
+
+def process_sparse_voxels(prot_dir, grid_size, level_sides, threshold, force=False):
+    """
+    Extracts the occupied voxels (coordinates and channel values of the voxels above the
+    threshold) of an already processed protein grid and of its pyramid levels, and stores them
+    as .npz files. Files that already exist for the same threshold are skipped unless forced.
+
+    :param prot_dir: the directory of the processed protein
+    :param grid_size: number of points on the side of the full resolution grid
+    :param level_sides: list of the grid sides (the full resolution and / or pyramid levels) for
+        which the occupied voxels are extracted, the pyramid levels must already exist
+    :param threshold: voxels with all channels <= threshold are considered empty
+    :param force: extract the voxels even if they exist
+    """
+    for side in level_sides:
+        voxels_file = os.path.join(prot_dir, sparse_voxels_filename(side))
+        if os.path.exists(voxels_file) and not force:
+            with np.load(voxels_file) as f:
+                if float(f['threshold']) == threshold:
+                    continue
+        grid = np.memmap(os.path.join(prot_dir, pyramid_grid_filename(grid_size, side)),
+                         mode='r', dtype=floatX).reshape((1, -1, side, side, side))
+        coords, values = occupied_voxels(grid, threshold)
+        np.savez(voxels_file, coords=coords, values=values, threshold=threshold, side=side)
+
 
 class GODataProcessor(DataProcessor):
     """
@@ -428,6 +684,23 @@ class GeneOntologyProcessor(object):
             return ["unknown"]
 
 
+def compile_grid_function(molmap_layer):
+    """
+    Compiles the computation of the grids of a MoleculeMapLayer once, for mini-batches of
+    molecules of any size. Evaluating the layer on shared variables instead would build and
+    compile a new theano graph for every processed protein.
+
+    :param molmap_layer: the MoleculeMapLayer
+    :return: the compiled theano function mapping coords (n_mols x atoms x 3), vdwradii
+        (n_mols x atoms) and n_atoms (n_mols,) to the grids (n_mols x 1 x side x side x side)
+    """
+    coords = T.tensor3('coords')
+    vdwradii = T.matrix('vdwradii')
+    n_atoms = T.ivector('n_atoms')
+    return theano.function([coords, vdwradii, n_atoms],
+                           molmap_layer.get_output_for(mols_info=[coords, vdwradii, n_atoms]))
+
+
 class GridProcessor(object):
     """
     Processor for the 3D maps of electron density and potential.
@@ -453,6 +726,14 @@ class GridProcessor(object):
                        dummy_natoms_input],
             grid_side=grid_side, resolution=resolution,
             minibatch_size=1, rotate=False)
+        # the grid function is compiled on the first call of process()
+        self._grid_function = None
+
+    @property
+    def grid_function(self):
+        if self._grid_function is None:
+            self._grid_function = compile_grid_function(self.processor)
+        return self._grid_function
 
     def process(self, prot_dir):
         """
@@ -468,10 +749,7 @@ class GridProcessor(object):
             n_atoms = np.array(coords.shape[1], dtype=intX).reshape((1,))
         except IOError:
             return None
-        mol_info = [theano.shared(coords),
-                    theano.shared(vdwradii),
-                    theano.shared(n_atoms)]
-        grid = self.processor.get_output_for(mols_info=mol_info).eval()
+        grid = self.grid_function(np.asarray(coords), np.asarray(vdwradii), n_atoms)
         return grid
 
 
@@ -498,6 +776,14 @@ class GridSideChainProcessor(object):
                                                      dummy_natoms_input],
                                           grid_side=grid_side, resolution=resolution,
                                           rotate=False, minibatch_size=1)
+        # the grid function is compiled on the first call of process()
+        self._grid_function = None
+
+    @property
+    def grid_function(self):
+        if self._grid_function is None:
+            self._grid_function = compile_grid_function(self.processor)
+        return self._grid_function
 
     def process(self, prot_dir):
         """
@@ -547,9 +833,8 @@ class GridSideChainProcessor(object):
                 n_atoms.append(masked_natoms)
         except IOError:
             return None
-        result = []
-        for c, v, na in zip(coords, vdwradii, n_atoms):
-            mol_info = [theano.shared(x) for x in
-                        [c, v, na]]
-            result.append(self.processor.get_output_for(mol_info).eval())
-        return np.transpose(np.concatenate(result), (1, 0, 2, 3, 4))
+        # all channels have the same (padded) number of atoms, so they are computed as a
+        # single mini-batch
+        result = self.grid_function(np.concatenate(coords), np.concatenate(vdwradii),
+                                    np.concatenate(n_atoms))
+        return np.transpose(result, (1, 0, 2, 3, 4))
@@ -8,42 +8,112 @@ class EnzymeFetcher(object):
     """
     EnzymeFetcher queries PDB ids for the enzymes EC2PDB data set, extracting them
     from the EC2PDB website based on desired EC categories.
+
+    The EC tree is crawled level by level, the pages of each level are fetched concurrently
+    (rate limited) through a CachedHTTPClient, so that a repeated crawl only revalidates the
+    pages. The page URLs are built from a template, which allows to crawl a local stand-in
+    server with saved pages, e.g. page_url="http://localhost:8000/{}.html".
     """
 
-    def __init__(self, categories, excluded_categories=list(), enzyme_dir=None):
+    DEFAULT_PAGE_URL = "https://www.ebi.ac.uk/thornton-srv/databases/cgi-bin/enzymes/" \
+                       "GetPage.pl?ec_number={}"
+
+    def __init__(self, categories, excluded_categories=list(), enzyme_dir=None,
+                 page_url=DEFAULT_PAGE_URL, cache_dir=None, n_workers=8,
+                 max_requests_per_second=5):
         """
         :param categories: which enzyme categories to download
         :param excluded_categories: which enzyme categories to exclude
         :param enzyme_dir: where to download the enzymes
+        :param page_url: URL template of the EC2PDB pages, formatted with the EC number
+        :param cache_dir: (optional) directory of the HTTP response cache, by default
+            <enzyme_dir>/http_cache (or a temporary cache, removed after fetch_enzymes(), if
+            enzyme_dir is not given either)
+        :param n_workers: number of concurrent requests
+        :param max_requests_per_second: rate limit for the requests
         """
+        from protfun.data_management.preprocess.http_cache import CachedHTTPClient
+
         self.enzyme_dir = enzyme_dir
         self.excluded_categories = excluded_categories
         self.leaf_categories = list()
+        self.page_url = page_url
+        self.n_workers = n_workers
+        if cache_dir is None and enzyme_dir is not None:
+            cache_dir = os.path.join(enzyme_dir, "http_cache")
+        self.client = CachedHTTPClient(cache_dir=cache_dir,
+                                       max_requests_per_second=max_requests_per_second)
 
         log.info("Evaluating the total categorical hierarchy...")
-        for cat in set(categories) - set(excluded_categories):
-            self._find_leaf_categories(cat)
+        self._find_leaf_categories(set(categories) - set(excluded_categories))
 
         self.fetched_prot_codes = dict()
 
-    def _find_leaf_categories(self, cat):
+    def _fetch_pages(self, categories):
+        """
+        Fetches the pages of the categories concurrently.
+        :return: list of the page contents, in the order of categories
+        """
+        from multiprocessing.pool import ThreadPool
+
+        urls = [self.page_url.format(cat) for cat in categories]
+        if len(urls) <= 1:
+            return [self.client.get_text(url) for url in urls]
+        pool = ThreadPool(processes=min(self.n_workers, len(urls)))
+        try:
+            return pool.map(self.client.get_text, urls, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _find_leaf_categories(self, categories):
         """
         Internal method, finds all categories in the leafs of the EC tree that are
-        children of the specified category.
+        children of the specified categories, going down the tree one level at a time.
 
         The below code parses the HTML of the website for EC2PDB.
         """
-        import requests
-        from bs4 import BeautifulSoup
+        level = sorted(set(categories))
+        while len(level) > 0:
+            inner = list()
+            for cat in level:
+                if cat.count('.') + 1 == 4:
+                    log.debug("adding: %s" % cat)
+                    self.leaf_categories.append(cat)
+                else:
+                    inner.append(cat)
+            next_level = list()
+            for cat, page in zip(inner, self._fetch_pages(inner)):
+                next_level += self._extract_children_from_html(page, cat)
+            level = sorted(set(next_level))
+
+    @staticmethod
+    def _extract_children_from_html(html_page, cat):
+        """
+        Extracts the direct children of the category from its EC2PDB page. The children are
+        taken from the menu links (e.g. "EC 3.4.21.-") with a regular expression, the slower
+        parsing of the HTML tree is only used if no children are found that way.
+        """
+        import re
 
         hierarchy_level = cat.count('.') + 1
-        if hierarchy_level == 4:
-            print("adding: %s" % cat)
-            self.leaf_categories.append(cat)
-            return
+        children = list()
+        for link_text in re.findall(r'<a\s[^>]*class=["\']?menuClass["\']?[^>]*>(.*?)</a>',
+                                    html_page, flags=re.IGNORECASE | re.DOTALL):
+            # remove trailing .- and the "EC " in front
+            child_cat = link_text.strip().rstrip('.-')[3:]
+            if child_cat.startswith(cat + '.') and child_cat.count('.') + 1 == hierarchy_level + 1:
+                children.append(child_cat)
+        if len(children) > 0:
+            return children
+        return EnzymeFetcher._extract_children_from_tree(html_page, cat)
+
+    @staticmethod
+    def _extract_children_from_tree(html_page, cat):
+        from bs4 import BeautifulSoup
 
-        url = "https://www.ebi.ac.uk/thornton-srv/databases/cgi-bin/enzymes/GetPage.pl?ec_number=" + cat
-        page = BeautifulSoup(requests.get(url).text, "html.parser")
+        hierarchy_level = cat.count('.') + 1
+        page = BeautifulSoup(html_page, "html.parser")
 
         # children table is located after 2 header tables + 2*hierarchy
         # tables for parent categories
@@ -59,7 +129,8 @@ class EnzymeFetcher(object):
             log.debug(
                 "No subcategory table found for parent category {0}".format(
                     cat))
-            return
+            return []
+        child_cats = list()
         for child in children:
             try:
                 child_cat = child.find('a', {'class': 'menuClass'},
@@ -68,8 +139,8 @@ class EnzymeFetcher(object):
                 log.debug("no link to child category")
                 continue
             # remove trailing .- and the "EC " in front
-            child_cat = child_cat.rstrip('.-')[3:]
-            self._find_leaf_categories(child_cat)
+            child_cats.append(child_cat.rstrip('.-')[3:])
+        return child_cats
 
     def fetch_enzymes(self):
         """
@@ -83,20 +154,65 @@ class EnzymeFetcher(object):
             log.info(
                 "Processing html pages for each enzyme classes ({0} in total). "
                 "This may take a while...".format(len(self.leaf_categories)))
-            self.fetched_prot_codes = self._ecs2pdbs()
+            try:
+                self.fetched_prot_codes = self._ecs2pdbs()
+            finally:
+                # a temporary cache is not reused by later runs
+                self.client.close()
+            log.info("HTTP cache: {}".format(self.client.stats))
         return self.fetched_prot_codes
 
     def _ecs2pdbs(self):
-        import requests
         pdbs = dict()
-        for category in self.leaf_categories:
-            url = "https://www.ebi.ac.uk/thornton-srv/databases/cgi-bin/enzymes/GetPage.pl?ec_number=" + category
-            response = requests.get(url)
-            prots = self._extract_pdbs_from_html(response.text, category)
+        for category, page in zip(self.leaf_categories, self._fetch_pages(self.leaf_categories)):
+            prots = self._extract_pdbs_fast(page, category)
+            if prots is None:
+                prots = self._extract_pdbs_from_html(page, category)
             if prots is not None:
                 pdbs[category] = prots
         return pdbs
 
+    @staticmethod
+    def _extract_pdbs_fast(html_page, cat):
+        """
+        Extracts the PDB codes from the PDB table of a leaf category page with regular
+        expressions: the table following the third paragraph, the link in the first cell of
+        each row after the three header rows.
+
+        :return: the list of PDB codes, or None if the page does not look as expected (then
+            _extract_pdbs_from_html should be used)
+        """
+        import re
+
+        paragraphs = [m.start() for m in re.finditer(r'<p[\s>]', html_page, flags=re.IGNORECASE)]
+        if len(paragraphs) < 3:
+            return None
+        table_start = re.compile(r'<table[\s>]', flags=re.IGNORECASE).search(html_page,
+                                                                            paragraphs[2])
+        if table_start is None:
+            return None
+        table_end = html_page.lower().find('</table>', table_start.end())
+        table = html_page[table_start.start():table_end if table_end >= 0 else None]
+        if '<table' in table[1:].lower():
+            # nested tables are not handled by the fast path
+            return None
+
+        rows = re.split(r'<tr[\s>]', table, flags=re.IGNORECASE)[1:]
+        pdbs = []
+        for row in rows[3:]:
+            first_cell = re.search(r'<td[^>]*>(.*?)(?:</td>|<td[\s>]|$)', row,
+                                   flags=re.IGNORECASE | re.DOTALL)
+            if first_cell is None:
+                continue
+            link = re.search(r'<a\s[^>]*href[^>]*>\s*([^<]*?)\s*</a>', first_cell.group(1),
+                             flags=re.IGNORECASE)
+            if link is not None and len(link.group(1)) == 4:
+                pdbs.append(str(link.group(1)).upper())
+        if len(pdbs) == 0:
+            log.debug("No PDB codes found with the fast path for {}".format(cat))
+            return None
+        return pdbs
+
     @staticmethod
     def _extract_pdbs_from_html(html_page, cat):
         from bs4 import BeautifulSoup
@@ -133,13 +249,301 @@ class EnzymeFetcher(object):
         return pdbs
 
 
-def download_pdbs(base_dir, protein_codes):
+class EnzymeMappingFetcher(object):
+    """
+    EnzymeMappingFetcher is an alternative to EnzymeFetcher, which does not scrape the EC2PDB
+    website, but reads the EC to PDB mapping from a local bulk dump, e.g. the SIFTS
+    pdb_chain_enzyme.csv(.gz) file. The file is streamed and parsed in a single pass.
+
+    The file must be a CSV (optionally gzipped) with a header row, which contains a column with the
+    PDB codes and a column with the EC numbers. Comment lines starting with '#' before the header
+    are skipped. Rows with incomplete EC numbers (e.g. 3.4.21.- or ?) are ignored.
+
+    Usage::
+        >>> ef = EnzymeMappingFetcher(categories=['3.4.21', '3.4.24'],
+        >>>                           mapping_file="data/misc/pdb_chain_enzyme.csv.gz")
+        >>> prot_codes = ef.fetch_enzymes()
+    """
+
+    def __init__(self, categories, mapping_file, excluded_categories=list(), pdb_column='PDB',
+                 ec_column='EC_NUMBER'):
+        """
+        :param categories: which enzyme categories to include
+        :param mapping_file: path to the CSV file with the EC to PDB mapping
+        :param excluded_categories: which enzyme categories to exclude
+        :param pdb_column: name of the column with the PDB codes
+        :param ec_column: name of the column with the EC numbers
+        """
+        self.categories = set(categories) - set(excluded_categories)
+        self.excluded_categories = set(excluded_categories)
+        self.mapping_file = mapping_file
+        self.pdb_column = pdb_column
+        self.ec_column = ec_column
+        self.fetched_prot_codes = dict()
+
+    def fetch_enzymes(self):
+        """
+        Reads the protein codes for all enzymes in the selected categories from the mapping file.
+        :return: a dictionary with keys EC categories (e.g. '3.4.21.4') and values list of protein
+        codes for that category (e.g. ['1A0H', '1A0Z']), as in EnzymeFetcher.fetch_enzymes()
+        """
+        import csv
+        import gzip
+
+        opener = gzip.open if self.mapping_file.endswith('.gz') else open
+        pdbs = dict()
+        seen = set()
+        with opener(self.mapping_file, 'rb') as f:
+            lines = (line for line in f if not line.startswith('#'))
+            reader = csv.reader(lines)
+            header = [column.strip() for column in next(reader)]
+            try:
+                pdb_index = header.index(self.pdb_column)
+                ec_index = header.index(self.ec_column)
+            except ValueError:
+                log.error("The mapping file must have the columns {} and {}".format(
+                    self.pdb_column, self.ec_column))
+                raise
+            for row in reader:
+                if len(row) <= max(pdb_index, ec_index):
+                    continue
+                ec = row[ec_index].strip()
+                path = ec.split('.')
+                if len(path) != 4 or not all(level.isdigit() for level in path):
+                    continue
+                prefixes = ['.'.join(path[:depth]) for depth in range(1, 5)]
+                if not any(p in self.categories for p in prefixes) or \
+                        any(p in self.excluded_categories for p in prefixes):
+                    continue
+                code = row[pdb_index].strip().upper()
+                # one row per chain, keep every protein only once per class
+                if len(code) == 4 and (ec, code) not in seen:
+                    seen.add((ec, code))
+                    pdbs.setdefault(ec, []).append(code)
+
+        log.info("Read {} proteins in {} enzyme classes from {}".format(
+            len(seen), len(pdbs), self.mapping_file))
+        self.fetched_prot_codes = pdbs
+        return self.fetched_prot_codes
+
+
+class PDBDownloader(object):
+    """
+    PDBDownloader fetches PDB files concurrently, with a pool of worker threads. Every protein is
+    stored in it's own directory (with name the PDB code) under base_dir, as pdb<code>.ent.
+
+    The files are sourced either from a PDB server over HTTP(S), or from a local snapshot of the
+    PDB, which can be a mirror directory (e.g. "/mnt/pdb" or "file:///mnt/pdb") or a tarball.
+    A mirror directory may be flat (pdb<code>.ent[.gz]) or have the "divided" layout of the PDB
+    archive (<2nd and 3rd letter of the code>/pdb<code>.ent[.gz]). A tarball is searched for
+    members with those names, in any directory.
+
+    Failed downloads are retried with exponential backoff, and an interrupted HTTP download is
+    resumed from its .part file on the next attempt (or the next run).
+
+    Usage::
+        >>> downloader = PDBDownloader(base_dir="data/raw", n_workers=16,
+        >>>                            mirror="file:///mnt/pdb_snapshot")
+        >>> downloaded, failed = downloader.download(['1A0A', '1A0B'])
+    """
+
+    DEFAULT_SERVER = "https://files.wwpdb.org/pub/pdb/data/structures/divided/pdb"
+
+    def __init__(self, base_dir, n_workers=8, mirror=None, server=DEFAULT_SERVER, retries=3,
+                 backoff=1.0, timeout=60):
+        """
+        :param base_dir: where to download all the proteins.
+        :param n_workers: number of concurrent downloads
+        :param mirror: (optional) path or file:// URL of a local PDB mirror directory or tarball,
+            if given the server is not used
+        :param server: base URL of the PDB archive in the "divided" layout
+        :param retries: how many times a failed download is retried
+        :param backoff: seconds to wait before the first retry, doubled for every further retry
+        :param timeout: timeout in seconds of the HTTP requests
+        """
+        self.base_dir = base_dir
+        self.n_workers = n_workers
+        self.server = server.rstrip('/')
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.mirror = None
+        self.tarball = None
+        self.tar_members = None
+        if mirror is not None:
+            if mirror.startswith('file://'):
+                mirror = mirror[len('file://'):]
+            if os.path.isdir(mirror):
+                self.mirror = mirror
+            elif os.path.isfile(mirror):
+                self._index_tarball(mirror)
+            else:
+                log.error("PDB mirror {} does not exist".format(mirror))
+                raise ValueError
+
+    def download(self, protein_codes):
+        """
+        Downloads the PDB files of the proteins which are not yet present under base_dir.
+
+        :param protein_codes: the PDB codes of the proteins that should be downloaded.
+        :return: a tuple of the lists of successfully downloaded (or already present) and of
+            the failed protein codes
+        """
+        from multiprocessing.pool import ThreadPool
+
+        prot_codes = sorted(set(code.upper() for code in protein_codes))
+        pool = ThreadPool(processes=self.n_workers)
+        try:
+            results = pool.map(self._fetch_with_retries, prot_codes, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        downloaded = [code for code, ok in zip(prot_codes, results) if ok]
+        failed = [code for code, ok in zip(prot_codes, results) if not ok]
+        log.info("Downloaded {0}/{1} molecules".format(len(downloaded), len(prot_codes)))
+        return downloaded, failed
+
+    def target_path(self, code):
+        return os.path.join(self.base_dir, code.upper(), 'pdb' + code.lower() + '.ent')
+
+    def _fetch_with_retries(self, code):
+        import time
+
+        target = self.target_path(code)
+        if os.path.exists(target):
+            return True
+        if not os.path.exists(os.path.dirname(target)):
+            try:
+                os.makedirs(os.path.dirname(target))
+            except OSError:
+                pass
+        for attempt in range(self.retries + 1):
+            try:
+                if self.tarball is not None:
+                    self._fetch_from_tarball(code, target)
+                elif self.mirror is not None:
+                    self._fetch_from_mirror(code, target)
+                else:
+                    self._fetch_from_server(code, target)
+                return True
+            except KeyError:
+                # not present in the local snapshot, retrying will not help
+                log.warning("Protein {} is not in the PDB mirror".format(code))
+                return False
+            except (IOError, OSError) as e:
+                if attempt < self.retries:
+                    wait = self.backoff * 2 ** attempt
+                    log.debug("Download of {} failed ({}), retrying in {}s".format(code, e, wait))
+                    time.sleep(wait)
+        log.warning("Failed to download protein {}".format(code))
+        return False
+
+    def _fetch_from_server(self, code, target):
+        import requests
+
+        url = "{}/{}/pdb{}.ent.gz".format(self.server, code.lower()[1:3], code.lower())
+        part = target + '.gz.part'
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset > 0 else {}
+        try:
+            response = requests.get(url, headers=headers, stream=True, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise IOError(str(e))
+        if response.status_code == 404:
+            raise KeyError(code)
+        if response.status_code == 416:
+            # the partial file is already complete
+            pass
+        elif response.status_code in (200, 206):
+            # the server may ignore the range request and send the whole file again
+            mode = 'ab' if response.status_code == 206 else 'wb'
+            with open(part, mode) as f:
+                for chunk in response.iter_content(chunk_size=1 << 16):
+                    f.write(chunk)
+        else:
+            raise IOError("HTTP status {} for {}".format(response.status_code, url))
+        try:
+            self._decompress(part, target)
+        except IOError:
+            # a corrupted partial download, start again from scratch
+            os.remove(part)
+            raise
+        os.remove(part)
+
+    def _fetch_from_mirror(self, code, target):
+        import shutil
+
+        code = code.lower()
+        for candidate in [os.path.join(self.mirror, code[1:3], 'pdb' + code + '.ent.gz'),
+                          os.path.join(self.mirror, code[1:3], 'pdb' + code + '.ent'),
+                          os.path.join(self.mirror, 'pdb' + code + '.ent.gz'),
+                          os.path.join(self.mirror, 'pdb' + code + '.ent')]:
+            if os.path.exists(candidate):
+                if candidate.endswith('.gz'):
+                    self._decompress(candidate, target)
+                else:
+                    shutil.copyfile(candidate, target + '.part')
+                    os.rename(target + '.part', target)
+                return
+        raise KeyError(code)
+
+    def _index_tarball(self, tar_path):
+        import tarfile
+        import threading
+
+        self.tarball = tarfile.open(tar_path, mode='r:*')
+        self.tar_lock = threading.Lock()
+        self.tar_members = dict()
+        for member in self.tarball.getmembers():
+            if member.isfile():
+                self.tar_members[os.path.basename(member.name)] = member
+        log.info("Indexed {} files in the PDB tarball {}".format(len(self.tar_members), tar_path))
+
+    def _fetch_from_tarball(self, code, target):
+        import gzip
+        import shutil
+        import StringIO
+
+        code = code.lower()
+        for name, compressed in [('pdb' + code + '.ent.gz', True), ('pdb' + code + '.ent', False)]:
+            if name in self.tar_members:
+                # tar files can not be read concurrently
+                with self.tar_lock:
+                    data = self.tarball.extractfile(self.tar_members[name]).read()
+                src = StringIO.StringIO(data)
+                if compressed:
+                    src = gzip.GzipFile(fileobj=src)
+                with open(target + '.part', 'wb') as f:
+                    shutil.copyfileobj(src, f)
+                os.rename(target + '.part', target)
+                return
+        raise KeyError(code)
+
+    @staticmethod
+    def _decompress(gz_path, target):
+        import gzip
+        import shutil
+
+        src = gzip.open(gz_path, 'rb')
+        try:
+            with open(target + '.part', 'wb') as f:
+                shutil.copyfileobj(src, f)
+        finally:
+            src.close()
+        os.rename(target + '.part', target)
+
+
+def download_pdbs(base_dir, protein_codes, n_workers=8, mirror=None):
     """
     Downloads the PDB database (or a part of it) as PDB files. Every protein is stored in it's own
-    directory (with name the PDB code) under base_dir.
+    directory (with name the PDB code) under base_dir. See PDBDownloader.
 
     :param base_dir: where to download all the proteins.
     :param protein_codes: the PDB codes of the proteins that should be downloaded.
+    :param n_workers: number of concurrent downloads
+    :param mirror: (optional) path or file:// URL of a local PDB mirror directory or tarball
+    :return: the list of protein codes that failed to download
     """
     prot_codes = []
     if isinstance(protein_codes, dict):
@@ -147,21 +551,9 @@ def download_pdbs(base_dir, protein_codes):
             prot_codes += protein_codes[key]
     else:
         prot_codes = protein_codes
-    prot_codes = list(set(prot_codes))
-    from Bio.PDB import PDBList
-    failed = 0
-    attempted = len(prot_codes)
-    for code in prot_codes:
-        try:
-            pl = PDBList(pdb=os.path.join(base_dir, code.upper()))
-            pl.flat_tree = 1
-            pl.retrieve_pdb_file(pdb_code=code)
-        except IOError:
-            log.warning("Failed to download protein {}".format(code))
-            failed += 1
-            continue
-    log.info(
-        "Downloaded {0}/{1} molecules".format(attempted - failed, attempted))
+    downloader = PDBDownloader(base_dir=base_dir, n_workers=n_workers, mirror=mirror)
+    _, failed = downloader.download(prot_codes)
+    return failed
 
 
 if __name__ == "__main__":
@@ -169,7 +561,7 @@ if __name__ == "__main__":
     ep.fetch_enzymes()
     pdbs21 = []
     pdbs24 = []
-    for key, value in ep.pdb_files.items():
+    for key, value in ep.fetched_prot_codes.items():
         if value is not None:
             if key.startswith('3.4.21'):
                 pdbs21 += value
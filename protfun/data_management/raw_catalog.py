@@ -0,0 +1,97 @@
+import cPickle
+import os
+
+from protfun.utils.log import get_logger
+
+log = get_logger("raw_catalog")
+
+
+class RawStoreCatalog(object):
+    """
+    RawStoreCatalog indexes the files in the raw data directory (the downloaded PDB files), so
+    that the existence of a file can be checked in O(1) without walking the directory tree.
+
+    The catalog is persisted between runs. On refresh, only the directories whose modification
+    time changed since the last refresh are listed again (adding or removing a file changes the
+    modification time of the directory that contains it), the others are taken from the catalog.
+
+    Usage::
+        >>> catalog = RawStoreCatalog(root_dir="data/raw",
+        >>>                           catalog_file="data/misc/raw_catalog.pickle")
+        >>> catalog.refresh()
+        >>> "pdb1a0a.ent" in catalog
+    """
+
+    def __init__(self, root_dir, catalog_file, extension='.ent'):
+        """
+        :param root_dir: the directory to be indexed (recursively)
+        :param catalog_file: the file in which the catalog is persisted
+        :param extension: only files with this extension are indexed
+        """
+        self.root_dir = root_dir
+        self.catalog_file = catalog_file
+        self.extension = extension
+        # maps directory path -> (mtime, list of indexed filenames, list of subdirectory paths)
+        self.dirs = dict()
+        self.files = set()
+        if os.path.exists(catalog_file):
+            try:
+                with open(catalog_file, 'rb') as f:
+                    extension, dirs = cPickle.load(f)
+                if extension == self.extension:
+                    self.dirs = dirs
+            except (EOFError, ValueError, cPickle.UnpicklingError):
+                log.warning("Ignoring the corrupted raw store catalog {}".format(catalog_file))
+
+    def refresh(self):
+        """
+        Brings the catalog up to date with the raw directory and persists it.
+
+        :return: the number of directories that had to be listed again
+        """
+        refreshed_dirs = dict()
+        stack = [self.root_dir]
+        n_listed = 0
+        while len(stack) > 0:
+            dir_path = stack.pop()
+            try:
+                mtime = os.stat(dir_path).st_mtime
+            except OSError:
+                continue
+            cached = self.dirs.get(dir_path)
+            if cached is not None and cached[0] == mtime:
+                entry = cached
+            else:
+                filenames, subdirs = [], []
+                for name in os.listdir(dir_path):
+                    path = os.path.join(dir_path, name)
+                    if os.path.isdir(path):
+                        subdirs.append(path)
+                    elif name.endswith(self.extension):
+                        filenames.append(name)
+                entry = (mtime, filenames, subdirs)
+                n_listed += 1
+            refreshed_dirs[dir_path] = entry
+            stack.extend(entry[2])
+
+        self.dirs = refreshed_dirs
+        self.files = set()
+        for _, filenames, _ in self.dirs.values():
+            self.files.update(filenames)
+        if n_listed > 0:
+            self._save()
+        log.info("Raw store catalog: {} files, {} directories re-listed".format(len(self.files),
+                                                                               n_listed))
+        return n_listed
+
+    def _save(self):
+        tmp_file = self.catalog_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            cPickle.dump((self.extension, self.dirs), f, protocol=cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_file, self.catalog_file)
+
+    def __contains__(self, filename):
+        return filename in self.files
+
+    def __len__(self):
+        return len(self.files)
@@ -1,9 +1,8 @@
 import os
-import ntpath
 import re
-from glob import glob
 import itertools
 
+from protfun.data_management.raw_catalog import RawStoreCatalog
 from protfun.utils.log import get_logger
 
 log = get_logger("validations")
@@ -37,9 +36,10 @@ class EnzymeValidator(object):
         """
         log.info("Checking downloaded proteins")
         num_errors = 0
-        raw_pdb_files = [ntpath.basename(y) for x in
-                         os.walk(self.dirs['data_raw']) for y in
-                         glob(os.path.join(x[0], '*.ent'))]
+        raw_pdb_files = RawStoreCatalog(
+            root_dir=self.dirs['data_raw'],
+            catalog_file=os.path.join(self.dirs['misc'], 'raw_catalog.pickle'))
+        raw_pdb_files.refresh()
         raw_enzyme_lists = [x.strip('.proteins')
                             for x in os.listdir(self.dirs['data_raw'])
                             if x.endswith('.proteins')]
@@ -91,17 +91,13 @@ class EnzymeValidator(object):
         :return:
         """
         bad_keys = []
-        duplicates = set()
-        checked_classes = set()
-        for cls, first_prots in data_dict.items():
-            duplicates |= set(first_prots)
-            checked_classes.add(cls)
-            if clean_duplicates:
-                for c, prots in data_dict.items():
-                    if c not in checked_classes:
-                        for p in prots[:]:
-                            if p in duplicates:
-                                prots.remove(p)
+        if clean_duplicates:
+            # a protein is kept only in the first class (in the order of the dictionary) that
+            # contains it, the lists are cleaned in place
+            seen = set()
+            for cls, prots in data_dict.items():
+                prots[:] = [p for p in prots if p not in seen]
+                seen.update(prots)
 
         for cls, prots in data_dict.items():
             if len(prots) == 0:
@@ -146,3 +142,41 @@ class EnzymeValidator(object):
             log.error("Protein codes in first part: {}".format(first_prot_codes))
             log.error("Protein codes in second part: {}".format(second_prot_codes))
             raise ValueError
+
+
+if __name__ == "__main__":
+    # benchmark the duplicates removal against the previous (quadratic) implementation
+    import copy
+    import time
+    import numpy as np
+
+
+    def check_class_representation_nested(data_dict):
+        duplicates = set()
+        checked_classes = set()
+        for cls, first_prots in data_dict.items():
+            duplicates |= set(first_prots)
+            checked_classes.add(cls)
+            for c, prots in data_dict.items():
+                if c not in checked_classes:
+                    for p in prots[:]:
+                        if p in duplicates:
+                            prots.remove(p)
+
+
+    # roughly the size of the EC database: ~5000 leaf classes, ~60000 proteins
+    rng = np.random.RandomState(42)
+    all_prots = ['{:04X}'.format(i) for i in range(60000)]
+    data = {'{}.{}.{}.{}'.format(*rng.randint(1, 30, size=4)): list(
+        rng.choice(all_prots, size=rng.randint(1, 30))) for _ in range(5000)}
+
+    nested_data = copy.deepcopy(data)
+    start = time.time()
+    check_class_representation_nested(nested_data)
+    log.info("Nested duplicates removal took {:.3f}s".format(time.time() - start))
+
+    start = time.time()
+    EnzymeValidator().check_class_representation(data, clean_dict=False)
+    log.info("Single pass duplicates removal took {:.3f}s".format(time.time() - start))
+
+    assert data == nested_data, "The cleaned dictionaries differ"
@@ -1,2 +1,6 @@
 from protfun.layers.molmap_layer import *
 from protfun.layers.grid_rotate_layer import *
+from protfun.layers.grid_symmetry_layer import *
+from protfun.layers.sparse_conv_layer import *
+from protfun.layers.graph_layer import *
+from protfun.layers.conv_layers import *
@@ -0,0 +1,85 @@
+import lasagne
+
+from protfun.utils.log import get_logger
+
+log = get_logger("conv_layers")
+
+try:
+    # importing lasagne.layers.dnn raises an ImportError when cuDNN is not available
+    import lasagne.layers.dnn
+
+    cudnn_available = True
+except ImportError:
+    cudnn_available = False
+
+_backend = 'cudnn' if cudnn_available else 'cpu'
+
+
+def get_conv_backend():
+    """
+    :return: the backend of the 3D convolutions and poolings built by conv3d() and
+        max_pool3d(): 'cudnn' if cuDNN is available, otherwise 'cpu'
+    """
+    return _backend
+
+
+def set_conv_backend(backend):
+    """
+    Overrides the automatically chosen backend of conv3d() and max_pool3d(), e.g. to build the
+    networks for the CPU on a GPU machine. Only affects the layers built afterwards.
+
+    :param backend: 'cudnn' or 'cpu'
+    """
+    global _backend
+    if backend not in ['cudnn', 'cpu']:
+        log.error("Unknown convolution backend: {}".format(backend))
+        raise ValueError
+    if backend == 'cudnn' and not cudnn_available:
+        log.error("The cudnn convolution backend was requested, but cuDNN is not available")
+        raise ValueError
+    _backend = backend
+
+
+def conv3d(incoming, num_filters, filter_size, **kwargs):
+    """
+    Builds a 3D convolution layer with the current backend: lasagne's Conv3DDNNLayer with cuDNN,
+    and otherwise lasagne's Conv3DLayer, which theano compiles to a BLAS based (im2col + GEMM)
+    correlation on the CPU. The filters are never flipped (the default of the cuDNN layer), so
+    the parameters of a network can be moved between the backends.
+
+    Usage::
+        >>> network = conv3d(incoming=network, pad='same', num_filters=32, filter_size=(3, 3, 3),
+        >>>                  nonlinearity=lasagne.nonlinearities.leaky_rectify)
+
+    :param incoming: the input layer
+    :param num_filters: number of filters
+    :param filter_size: size of the filters, an int or a 3-tuple
+    :param kwargs: the remaining parameters of lasagne's Conv3DLayer, e.g. pad, stride, W, b,
+        nonlinearity
+    :return: the convolution layer
+    """
+    kwargs.setdefault('flip_filters', False)
+    if _backend == 'cudnn':
+        return lasagne.layers.dnn.Conv3DDNNLayer(incoming=incoming, num_filters=num_filters,
+                                                 filter_size=filter_size, **kwargs)
+    return lasagne.layers.Conv3DLayer(incoming=incoming, num_filters=num_filters,
+                                      filter_size=filter_size, **kwargs)
+
+
+def max_pool3d(incoming, pool_size, **kwargs):
+    """
+    Builds a 3D max-pooling layer with the current backend: lasagne's MaxPool3DDNNLayer with
+    cuDNN, and otherwise lasagne's MaxPool3DLayer.
+
+    Usage::
+        >>> network = max_pool3d(incoming=network, pool_size=(2, 2, 2), stride=2)
+
+    :param incoming: the input layer
+    :param pool_size: size of the pooling regions, an int or a 3-tuple
+    :param kwargs: the remaining parameters of lasagne's MaxPool3DLayer, e.g. stride, pad
+    :return: the pooling layer
+    """
+    if _backend == 'cudnn':
+        return lasagne.layers.dnn.MaxPool3DDNNLayer(incoming=incoming, pool_size=pool_size,
+                                                    **kwargs)
+    return lasagne.layers.MaxPool3DLayer(incoming=incoming, pool_size=pool_size, **kwargs)
@@ -0,0 +1,79 @@
+import numpy as np
+import theano
+import lasagne
+from theano import tensor as T
+
+from protfun.utils.log import get_logger
+
+log = get_logger("graph_layer")
+floatX = theano.config.floatX
+
+
+class RadiusGraphConvLayer(lasagne.layers.MergeLayer):
+    """
+    RadiusGraphConvLayer is a message passing layer on the radius graph of the atoms (a
+    continuous-filter convolution): every atom receives from each of its neighbors the
+    neighbor's (linearly transformed) features, multiplied element-wise by a filter that is a
+    learned function of the distance between the two atoms. The messages are summed and added to
+    the atom's own transformed features.
+
+    The distances are expanded in gaussian radial basis functions and smoothly cut off at the
+    radius, so the output does not change abruptly when an atom moves across the cutoff. As only
+    the distances are used, the layer is invariant to rotations and translations of the
+    molecules. The cost of the layer is linear in the number of edges, i.e. in the number of
+    atoms.
+
+    Usage::
+        >>> conv = RadiusGraphConvLayer(atoms, senders, receivers, distances, num_units=64,
+        >>>                             radius=4.5)
+    """
+
+    def __init__(self, incoming, senders, receivers, distances, num_units, radius, n_rbf=16,
+                 W_self=lasagne.init.GlorotUniform(), W_neighbor=lasagne.init.GlorotUniform(),
+                 W_filter=lasagne.init.GlorotUniform(), b=lasagne.init.Constant(0.),
+                 nonlinearity=lasagne.nonlinearities.rectify, **kwargs):
+        """
+        :param incoming: the lasagne layer with the features of the atoms (N x channels)
+        :param senders: the lasagne layer with the sending atom of each edge (E,)
+        :param receivers: the lasagne layer with the receiving atom of each edge (E,)
+        :param distances: the lasagne layer with the length of each edge (E,)
+        :param num_units: number of output features
+        :param radius: the cutoff radius of the graph
+        :param n_rbf: number of radial basis functions, evenly spaced in [0, radius]
+        :param W_self: initializer of the weights for the atom's own features
+        :param W_neighbor: initializer of the weights for the neighbors' features
+        :param W_filter: initializer of the weights mapping the radial basis to the filters
+        :param b: initializer of the biases
+        :param nonlinearity: the non-linearity applied on the output
+        :param kwargs: lasagne **kwargs
+        """
+        super(RadiusGraphConvLayer, self).__init__([incoming, senders, receivers, distances],
+                                                   **kwargs)
+        self.num_units = num_units
+        self.radius = radius
+        self.nonlinearity = nonlinearity or lasagne.nonlinearities.identity
+        n_channels = self.input_shapes[0][1]
+        self.rbf_centers = np.linspace(0, radius, n_rbf).astype(floatX)
+        self.rbf_gamma = np.asarray(1. / (2 * (radius / n_rbf) ** 2), dtype=floatX)
+        self.W_self = self.add_param(W_self, (n_channels, num_units), name='W_self')
+        self.W_neighbor = self.add_param(W_neighbor, (n_channels, num_units), name='W_neighbor')
+        self.W_filter = self.add_param(W_filter, (n_rbf, num_units), name='W_filter')
+        self.b = self.add_param(b, (num_units,), name='b', regularizable=False)
+
+    def get_output_shape_for(self, input_shapes):
+        return input_shapes[0][0], self.num_units
+
+    def get_output_for(self, inputs, **kwargs):
+        features, senders, receivers, distances = inputs
+        # expand the distances in the radial basis, with a cosine cutoff at the radius
+        rbf = T.exp(-self.rbf_gamma * T.sqr(distances.dimshuffle(0, 'x') -
+                                            self.rbf_centers.reshape((1, -1))))
+        cutoff = 0.5 * (T.cos(distances * np.pi / self.radius) + 1.)
+        filters = T.dot(rbf, self.W_filter) * cutoff.dimshuffle(0, 'x')
+
+        messages = T.dot(features, self.W_neighbor)[senders] * filters
+        aggregated = T.inc_subtensor(
+            T.zeros((features.shape[0], self.num_units), dtype=features.dtype)[receivers],
+            messages)
+        output = T.dot(features, self.W_self) + aggregated + self.b.dimshuffle('x', 0)
+        return self.nonlinearity(output)
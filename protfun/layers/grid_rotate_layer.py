@@ -1,8 +1,10 @@
+import os
 import numpy as np
 import theano
 import lasagne
 from theano import tensor as T
 
+from protfun.utils.np_utils import CUBE_SYMMETRIES, symmetry_matrix
 from protfun.utils.log import get_logger
 
 log = get_logger("grid_rotate_layer")
@@ -25,11 +27,17 @@ class GridRotationLayer(lasagne.layers.Layer):
         >>> # apply the rotation layer
         >>> rotation_layer = GridRotationLayer(incoming=input_layer, grid_side=side,
         >>>                                    n_channels=n_channels, interpolation='linear')
+        >>>
+        >>> # or draw the rotations from a precomputed bank of nearest-neighbour index tables
+        >>> bank = RotationIndexBank.precompute(grid_side=side, n_rotations=64)
+        >>> rotation_layer = GridRotationLayer(incoming=input_layer, grid_side=side,
+        >>>                                    n_channels=n_channels, interpolation='nearest',
+        >>>                                    index_bank=bank)
     """
     min_dist_from_border = 5
 
     def __init__(self, incoming, grid_side, n_channels, interpolation='linear',
-                 avg_rotation_angle=np.pi, **kwargs):
+                 avg_rotation_angle=np.pi, index_bank=None, **kwargs):
         """
         :param incoming: the incoming lasagne layer (usually an InputLayer)
             expected shape is (minibatch_size, n_channels, grid_side, grid_side, grid_side)
@@ -37,6 +45,10 @@ class GridRotationLayer(lasagne.layers.Layer):
         :param n_channels: number of channels in the 3D input
         :param interpolation: 'linear' or 'nearest'
         :param avg_rotation_angle: default is np.pi
+        :param index_bank: (optional) a RotationIndexBank for grid_side. If provided, the
+            rotations are not computed on the fly but a random table is picked from the bank on
+            each call, and the augmentation is reduced to a single gather. Requires
+            interpolation='nearest'.
         :param kwargs: lasagne **kwargs
         """
         super(GridRotationLayer, self).__init__(incoming, **kwargs)
@@ -44,11 +56,35 @@ class GridRotationLayer(lasagne.layers.Layer):
         self.n_channels = n_channels
         self.interpolation = interpolation
         self.angle = avg_rotation_angle
+        self.index_tables = None
+        if index_bank is not None:
+            if interpolation != 'nearest':
+                log.error("A rotation index bank can only be used with nearest interpolation")
+                raise ValueError
+            if index_bank.grid_side != grid_side:
+                log.error("The rotation index bank was computed for grid side {}, "
+                          "expected {}".format(index_bank.grid_side, grid_side))
+                raise ValueError
+            # the gather runs on the device, so the tables are copied into this process (and onto
+            # the GPU); the memmap of the bank only saves the precomputation, not this memory
+            self.index_tables = theano.shared(np.asarray(index_bank.tables, dtype=np.int32),
+                                              name="rotation_index_tables")
 
     def get_output_shape_for(self, input_shape):
         return None, self.n_channels, self.grid_side, self.grid_side, self.grid_side
 
-    def get_output_for(self, grids, **kwargs):
+    def get_output_for(self, grids, skip_augmentation=False, **kwargs):
+        """
+        :param grids: the incoming grids
+        :param skip_augmentation: if True, the grids are passed through unchanged, e.g. when the
+            rotations are applied beforehand for test-time augmentation.
+        :return: the randomly rotated and translated grids
+        """
+        if skip_augmentation:
+            return grids
+        if self.index_tables is not None:
+            return self._get_output_from_bank(grids)
+
         height = width = depth = self.grid_side
 
         # np.indices() returns 3 train_grids exactly as big as the original one.
@@ -169,6 +205,18 @@ class GridRotationLayer(lasagne.layers.Layer):
 
         return output
 
+    def _get_output_from_bank(self, grids):
+        """
+        Rotates the grids by picking a random precomputed index table and gathering the
+        flattened grids with it. See RotationIndexBank.
+        """
+        random_streams = T.shared_randomstreams.RandomStreams()
+        table_index = random_streams.random_integers(low=0,
+                                                     high=self.index_tables.shape[0] - 1)
+        flat_grids = grids.reshape((grids.shape[0], grids.shape[1], -1))
+        output = flat_grids[:, :, self.index_tables[table_index]]
+        return output.reshape(grids.shape)
+
     def _rotation_matrix(self):
         # generate a random rotation matrix Q
         random_streams = T.shared_randomstreams.RandomStreams()
@@ -201,6 +249,177 @@ class GridRotationLayer(lasagne.layers.Layer):
         return rand_translation
 
 
+def random_rotation_matrix(avg_rotation_angle=np.pi, random_state=np.random):
+    """
+    numpy counterpart of GridRotationLayer._rotation_matrix(), i.e. a composition of random
+    givens rotations around all 3 spatial axes.
+
+    :param avg_rotation_angle: the rotation angles are drawn uniformly from
+        [-avg_rotation_angle, avg_rotation_angle]
+    :param random_state: a np.random.RandomState (or the np.random module)
+    :return: a 3x3 rotation matrix
+    """
+    angle = random_state.uniform(-avg_rotation_angle, avg_rotation_angle, size=3)
+    c, s = np.cos(angle), np.sin(angle)
+    r_x = np.array([[1, 0, 0], [0, c[0], -s[0]], [0, s[0], c[0]]])
+    r_y = np.array([[c[1], 0, -s[1]], [0, 1, 0], [s[1], 0, c[1]]])
+    r_z = np.array([[c[2], -s[2], 0], [s[2], c[2], 0], [0, 0, 1]])
+    return np.dot(np.dot(r_z, r_y), r_x)
+
+
+def rotation_index_table(grid_side, rotation, translation=(0, 0, 0)):
+    """
+    numpy counterpart of the nearest-neighbour index computation in
+    GridRotationLayer.get_output_for(). Computes for each point of the flattened output grid
+    the flat index of the input grid point it should be gathered from.
+
+    :param grid_side: number of points on each side of the 3D grid
+    :param rotation: 3x3 rotation matrix
+    :param translation: translation vector (in voxels), applied before the rotation
+    :return: np.int32 array of size grid_side ** 3
+    """
+    indices = np.indices((grid_side,) * 3, dtype=np.float64).reshape((3, -1))
+    origin = np.array([grid_side // 2] * 3, dtype=np.float64).reshape((3, 1))
+    indices = indices + np.asarray(translation, dtype=np.float64).reshape((3, 1)) - origin
+    indices = np.tensordot(rotation, indices, axes=(0, 0)) + origin
+    indices = np.rint(np.clip(indices, 0, grid_side - 1 - .001)).astype(np.int64)
+    flat = grid_side ** 2 * indices[0] + grid_side * indices[1] + indices[2]
+    return flat.astype(np.int32)
+
+
+def cube_symmetry_index_table(grid_side, symmetry):
+    """
+    Computes the index table of one of the 24 rotations of the cube (see
+    protfun.utils.np_utils.CUBE_SYMMETRIES). Gathering with this table is an exact permutation
+    of the voxels, identical to the respective axes transpose and flips of the grid (no rounding
+    or clipping takes place).
+
+    :param grid_side: number of points on each side of the 3D grid
+    :param symmetry: an (axes permutation, axes flips) pair
+    :return: np.int32 array of size grid_side ** 3
+    """
+    rotation = symmetry_matrix(*symmetry)
+    # work with doubled coordinates, so that the center (grid_side - 1) / 2 is an integer
+    doubled = 2 * np.indices((grid_side,) * 3, dtype=np.int64).reshape((3, -1)) - (grid_side - 1)
+    indices = (np.dot(rotation, doubled) + (grid_side - 1)) // 2
+    flat = grid_side ** 2 * indices[0] + grid_side * indices[1] + indices[2]
+    return flat.astype(np.int32)
+
+
+class RotationIndexBank(object):
+    """
+    RotationIndexBank is a bank of K precomputed nearest-neighbour rotation index tables for a
+    fixed grid side. It lets GridRotationLayer replace the per-call index computation with a
+    single gather. The bank can be persisted as a memmap file, so that it is computed once for
+    all processes using the same grid side. Note that the memmap only saves the precomputation:
+    GridRotationLayer copies the tables into a shared variable, i.e. each process still holds
+    its own copy of K x grid_side ** 3 indices.
+
+    Usage::
+        >>> bank = RotationIndexBank.load_or_precompute(cache_dir="data/misc", grid_side=64,
+        >>>                                             n_rotations=128)
+        >>> # only the 24 (exact) rotations of the cube
+        >>> cube_bank = RotationIndexBank.precompute(grid_side=64, cube_symmetries_only=True)
+    """
+
+    def __init__(self, grid_side, tables, cube_symmetries_only=False):
+        """
+        :param grid_side: number of points on each side of the 3D grids
+        :param tables: an int32 array (or memmap) of shape (K, grid_side ** 3)
+        :param cube_symmetries_only: whether the tables are the exact rotations of the cube
+        """
+        self.grid_side = grid_side
+        self.tables = tables
+        self.cube_symmetries_only = cube_symmetries_only
+
+    def __len__(self):
+        return self.tables.shape[0]
+
+    @classmethod
+    def precompute(cls, grid_side, n_rotations=64, cube_symmetries_only=False,
+                   avg_rotation_angle=np.pi, max_translation=2.5, seed=None):
+        """
+        Computes a new bank of rotation index tables.
+
+        :param grid_side: number of points on each side of the 3D grids
+        :param n_rotations: number of random rotations (ignored for cube_symmetries_only)
+        :param cube_symmetries_only: restrict the bank to the 24 rotations of the cube
+        :param avg_rotation_angle: see GridRotationLayer
+        :param max_translation: random translations are drawn uniformly from
+            [-max_translation, max_translation] voxels in each direction, as in GridRotationLayer
+        :param seed: seed for the random rotations and translations
+        :return: the RotationIndexBank
+        """
+        if cube_symmetries_only:
+            tables = [cube_symmetry_index_table(grid_side, sym) for sym in CUBE_SYMMETRIES]
+        else:
+            random_state = np.random.RandomState(seed)
+            tables = list()
+            for _ in xrange(n_rotations):
+                rotation = random_rotation_matrix(avg_rotation_angle, random_state)
+                translation = random_state.uniform(-max_translation, max_translation, size=3)
+                tables.append(rotation_index_table(grid_side, rotation, translation))
+        return cls(grid_side, np.vstack(tables), cube_symmetries_only=cube_symmetries_only)
+
+    def save(self, file_path):
+        """
+        Persists the bank as a flat int32 memmap file. The tables are written to a temporary
+        file first and renamed, so that concurrent readers never see a partially written bank.
+
+        :param file_path: where to store the tables
+        """
+        tmp_path = "{}.{}.tmp".format(file_path, os.getpid())
+        tmp = np.memmap(tmp_path, shape=self.tables.shape, mode='w+', dtype=np.int32)
+        tmp[:] = self.tables[:]
+        tmp.flush()
+        del tmp
+        os.rename(tmp_path, file_path)
+
+    @classmethod
+    def load(cls, file_path, grid_side, cube_symmetries_only=False, n_rotations=None):
+        """
+        Maps a persisted bank read-only into memory.
+
+        :param file_path: the memmap file written by save()
+        :param grid_side: number of points on each side of the 3D grids
+        :param cube_symmetries_only: whether the file contains only the rotations of the cube
+        :param n_rotations: (optional) the expected number of tables in the file
+        :return: the RotationIndexBank
+        """
+        table_size = grid_side ** 3 * np.dtype(np.int32).itemsize
+        file_size = os.path.getsize(file_path)
+        if file_size == 0 or file_size % table_size != 0 or \
+                (n_rotations is not None and file_size != n_rotations * table_size):
+            log.error("The rotation index bank {} has an unexpected size of {} bytes".format(
+                file_path, file_size))
+            raise ValueError
+        tables = np.memmap(file_path, mode='r', dtype=np.int32).reshape((-1, grid_side ** 3))
+        return cls(grid_side, tables, cube_symmetries_only=cube_symmetries_only)
+
+    @classmethod
+    def load_or_precompute(cls, cache_dir, grid_side, n_rotations=64,
+                           cube_symmetries_only=False, seed=0):
+        """
+        Loads the bank for the given parameters from cache_dir, computes and stores it first if
+        it is not there yet.
+
+        :param cache_dir: the directory where the banks are stored
+        :return: the RotationIndexBank
+        """
+        if cube_symmetries_only:
+            filename = "rotations_{}_cube.memmap".format(grid_side)
+            n_rotations = len(CUBE_SYMMETRIES)
+        else:
+            filename = "rotations_{}_{}_seed{}.memmap".format(grid_side, n_rotations, seed)
+        file_path = os.path.join(cache_dir, filename)
+        if not os.path.exists(file_path):
+            log.info("Precomputing rotation index tables into {}".format(file_path))
+            cls.precompute(grid_side, n_rotations=n_rotations,
+                           cube_symmetries_only=cube_symmetries_only, seed=seed).save(file_path)
+        return cls.load(file_path, grid_side, cube_symmetries_only=cube_symmetries_only,
+                        n_rotations=n_rotations)
+
+
 if __name__ == "__main__":
     """
     A quick test of the grid rotation layer.
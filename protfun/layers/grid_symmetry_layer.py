@@ -0,0 +1,101 @@
+import numpy as np
+import theano
+import lasagne
+from theano import tensor as T
+from theano.ifelse import ifelse
+
+from protfun.utils.np_utils import CUBE_SYMMETRIES
+from protfun.utils.log import get_logger
+
+log = get_logger("grid_symmetry_layer")
+floatX = theano.config.floatX
+
+
+class GridSymmetryLayer(lasagne.layers.Layer):
+    """
+    GridSymmetryLayer is a cheaper and exact alternative to the GridRotationLayer. Instead of
+    rotating the grids by arbitrary angles (which requires interpolation and blurs the
+    densities), it applies a random one of the 24 rotations of the cube, implemented purely as
+    axes transposes and flips, followed by a random integer translation of the voxels.
+
+    As in the GridRotationLayer, a single random transformation is drawn for the whole
+    mini-batch on each call. In deterministic mode (validation / testing) the grids are passed
+    through unchanged.
+
+    Usage::
+        >>> from lasagne.layers import InputLayer
+        >>> input_layer = InputLayer(shape=(8, 1, 64, 64, 64), input_var=input_grid)
+        >>> symmetry_layer = GridSymmetryLayer(incoming=input_layer, grid_side=64,
+        >>>                                    n_channels=1, max_translation=2)
+    """
+
+    def __init__(self, incoming, grid_side, n_channels, max_translation=2,
+                 translation_mode='roll', **kwargs):
+        """
+        :param incoming: the incoming lasagne layer (usually an InputLayer)
+            expected shape is (minibatch_size, n_channels, grid_side, grid_side, grid_side)
+        :param grid_side: number of points on each side of the 3D input
+        :param n_channels: number of channels in the 3D input
+        :param max_translation: the translations are drawn uniformly from the integers in
+            [-max_translation, max_translation] for each spatial axis
+        :param translation_mode: 'roll' (wrap around the borders) or 'pad' (fill with zeros)
+        :param kwargs: lasagne **kwargs
+        """
+        super(GridSymmetryLayer, self).__init__(incoming, **kwargs)
+        if translation_mode not in ('roll', 'pad'):
+            log.error("translation_mode can only be 'roll' or 'pad'")
+            raise ValueError
+        self.grid_side = grid_side
+        self.n_channels = n_channels
+        self.max_translation = max_translation
+        self.translation_mode = translation_mode
+
+    def get_output_shape_for(self, input_shape):
+        return input_shape[0], self.n_channels, self.grid_side, self.grid_side, self.grid_side
+
+    def get_output_for(self, grids, deterministic=False, skip_augmentation=False, **kwargs):
+        if deterministic or skip_augmentation:
+            return grids
+        random_streams = T.shared_randomstreams.RandomStreams()
+
+        # pick one of the 24 symmetries; ifelse is lazy, so only the chosen branch is computed
+        symmetry_index = random_streams.random_integers(low=0, high=len(CUBE_SYMMETRIES) - 1)
+        output = self._select_symmetry(grids, symmetry_index, 0, len(CUBE_SYMMETRIES))
+
+        if self.max_translation > 0:
+            shifts = random_streams.random_integers(size=(3,), low=-self.max_translation,
+                                                    high=self.max_translation)
+            for axis in range(3):
+                output = self._translate(output, shifts[axis], axis + 2)
+        return output
+
+    def _select_symmetry(self, grids, symmetry_index, first, last):
+        """
+        Builds a balanced tree of lazy ifelse nodes over the symmetries in [first, last).
+        """
+        if last - first == 1:
+            return self.apply_symmetry(grids, CUBE_SYMMETRIES[first])
+        middle = (first + last) // 2
+        return ifelse(T.lt(symmetry_index, middle),
+                      self._select_symmetry(grids, symmetry_index, first, middle),
+                      self._select_symmetry(grids, symmetry_index, middle, last))
+
+    @staticmethod
+    def apply_symmetry(grids, symmetry):
+        """
+        Symbolic counterpart of protfun.utils.np_utils.apply_cube_symmetry for 5D grids.
+        """
+        perm, flips = symmetry
+        output = grids.dimshuffle(0, 1, *[2 + p for p in perm])
+        slices = [slice(None)] * 2 + [slice(None, None, -1) if f else slice(None) for f in flips]
+        return output[tuple(slices)]
+
+    def _translate(self, grids, shift, axis):
+        if self.translation_mode == 'roll':
+            return T.roll(grids, shift, axis=axis)
+        size = grids.shape[axis]
+        src = [slice(None)] * 5
+        dst = [slice(None)] * 5
+        src[axis] = slice(T.maximum(0, -shift), size - T.maximum(0, shift))
+        dst[axis] = slice(T.maximum(0, shift), size - T.maximum(0, -shift))
+        return T.set_subtensor(T.zeros_like(grids)[tuple(dst)], grids[tuple(src)])
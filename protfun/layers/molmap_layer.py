@@ -1,3 +1,4 @@
+import os
 import lasagne
 import numpy as np
 import theano
@@ -35,17 +36,14 @@ class MoleculeMapLayer(lasagne.layers.MergeLayer):
         """
         :param incomings: list of lasagne InputLayers for coords, vdwradii and n_atoms for the
             molecules in the minibatch.
-        :param minibatch_size: size of the mini-batches that will be passed to this layer
+        :param minibatch_size: (optional) size of the mini-batches that will be passed to this
+            layer, only used for the static output shape. Mini-batches of any size are accepted.
         :param grid_side: length of the grid_side (in angstroms, not number of points)
         :param resolution: length of the side of a single voxel in the grid, in angstroms.
         :param rotate: boolean flag, whether to rotate the molecule before creating the grid or not.
         :param kwargs: lasagne **kwargs
         """
         super(MoleculeMapLayer, self).__init__(incomings, **kwargs)
-        if minibatch_size is None:
-            minibatch_size = 1
-            log.info("Minibatch size not provided - assuming {}.".format(minibatch_size))
-
         self.minibatch_size = minibatch_size
         self.rotate = rotate
 
@@ -68,12 +66,14 @@ class MoleculeMapLayer(lasagne.layers.MergeLayer):
         self.grid_coords = self.add_param(grid_coords, grid_coords.shape, 'grid_coords',
                                           trainable=False)
 
-    def get_output_shape_for(self, input_shape):
+    def get_output_shape_for(self, input_shapes):
         """
-        :param input_shape: not needed
+        :param input_shapes: shapes of coords, vdwradii and n_atoms
         :return: the shape of the two computed grid (electron density)
         """
-        return self.minibatch_size, 1, self.side_points_count, self.side_points_count, self.side_points_count
+        minibatch_size = input_shapes[0][0] if input_shapes[0][0] is not None \
+            else self.minibatch_size
+        return minibatch_size, 1, self.side_points_count, self.side_points_count, self.side_points_count
 
     def get_output_for(self, mols_info, **kwargs):
         """
@@ -92,9 +92,10 @@ class MoleculeMapLayer(lasagne.layers.MergeLayer):
             mols_coords = self.rotate_and_translate(mols_coords)
 
         # initialize the computed electron density with 0s, it will be computed part by part
-        # in place.
-        zeros = np.zeros((self.minibatch_size, 1, self.side_points_count ** 3), dtype=floatX)
-        grids_density = self.add_param(zeros, zeros.shape, 'grids_density', trainable=False)
+        # in place. The size of the mini-batch is symbolic, so that the last mini-batch of an
+        # evaluation pass can be smaller.
+        n_mols = mols_natoms.shape[0]
+        grids_density = T.zeros((n_mols, 1, self.side_points_count ** 3), dtype=floatX)
 
         # determine the free GPU memory
         free_gpu_memory = self.get_free_gpu_memory()
@@ -185,28 +186,30 @@ class MoleculeMapLayer(lasagne.layers.MergeLayer):
 
         # this theano.scan iterates over each molecule in the mini-batch
         result, _ = theano.scan(fn=compute_grid_per_mol,
-                                sequences=[T.arange(self.minibatch_size),
+                                sequences=[T.arange(n_mols),
                                            mols_natoms,
                                            mols_coords,
                                            mols_vdwradii],
                                 outputs_info=grids_density,
                                 non_sequences=self.grid_coords,
-                                n_steps=self.minibatch_size,
                                 allow_gc=True)
 
         # result[-1] has the final computation of the electron density for all molecules
         # in the minibatch
         grids_density = result[-1]
         grids_density = T.reshape(grids_density, newshape=(
-            self.minibatch_size, 1, self.side_points_count,
+            n_mols, 1, self.side_points_count,
             self.side_points_count, self.side_points_count))
         return grids_density
 
     @staticmethod
     def get_free_gpu_memory():
         """
-        :return: the GPU memory that is currently free on the machine.
+        :return: the GPU memory that is currently free on the machine, or the available system
+            memory when theano runs on the CPU.
         """
+        if theano.config.device.startswith('cpu'):
+            return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
         import theano.sandbox.cuda.basic_ops as cuda
         # free gpu memory in bytes
         free_gpu_memory = cuda.cuda_ndarray.cuda_ndarray.mem_info()[0]
@@ -261,7 +264,7 @@ class MoleculeMapLayer(lasagne.layers.MergeLayer):
         coords_max = T.max(perturbated_coords, axis=1, keepdims=True)
         transl_min = (-self.endx + self.min_dist_from_border) - coords_min
         transl_max = (self.endx - self.min_dist_from_border) - coords_max
-        rand01 = random_streams.uniform((self.minibatch_size, 1, 3),
+        rand01 = random_streams.uniform((coords.shape[0], 1, 3),
                                         dtype=floatX)  # unifom random in open interval ]0;1[
         rand01 = T.Rebroadcast((1, True), )(rand01)
         rand_translation = rand01 * (transl_max - transl_min) + transl_min
@@ -274,7 +277,6 @@ if __name__ == "__main__":
     A quick test of the MoleculeMapLayer.
     The computed electron density grid is visualized using the molecule view.
     """
-    import os
 
     # replace this with something meaningful on your system
     path_to_moldata = "/home/valor/workspace/DLCV_ProtFun/data/full/processed_single_64/1A0H"
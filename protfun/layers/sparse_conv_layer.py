@@ -0,0 +1,120 @@
+import numpy as np
+import theano
+import lasagne
+from theano import tensor as T
+
+from protfun.utils.sparse_voxels import KERNEL_OFFSETS
+from protfun.utils.log import get_logger
+
+log = get_logger("sparse_conv_layer")
+floatX = theano.config.floatX
+
+
+class SparseConv3DLayer(lasagne.layers.MergeLayer):
+    """
+    SparseConv3DLayer is a 3x3x3 convolution (with 'same' padding) computed only at the active
+    sites of a sparse voxel grid, i.e. the output has the same active sites as the input
+    (submanifold convolution). The features of the sites are a (N x channels) matrix, and the
+    27 neighbors of each site are given by a precomputed neighbor map (see
+    protfun.utils.sparse_voxels.neighbor_map), in which missing neighbors point to an extra zero
+    row. The cost and memory of the layer are thus linear in the number of active sites, not in
+    the volume of the grid.
+
+    Usage::
+        >>> features = InputLayer(shape=(None, 1), input_var=T.matrix('features'))
+        >>> neighbors = InputLayer(shape=(None, 27), input_var=T.imatrix('neighbors'))
+        >>> conv = SparseConv3DLayer(features, neighbors, num_filters=32)
+    """
+
+    def __init__(self, incoming, neighbors, num_filters, W=lasagne.init.GlorotUniform(),
+                 b=lasagne.init.Constant(0.), nonlinearity=lasagne.nonlinearities.rectify,
+                 **kwargs):
+        """
+        :param incoming: the lasagne layer with the features of the active sites (N x channels)
+        :param neighbors: the lasagne layer with the neighbor map of the active sites (N x 27)
+        :param num_filters: number of output channels
+        :param W: initializer of the weights, shaped (27 * channels, num_filters)
+        :param b: initializer of the biases, None for no biases
+        :param nonlinearity: the non-linearity applied on the output
+        :param kwargs: lasagne **kwargs
+        """
+        super(SparseConv3DLayer, self).__init__([incoming, neighbors], **kwargs)
+        self.num_filters = num_filters
+        self.nonlinearity = nonlinearity or lasagne.nonlinearities.identity
+        n_channels = self.input_shapes[0][1]
+        self.W = self.add_param(W, (len(KERNEL_OFFSETS) * n_channels, num_filters), name='W')
+        if b is None:
+            self.b = None
+        else:
+            self.b = self.add_param(b, (num_filters,), name='b', regularizable=False)
+
+    def get_output_shape_for(self, input_shapes):
+        return input_shapes[0][0], self.num_filters
+
+    def get_output_for(self, inputs, **kwargs):
+        features, neighbors = inputs
+        # the last row is the zero padding for the missing neighbors
+        padded = T.concatenate([features, T.zeros((1, features.shape[1]), dtype=features.dtype)])
+        gathered = padded[neighbors.flatten()].reshape(
+            (neighbors.shape[0], neighbors.shape[1] * features.shape[1]))
+        output = T.dot(gathered, self.W)
+        if self.b is not None:
+            output += self.b.dimshuffle('x', 0)
+        return self.nonlinearity(output)
+
+
+class SparsePool3DLayer(lasagne.layers.MergeLayer):
+    """
+    SparsePool3DLayer is a 2x2x2 max-pooling with stride 2 over the active sites of a sparse
+    voxel grid. Each output site is an active site of the grid at half the resolution, and takes
+    the maximum over its (up to 8) active children, given by a precomputed children map (see
+    protfun.utils.sparse_voxels.downsample_sites). Missing children are ignored.
+    """
+
+    def __init__(self, incoming, children, **kwargs):
+        """
+        :param incoming: the lasagne layer with the features of the active sites (N x channels)
+        :param children: the lasagne layer with the children map of the coarse sites (M x 8)
+        :param kwargs: lasagne **kwargs
+        """
+        super(SparsePool3DLayer, self).__init__([incoming, children], **kwargs)
+
+    def get_output_shape_for(self, input_shapes):
+        return input_shapes[1][0], input_shapes[0][1]
+
+    def get_output_for(self, inputs, **kwargs):
+        features, children = inputs
+        # every coarse site has at least one child, so the padding is never the maximum
+        lowest = np.asarray(np.finfo(features.dtype).min, dtype=features.dtype)
+        padded = T.concatenate([features, T.alloc(lowest, 1, features.shape[1])])
+        gathered = padded[children.flatten()].reshape(
+            (children.shape[0], children.shape[1], features.shape[1]))
+        return T.max(gathered, axis=1)
+
+
+class SparseGlobalPoolLayer(lasagne.layers.MergeLayer):
+    """
+    SparseGlobalPoolLayer averages the features of the active sites of each sample in the
+    mini-batch, resulting in a (minibatch_size x channels) matrix that can be fed into dense
+    layers.
+    """
+
+    def __init__(self, incoming, segments, counts, **kwargs):
+        """
+        :param incoming: the lasagne layer with the features of the active sites (N x channels)
+        :param segments: the lasagne layer with the sample index of each active site (N,)
+        :param counts: the lasagne layer with the number of active sites of each sample
+            (minibatch_size,)
+        :param kwargs: lasagne **kwargs
+        """
+        super(SparseGlobalPoolLayer, self).__init__([incoming, segments, counts], **kwargs)
+
+    def get_output_shape_for(self, input_shapes):
+        return input_shapes[2][0], input_shapes[0][1]
+
+    def get_output_for(self, inputs, **kwargs):
+        features, segments, counts = inputs
+        sums = T.inc_subtensor(
+            T.zeros((counts.shape[0], features.shape[1]), dtype=features.dtype)[segments],
+            features)
+        return sums / T.maximum(counts, 1).dimshuffle(0, 'x')
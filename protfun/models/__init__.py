@@ -1,5 +1,7 @@
 from protfun.models.disjoint_class_model import MemmapsDisjointClassifier, \
-    GridsDisjointClassifier
+    GridsDisjointClassifier, SparseDisjointClassifier, GraphDisjointClassifier
 from protfun.models.joint_class_model import GridsJointClassifier
+from protfun.models.function_cache import FunctionCache
 from protfun.models.model_monitor import *
 from protfun.models.model_trainer import *
+from protfun.models.inference_engine import InferenceEngine, serve
@@ -1,4 +1,6 @@
 import abc
+import hashlib
+import time
 import numpy as np
 import theano
 import theano.tensor as T
@@ -6,6 +8,7 @@ import lasagne
 
 from protfun.layers.molmap_layer import MoleculeMapLayer
 from protfun.layers.grid_rotate_layer import GridRotationLayer
+from protfun.layers.grid_symmetry_layer import GridSymmetryLayer
 from protfun.utils.log import get_logger
 
 log = get_logger("disjoint_class_model")
@@ -25,25 +28,34 @@ class DisjointClassModel(object):
 
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, name, n_classes, learning_rate):
+    def __init__(self, name, n_classes, learning_rate, function_cache=None, cache_key=None):
         """
         :param name: name of the model, used by external mechanisms for saving training history etc.
         :param n_classes: total number of different classes for the classification.
         :param learning_rate: initial learning rate
+        :param function_cache: (optional) a FunctionCache, in which the compiled functions are
+            persisted and looked up under cache_key
+        :param cache_key: key of the model in the function_cache, see FunctionCache.make_key
         """
         self.name = name
         self.n_classes = n_classes
         self.learning_rate = learning_rate
+        self.function_cache = function_cache if cache_key is not None else None
+        self.cache_key = cache_key
 
-        # these functions are defined in define_forward_pass()
-        self.train_function = None
-        self.validation_function = None
-        self.get_hidden_activations = None
+        # the graphs of these functions are defined in define_forward_pass(), each function is
+        # compiled (or loaded from the function cache) on first use
+        self._compilers = dict()
+        self._functions = dict()
+        self.accumulation_steps = 1
+        self._gradient_buffers = list()
 
         # child classes must define self.output_layers before calling define_forward_pass()
         self.output_layers = None
+        self.input_vars = None
 
-    def define_forward_pass(self, input_vars, output_layer, penalty=0):
+    def define_forward_pass(self, input_vars, output_layer, penalty=0, accumulation_steps=1,
+                            loss_scale=1.):
         """
         define_forward_pass is meant to be called in the constructors of models that inherit
         from DisjointClassModel. It defines the core functionality of the model:
@@ -53,11 +65,34 @@ class DisjointClassModel(object):
             * defines the train_function (forward pass during training)
             * defines the validation_function (forward pass during testing / validation)
 
+        The functions are only compiled when they are first used, so that e.g. testing a model
+        does not compile the training graph.
+
+        With accumulation_steps > 1, the gradients of accumulation_steps consecutive calls of the
+        train_function (micro-batches) are summed into shared buffers, and a single adam update
+        with their mean is applied after the last of them. This gives the updates of a
+        accumulation_steps times larger mini-batch, with the memory footprint of a micro-batch.
+
+        With loss_scale > 1, the gradients are computed for the loss multiplied by loss_scale
+        and divided by it again, so that small gradients do not underflow in half precision.
+        Updates with non-finite gradients (overflows) are skipped. Note that the activations and
+        gradients of all current models (including the 'mixed' precision) are float32, where
+        small gradients do not underflow, so the scale currently has no effect besides skipping
+        non-finite updates.
+
         :param input_vars: list of the Theano variables for the input data the model is applied on.
         :param output_layer: the last Lasagne layer of the neural network, child classes should apply the
             neural network before calling define_forward_pass()
         :param penalty: if applicable, and L2 penalty to add to the loss (otherwise 0).
+        :param accumulation_steps: number of micro-batches whose gradients are accumulated
+            before an update is applied, 1 for an update after every mini-batch.
+        :param loss_scale: static scale of the loss for the gradient computation, 1 for none.
         """
+        if accumulation_steps < 1:
+            log.error("accumulation_steps must be at least 1")
+            raise ValueError
+        self.input_vars = input_vars
+        self.accumulation_steps = accumulation_steps
         train_params = lasagne.layers.get_all_params(output_layer, trainable=True)
         targets = T.imatrix('targets')
 
@@ -77,33 +112,210 @@ class DisjointClassModel(object):
         per_class_val_accuracies = T.mean(T.eq(val_predictions > 0.5, targets), axis=0,
                                           dtype=theano.config.floatX)
 
-        train_params_updates = lasagne.updates.adam(loss_or_grads=train_loss,
-                                                    params=train_params,
-                                                    learning_rate=self.learning_rate)
-
-        # define training forward pass function
-        self.train_function = theano.function(inputs=input_vars + [targets],
-                                              outputs={'loss': train_loss,
-                                                       'accuracy': train_accuracy,
-                                                       'per_class_accs': per_class_train_accuracies,
-                                                       'predictions': T.stack(train_predictions)},
-                                              updates=train_params_updates)  # , profile=True)
-
-        # define testing forward pass function
-        self.validation_function = theano.function(inputs=input_vars + [targets],
-                                                   outputs={'loss': val_loss,
-                                                            'accuracy': val_accuracy,
-                                                            'per_class_accs': per_class_val_accuracies,
-                                                            'predictions': T.stack(
-                                                                val_predictions)})
-
-        # define a utility function for getting the activations of all layers
-        self.get_hidden_activations = theano.function(inputs=input_vars,
-                                                      outputs=lasagne.layers.get_output(
-                                                          lasagne.layers.get_all_layers(
-                                                              output_layer))
-                                                              + [T.stack(val_predictions)])
-        log.info("Computational graph for {} compiled".format(self.name))
+        def gradients():
+            if loss_scale == 1:
+                return T.grad(train_loss, train_params)
+            return [grad / loss_scale for grad in T.grad(train_loss * loss_scale, train_params)]
+
+        def adam_updates(grads):
+            updates = lasagne.updates.adam(loss_or_grads=grads,
+                                           params=train_params,
+                                           learning_rate=self.learning_rate)
+            if loss_scale == 1:
+                return updates
+            # skip the whole update (incl. the optimizer state) if the scaled loss overflowed
+            overflow = T.any(T.stack([T.any(T.or_(T.isnan(grad), T.isinf(grad)))
+                                      for grad in grads]))
+            for var in updates:
+                updates[var] = T.switch(overflow, var, updates[var])
+            return updates
+
+        def compile_train_function():
+            train_params_updates = adam_updates(gradients())
+            return theano.function(inputs=input_vars + [targets],
+                                   outputs={'loss': train_loss,
+                                            'accuracy': train_accuracy,
+                                            'per_class_accs': per_class_train_accuracies,
+                                            'predictions': T.stack(train_predictions)},
+                                   updates=train_params_updates)  # , profile=True)
+
+        # shared buffers, in which the gradients of the micro-batches are summed
+        self._gradient_buffers = list()
+        if accumulation_steps > 1:
+            self._gradient_buffers = [
+                theano.shared(np.zeros(p.get_value(borrow=True).shape, dtype=p.dtype),
+                              broadcastable=p.broadcastable, name='grad_buffer')
+                for p in train_params]
+
+        def compile_accumulate_function():
+            grads = gradients()
+            return theano.function(inputs=input_vars + [targets],
+                                   outputs={'loss': train_loss,
+                                            'accuracy': train_accuracy,
+                                            'per_class_accs': per_class_train_accuracies,
+                                            'predictions': T.stack(train_predictions)},
+                                   updates=[(buf, buf + grad) for buf, grad in
+                                            zip(self._gradient_buffers, grads)])
+
+        def compile_apply_function():
+            # the number of accumulated micro-batches, smaller than accumulation_steps for the
+            # last update of an epoch
+            n_accumulated = T.scalar('n_accumulated', dtype=floatX)
+            mean_grads = [buf / n_accumulated for buf in self._gradient_buffers]
+            updates = adam_updates(mean_grads)
+            for buf in self._gradient_buffers:
+                updates[buf] = T.zeros_like(buf)
+            return theano.function(inputs=[n_accumulated], updates=updates)
+
+        def compile_validation_function():
+            return theano.function(inputs=input_vars + [targets],
+                                   outputs={'loss': val_loss,
+                                            'accuracy': val_accuracy,
+                                            'per_class_accs': per_class_val_accuracies,
+                                            'predictions': T.stack(val_predictions)})
+
+        def compile_hidden_activations():
+            # a utility function for getting the activations of all layers
+            return theano.function(inputs=input_vars,
+                                   outputs=lasagne.layers.get_output(
+                                       lasagne.layers.get_all_layers(output_layer))
+                                           + [T.stack(val_predictions)])
+
+        def compile_prediction_function():
+            predictions = lasagne.layers.get_output(output_layer, deterministic=True,
+                                                    skip_augmentation=True)
+            return theano.function(inputs=input_vars, outputs=T.stack(predictions))
+
+        self._compilers = {'train_function': compile_train_function,
+                           'accumulate_function': compile_accumulate_function,
+                           'apply_function': compile_apply_function,
+                           'validation_function': compile_validation_function,
+                           'get_hidden_activations': compile_hidden_activations,
+                           'prediction_function': compile_prediction_function}
+        self._functions = dict()
+        log.info("Computational graph for {} defined".format(self.name))
+
+    def _get_function(self, name, keep=True):
+        """
+        Returns the function with the given name, compiling it (or loading it from the function
+        cache) on first use.
+
+        :param name: name of the function
+        :param keep: whether the compiled function is kept by the model for later calls
+        """
+        if name in self._functions:
+            return self._functions[name]
+        if name not in self._compilers:
+            log.error("define_forward_pass() must be called before using {}".format(name))
+            raise ValueError
+        # the gradient buffers are shared between the functions as well
+        params = lasagne.layers.get_all_params(self.output_layers) + self._gradient_buffers
+        function = None
+        if self.function_cache is not None:
+            function = self.function_cache.load(self.cache_key, name, params)
+        if function is None:
+            start_time = time.time()
+            function = self._compilers[name]()
+            log.info("Compiled {} for {} in {:.1f}s".format(name, self.name,
+                                                             time.time() - start_time))
+            if self.function_cache is not None:
+                self.function_cache.save(self.cache_key, name, function, params)
+        if keep:
+            self._functions[name] = function
+        return function
+
+    @property
+    def train_function(self):
+        if self.accumulation_steps == 1:
+            return self._get_function('train_function')
+        if 'train_function' not in self._functions:
+            self._functions['train_function'] = AccumulatingTrainFunction(
+                accumulate_function=self._get_function('accumulate_function'),
+                apply_function=self._get_function('apply_function'),
+                accumulation_steps=self.accumulation_steps)
+        return self._functions['train_function']
+
+    def flush_gradients(self):
+        """
+        Applies the gradients accumulated so far, if the train_function accumulates gradients
+        over micro-batches and some are pending (e.g. at the end of an epoch). Otherwise
+        nothing is done.
+        """
+        train_function = self._functions.get('train_function')
+        if isinstance(train_function, AccumulatingTrainFunction):
+            train_function.flush()
+
+    @property
+    def validation_function(self):
+        return self._get_function('validation_function')
+
+    @property
+    def get_hidden_activations(self):
+        return self._get_function('get_hidden_activations')
+
+    def get_layers(self, layers=None):
+        """
+        Selects layers of the network.
+
+        :param layers: (optional) list of layer indices (in the order of
+            lasagne.layers.get_all_layers) or layer names. If None, all layers are selected.
+        :return: list of (index, layer) tuples, in the order of the network
+        """
+        all_layers = lasagne.layers.get_all_layers(self.output_layers)
+        if layers is None:
+            return list(enumerate(all_layers))
+        names = {layer.name: i for i, layer in enumerate(all_layers) if layer.name is not None}
+        indices = set()
+        for layer in layers:
+            if layer in names:
+                indices.add(names[layer])
+            elif isinstance(layer, int) and -len(all_layers) <= layer < len(all_layers):
+                indices.add(layer % len(all_layers))
+            else:
+                log.error("Unknown layer: {}".format(layer))
+                raise ValueError
+        return [(i, all_layers[i]) for i in sorted(indices)]
+
+    def get_activation_function(self, layers=None, keep=True):
+        """
+        Returns a function that maps the inputs to the (deterministic) activations of the
+        selected layers only, so that no other intermediate results have to be kept. As in
+        get_prediction_function(), the random augmentation is skipped, so the activations
+        match the predictions for the same inputs. The function is compiled on first use.
+
+        Usage::
+            >>> activations = model.get_activation_function(layers=[2, 'conv_3'])
+            >>> conv2, conv3 = activations(grids)
+
+        :param layers: (optional) the selected layers, see get_layers(). All layers if None.
+        :param keep: whether the compiled function is kept by the model for later calls. Pass
+            False when the function is used only once, e.g. when streaming the activations of
+            one layer after the other.
+        :return: the compiled theano function, returning a list with the activations of each of
+            the selected layers
+        """
+        selected = self.get_layers(layers)
+        name = 'activations_{}'.format('-'.join(str(i) for i, _ in selected))
+        if name not in self._compilers:
+            def compile_activation_function():
+                return theano.function(inputs=self.input_vars,
+                                       outputs=lasagne.layers.get_output(
+                                           [layer for _, layer in selected], deterministic=True,
+                                           skip_augmentation=True))
+
+            self._compilers[name] = compile_activation_function
+        return self._get_function(name, keep=keep)
+
+    def get_prediction_function(self):
+        """
+        Returns a function that maps the inputs to the (deterministic) sigmoid outputs of the
+        model, **without** the random augmentation in the beginning of the network. Used for
+        test-time augmentation, where the inputs are transformed beforehand. The function is
+        compiled on first use.
+
+        :return: the compiled theano function
+        """
+        return self._get_function('prediction_function')
 
     def get_output_layers(self):
         """
@@ -115,6 +327,42 @@ class DisjointClassModel(object):
         return self.name
 
 
+class AccumulatingTrainFunction(object):
+    """
+    AccumulatingTrainFunction can be called like the compiled train function of a model. Each
+    call runs the forward and backward pass of a micro-batch and accumulates its gradients, every
+    accumulation_steps calls the accumulated gradients are applied in a single update.
+    """
+
+    def __init__(self, accumulate_function, apply_function, accumulation_steps):
+        """
+        :param accumulate_function: compiled function, adds the gradients of a micro-batch to the
+            gradient buffers and returns the same outputs as a train function
+        :param apply_function: compiled function, applies the mean of the buffered gradients and
+            resets the buffers. Takes the number of accumulated micro-batches.
+        :param accumulation_steps: number of micro-batches per update
+        """
+        self.accumulate_function = accumulate_function
+        self.apply_function = apply_function
+        self.accumulation_steps = accumulation_steps
+        self.n_accumulated = 0
+
+    def __call__(self, *inputs):
+        output = self.accumulate_function(*inputs)
+        self.n_accumulated += 1
+        if self.n_accumulated == self.accumulation_steps:
+            self.flush()
+        return output
+
+    def flush(self):
+        """
+        Applies the pending accumulated gradients, if any.
+        """
+        if self.n_accumulated > 0:
+            self.apply_function(np.asarray(self.n_accumulated, dtype=floatX))
+            self.n_accumulated = 0
+
+
 class MemmapsDisjointClassifier(DisjointClassModel):
     """
     MemmapsDisjointClassifier extends the DisjointClassModel.
@@ -140,11 +388,12 @@ class MemmapsDisjointClassifier(DisjointClassModel):
         coords = T.tensor3('coords')
         vdwradii = T.matrix('vdwradii')
         n_atoms = T.ivector('n_atoms')
-        coords_input = lasagne.layers.InputLayer(shape=(self.minibatch_size, None, None),
+        # the mini-batch dimension is left variable, e.g. for a smaller last mini-batch
+        coords_input = lasagne.layers.InputLayer(shape=(None, None, None),
                                                  input_var=coords)
-        vdwradii_input = lasagne.layers.InputLayer(shape=(self.minibatch_size, None),
+        vdwradii_input = lasagne.layers.InputLayer(shape=(None, None),
                                                    input_var=vdwradii)
-        natoms_input = lasagne.layers.InputLayer(shape=(self.minibatch_size,),
+        natoms_input = lasagne.layers.InputLayer(shape=(None,),
                                                  input_var=n_atoms)
         grids = MoleculeMapLayer(
             incomings=[coords_input, vdwradii_input, natoms_input],
@@ -170,7 +419,9 @@ class GridsDisjointClassifier(DisjointClassModel):
     """
 
     def __init__(self, name, n_classes, network, grid_size, n_channels, minibatch_size,
-                 learning_rate=1e-4):
+                 learning_rate=1e-4, rotation_bank=None, augmentation='rotation',
+                 max_translation=2, translation_mode='roll', function_cache=None,
+                 accumulation_steps=1, precision='float32', loss_scale=1.):
         """
         :param name: name of the model, used by external mechanisms for saving training history etc.
         :param n_classes: total number of different classes for the classification.
@@ -179,17 +430,82 @@ class GridsDisjointClassifier(DisjointClassModel):
         :param n_channels: number of channels in the input grids (should be 1)
         :param minibatch_size: -
         :param learning_rate: initial learning rate
+        :param rotation_bank: (optional) a RotationIndexBank, if provided the grids are rotated
+            with nearest interpolation by gathering with the precomputed index tables. Only used
+            with the 'rotation' augmentation.
+        :param augmentation: how the grids are augmented in the graph:
+            'rotation' - random rotations with interpolation (GridRotationLayer)
+            'cube' - exact random rotations of the cube and integer translations
+                     (GridSymmetryLayer)
+            'none' - no augmentation in the graph, e.g. when it is done by the data feeder
+        :param max_translation: max. translation in voxels for the 'cube' augmentation
+        :param translation_mode: 'roll' or 'pad', see GridSymmetryLayer
+        :param function_cache: (optional) a FunctionCache, the compiled functions are then reused
+            by all models with the same network, shapes and hyperparameters
+        :param accumulation_steps: number of mini-batches whose gradients are accumulated before
+            an update is applied, see DisjointClassModel.define_forward_pass()
+        :param precision: 'float32' (everything in floatX) or 'mixed': the input grids are
+            float16 and are augmented in float16, and they are cast to float32 before the network.
+            The weights, the activations of the network and the loss stay in float32, because
+            the 3D convolutions of the CPU (BLAS) backend only support float32 / float64.
+        :param loss_scale: static loss scale, see DisjointClassModel.define_forward_pass()
         """
-        super(GridsDisjointClassifier, self).__init__(name, n_classes, learning_rate)
+        if precision not in ('float32', 'mixed'):
+            log.error("precision can only be 'float32' or 'mixed'")
+            raise ValueError
+        if rotation_bank is not None and augmentation != 'rotation':
+            log.warning("The rotation bank is ignored with the '{}' augmentation".format(
+                augmentation))
+            rotation_bank = None
+        cache_key = None
+        if function_cache is not None:
+            bank_key = None
+            if rotation_bank is not None:
+                bank_key = (rotation_bank.tables.shape, rotation_bank.cube_symmetries_only,
+                            hashlib.sha1(np.ascontiguousarray(rotation_bank.tables)).hexdigest())
+            cache_key = function_cache.make_key(network=network, grid_size=grid_size,
+                                                n_channels=n_channels,
+                                                minibatch_size=minibatch_size,
+                                                n_classes=n_classes, learning_rate=learning_rate,
+                                                augmentation=augmentation,
+                                                max_translation=max_translation,
+                                                translation_mode=translation_mode,
+                                                rotation_bank=bank_key, precision=precision,
+                                                loss_scale=loss_scale)
+        super(GridsDisjointClassifier, self).__init__(name, n_classes, learning_rate,
+                                                      function_cache=function_cache,
+                                                      cache_key=cache_key)
         self.minibatch_size = minibatch_size
 
-        # define the model inputs
-        grids = T.TensorType(floatX, (False,) * 5)()
+        # define the model inputs, the mini-batch dimension is left variable, e.g. for a smaller
+        # last mini-batch
+        self.input_dtype = 'float16' if precision == 'mixed' else floatX
+        grids = T.TensorType(self.input_dtype, (False,) * 5)()
         input_layer = lasagne.layers.InputLayer(
-            shape=(self.minibatch_size, n_channels, grid_size, grid_size, grid_size),
+            shape=(None, n_channels, grid_size, grid_size, grid_size),
             input_var=grids)
-        rotated_grids = GridRotationLayer(incoming=input_layer, grid_side=grid_size,
-                                          n_channels=n_channels)
+        if augmentation == 'rotation':
+            if rotation_bank is None:
+                rotated_grids = GridRotationLayer(incoming=input_layer, grid_side=grid_size,
+                                                  n_channels=n_channels)
+            else:
+                rotated_grids = GridRotationLayer(incoming=input_layer, grid_side=grid_size,
+                                                  n_channels=n_channels,
+                                                  interpolation='nearest',
+                                                  index_bank=rotation_bank)
+        elif augmentation == 'cube':
+            rotated_grids = GridSymmetryLayer(incoming=input_layer, grid_side=grid_size,
+                                              n_channels=n_channels,
+                                              max_translation=max_translation,
+                                              translation_mode=translation_mode)
+        elif augmentation == 'none':
+            rotated_grids = input_layer
+        else:
+            log.error("augmentation can only be 'rotation', 'cube' or 'none'")
+            raise ValueError
+        if precision == 'mixed':
+            rotated_grids = lasagne.layers.ExpressionLayer(rotated_grids,
+                                                           lambda x: T.cast(x, floatX))
 
         # apply the network to the preprocessed input
         self.output_layers, self.penalty = network(rotated_grids,
@@ -197,4 +513,128 @@ class GridsDisjointClassifier(DisjointClassModel):
                                                    last_nonlinearity=lasagne.nonlinearities.sigmoid)
         self.define_forward_pass(input_vars=[grids],
                                  output_layer=self.output_layers,
-                                 penalty=self.penalty)
+                                 penalty=self.penalty,
+                                 accumulation_steps=accumulation_steps,
+                                 loss_scale=loss_scale)
+
+
+class SparseDisjointClassifier(DisjointClassModel):
+    """
+    SparseDisjointClassifier extends the DisjointClassModel.
+    It allows for a sample to be in multiple classes at once.
+    Instead of dense grids, its inputs are the occupied voxels of the proteins in the mini-batch,
+    together with the neighbor and children maps of the sites on each resolution level, as
+    provided by the EnzymesSparseGridFeeder (see protfun.utils.sparse_voxels.build_sparse_inputs).
+    It must be used with a sparse network, e.g. protfun.networks.sparse_network. The grids are
+    augmented by the data feeder, on the voxel coordinates.
+    """
+
+    def __init__(self, name, n_classes, network, n_channels, n_levels, learning_rate=1e-4,
+                 function_cache=None, accumulation_steps=1):
+        """
+        :param name: name of the model, used by external mechanisms for saving training history etc.
+        :param n_classes: total number of different classes for the classification.
+        :param network: sparse neural network function which should be applied on the inputs
+        :param n_channels: number of channels of the occupied voxels
+        :param n_levels: number of resolution levels of the sparse inputs
+        :param learning_rate: initial learning rate
+        :param function_cache: (optional) a FunctionCache, see GridsDisjointClassifier
+        :param accumulation_steps: see DisjointClassModel.define_forward_pass()
+        """
+        cache_key = None
+        if function_cache is not None:
+            cache_key = function_cache.make_key(network=network, n_channels=n_channels,
+                                                n_levels=n_levels, n_classes=n_classes,
+                                                learning_rate=learning_rate, model='sparse')
+        super(SparseDisjointClassifier, self).__init__(name, n_classes, learning_rate,
+                                                       function_cache=function_cache,
+                                                       cache_key=cache_key)
+        self.input_dtype = floatX
+
+        # define the model inputs, in the order of build_sparse_inputs
+        features = T.matrix('features')
+        neighbors = [T.imatrix('neighbors_{}'.format(level)) for level in range(n_levels)]
+        children = [T.imatrix('children_{}'.format(level)) for level in range(1, n_levels)]
+        segments = T.ivector('segments')
+        counts = T.vector('counts')
+        sparse_input = {
+            'features': lasagne.layers.InputLayer(shape=(None, n_channels), input_var=features),
+            'neighbors': [lasagne.layers.InputLayer(shape=(None, 27), input_var=var)
+                          for var in neighbors],
+            'children': [lasagne.layers.InputLayer(shape=(None, 8), input_var=var)
+                         for var in children],
+            'segments': lasagne.layers.InputLayer(shape=(None,), input_var=segments),
+            'counts': lasagne.layers.InputLayer(shape=(None,), input_var=counts)}
+        input_vars = [features, neighbors[0]]
+        for level in range(1, n_levels):
+            input_vars += [children[level - 1], neighbors[level]]
+        input_vars += [segments, counts]
+
+        # apply the network to the sparse input
+        self.output_layers, self.penalty = network(sparse_input,
+                                                   n_outputs=n_classes,
+                                                   last_nonlinearity=lasagne.nonlinearities.sigmoid)
+        self.define_forward_pass(input_vars=input_vars,
+                                 output_layer=self.output_layers,
+                                 penalty=self.penalty,
+                                 accumulation_steps=accumulation_steps)
+
+
+class GraphDisjointClassifier(DisjointClassModel):
+    """
+    GraphDisjointClassifier extends the DisjointClassModel.
+    It allows for a sample to be in multiple classes at once.
+    Instead of grids, its inputs are the atoms of the proteins in the mini-batch together with
+    the edges of their radius graph, as provided by the EnzymesMolDataFeeder in graph mode
+    (see protfun.utils.radius_graph.build_graph_inputs). It must be used with a graph network,
+    e.g. protfun.networks.graph_network. As the graph networks only see the distances between
+    atoms, the model is invariant to rotations and no augmentation is needed.
+    """
+
+    def __init__(self, name, n_classes, network, n_atom_features=2, radius=4.5,
+                 learning_rate=1e-4, function_cache=None, accumulation_steps=1):
+        """
+        :param name: name of the model, used by external mechanisms for saving training history etc.
+        :param n_classes: total number of different classes for the classification.
+        :param network: graph neural network function which should be applied on the inputs
+        :param n_atom_features: number of features of each atom
+        :param radius: the cutoff radius the radius graphs are built with
+        :param learning_rate: initial learning rate
+        :param function_cache: (optional) a FunctionCache, see GridsDisjointClassifier
+        :param accumulation_steps: see DisjointClassModel.define_forward_pass()
+        """
+        cache_key = None
+        if function_cache is not None:
+            cache_key = function_cache.make_key(network=network, n_atom_features=n_atom_features,
+                                                radius=radius, n_classes=n_classes,
+                                                learning_rate=learning_rate, model='graph')
+        super(GraphDisjointClassifier, self).__init__(name, n_classes, learning_rate,
+                                                      function_cache=function_cache,
+                                                      cache_key=cache_key)
+        self.input_dtype = floatX
+
+        # define the model inputs, in the order of build_graph_inputs
+        atoms = T.matrix('atoms')
+        senders = T.ivector('senders')
+        receivers = T.ivector('receivers')
+        distances = T.vector('distances')
+        segments = T.ivector('segments')
+        counts = T.vector('counts')
+        graph_input = {
+            'atoms': lasagne.layers.InputLayer(shape=(None, n_atom_features), input_var=atoms),
+            'senders': lasagne.layers.InputLayer(shape=(None,), input_var=senders),
+            'receivers': lasagne.layers.InputLayer(shape=(None,), input_var=receivers),
+            'distances': lasagne.layers.InputLayer(shape=(None,), input_var=distances),
+            'segments': lasagne.layers.InputLayer(shape=(None,), input_var=segments),
+            'counts': lasagne.layers.InputLayer(shape=(None,), input_var=counts)}
+        input_vars = [atoms, senders, receivers, distances, segments, counts]
+
+        # apply the network to the graph input
+        self.output_layers, self.penalty = network(graph_input,
+                                                   n_outputs=n_classes,
+                                                   last_nonlinearity=lasagne.nonlinearities.sigmoid,
+                                                   radius=radius)
+        self.define_forward_pass(input_vars=input_vars,
+                                 output_layer=self.output_layers,
+                                 penalty=self.penalty,
+                                 accumulation_steps=accumulation_steps)
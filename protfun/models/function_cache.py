@@ -0,0 +1,169 @@
+import cPickle
+import hashlib
+import inspect
+import os
+import sys
+import threading
+
+import theano
+
+from protfun.layers.conv_layers import get_conv_backend
+from protfun.utils.log import get_logger
+
+log = get_logger("function_cache")
+
+# the hash of the sources of the protfun package, computed once per process
+_package_hash = None
+
+
+def package_sources_hash():
+    """
+    Hashes the source files of the whole protfun package. The compiled graphs do not only
+    depend on the network function, but also on the helper builders and the layers it uses.
+
+    :return: a hex string
+    """
+    global _package_hash
+    if _package_hash is None:
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        sha1 = hashlib.sha1()
+        for root, dirs, files in os.walk(package_dir):
+            dirs.sort()
+            for filename in sorted(files):
+                if filename.endswith('.py'):
+                    file_path = os.path.join(root, filename)
+                    sha1.update(os.path.relpath(file_path, package_dir))
+                    with open(file_path, 'rb') as f:
+                        sha1.update(f.read())
+        _package_hash = sha1.hexdigest()
+    return _package_hash
+
+
+class FunctionCache(object):
+    """
+    FunctionCache persists compiled Theano functions on disk, so that a model with the same
+    network, input shapes and hyperparameters does not have to be compiled again (for the larger
+    networks the compilation takes minutes).
+
+    A compiled function owns the shared variables it was compiled with. When a cached function is
+    loaded, the shared variables of the model's layers (the params) are swapped in, so that the
+    loaded function reads and updates the params of the current model, e.g. the ones loaded from a
+    params file. All other shared variables (optimizer state, random streams) are the function's
+    own.
+
+    Usage::
+        >>> cache = FunctionCache(cache_dir="data/misc/compiled")
+        >>> key = FunctionCache.make_key(network=standard_network, grid_size=64, n_channels=1,
+        >>>                              minibatch_size=8, n_classes=2)
+        >>> fn = cache.load(key, 'validation_function', params)
+        >>> if fn is None:
+        >>>     fn = theano.function(...)
+        >>>     cache.save(key, 'validation_function', fn, params)
+    """
+
+    def __init__(self, cache_dir):
+        """
+        :param cache_dir: directory in which the compiled functions are persisted
+        """
+        self.cache_dir = cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    @staticmethod
+    def make_key(network, **params):
+        """
+        Computes the key of a compiled model. Besides the given parameters, the key includes the
+        name and source code of the network function, a hash of the sources of the whole protfun
+        package (layers, helper builders), the convolution backend and the Theano version and
+        configuration, so that a function is never reused for changed code or a different
+        device.
+
+        :param network: the network function of the model
+        :param params: everything else the compiled graph depends on (shapes, hyperparameters)
+        :return: a hex string
+        """
+        try:
+            network_source = inspect.getsource(network)
+        except (IOError, TypeError):
+            network_source = None
+        params['network'] = (network.__name__, network_source)
+        params['package'] = package_sources_hash()
+        params['conv_backend'] = get_conv_backend()
+        params['theano'] = (theano.__version__, theano.config.floatX, theano.config.device,
+                            theano.config.optimizer, theano.config.mode)
+        return hashlib.sha1(repr(sorted(params.items()))).hexdigest()[:16]
+
+    def _path(self, key, name):
+        return os.path.join(self.cache_dir, "{}_{}.pickle".format(key, name))
+
+    def load(self, key, name, params):
+        """
+        :param key: the key of the model (see make_key)
+        :param name: name of the function, e.g. 'train_function'
+        :param params: list of the model's shared variables, in the same order as when the
+            function was saved
+        :return: the compiled function, using the given params, or None if it is not cached
+            (or can not be loaded)
+        """
+        path = self._path(key, name)
+        if not os.path.exists(path):
+            return None
+        # the cached graph was already optimized, only link it again
+        reoptimize = theano.config.reoptimize_unpickled_function
+        theano.config.reoptimize_unpickled_function = False
+        try:
+            with open(path, 'rb') as f:
+                function, param_indices, cached_params = cPickle.load(f)
+            if max(param_indices or [-1]) >= len(params) or not all(
+                    self._matches(cached, params[i])
+                    for i, cached in zip(param_indices, cached_params)):
+                log.warning("Cached {} does not match the model, compiling it".format(name))
+                return None
+            swap = {cached: params[i] for i, cached in zip(param_indices, cached_params)}
+            function = function.copy(swap=swap)
+        except Exception as e:
+            log.warning("Could not load the cached {} ({}), compiling it".format(name, e))
+            return None
+        finally:
+            theano.config.reoptimize_unpickled_function = reoptimize
+        log.info("Loaded the compiled {} from {}".format(name, path))
+        return function
+
+    @staticmethod
+    def _matches(cached, param):
+        """
+        :return: whether the shared variable param can be swapped in for the cached one, i.e.
+            both have the same type (dtype, broadcastable pattern) and shape
+        """
+        return cached.type == param.type and \
+            cached.get_value(borrow=True).shape == param.get_value(borrow=True).shape
+
+    def save(self, key, name, function, params):
+        """
+        Persists a compiled function. A failure to pickle the function is only logged.
+
+        :param key: the key of the model (see make_key)
+        :param name: name of the function, e.g. 'train_function'
+        :param function: the compiled Theano function
+        :param params: list of the model's shared variables
+        """
+        function_inputs = set(i.variable for i in function.maker.inputs)
+        param_indices = [i for i, p in enumerate(params) if p in function_inputs]
+        cached_params = [params[i] for i in param_indices]
+        path = self._path(key, name)
+        # unique temp file per thread, the rename is atomic
+        tmp_path = "{}.{}.tmp".format(path, threading.current_thread().ident)
+        # the graphs of the deeper networks exceed the default recursion limit when pickled
+        recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(recursion_limit, 50000))
+        try:
+            with open(tmp_path, 'wb') as f:
+                cPickle.dump((function, param_indices, cached_params), f,
+                             protocol=cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+        except Exception as e:
+            log.warning("Could not cache the compiled {} ({})".format(name, e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        finally:
+            sys.setrecursionlimit(recursion_limit)
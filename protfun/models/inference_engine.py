@@ -0,0 +1,478 @@
+import BaseHTTPServer
+import SocketServer
+import Queue
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import theano
+import lasagne
+
+from protfun.config import get_config
+from protfun.data_management.preprocess import EnzymeDataProcessor, PDBDownloader
+from protfun.models.disjoint_class_model import GridsDisjointClassifier
+from protfun.models.function_cache import FunctionCache
+from protfun.networks import get_network
+from protfun.utils.data_utils import pyramid_grid_filename
+from protfun.utils.np_utils import block_average, crop_around_box, load_bounding_box
+from protfun.utils.log import get_logger
+
+log = get_logger("inference_engine")
+floatX = theano.config.floatX
+
+
+class _PendingPrediction(object):
+    """
+    The prediction of a single protein, which is filled in by the prediction worker.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.scores = None
+        self.error = None
+        self.done = threading.Event()
+
+    def resolve(self, scores):
+        self.scores = scores
+        self.done.set()
+
+    def fail(self, error):
+        self.error = error
+        self.done.set()
+
+
+class InferenceEngine(object):
+    """
+    InferenceEngine scores proteins with a trained GridsDisjointClassifier, without a data
+    manager, a data split or a trainer. The model configuration (config.yaml) and the checkpoint
+    (params_*.npz) are loaded and the prediction function is compiled once, after which
+    arbitrary proteins can be scored, given by PDB codes or PDB files.
+
+    The proteins are processed in a pipeline:
+        * the PDB files of unknown codes are downloaded concurrently (or taken from a PDB mirror)
+        * a pool of worker threads loads the grids of already processed proteins (from the data
+          set of the model, or from the cache of the engine), or pre-processes the PDB files
+          into grids, which are cached under the work directory
+        * each ready grid is queued to a single prediction worker, which collects the queued
+          grids into micro-batches of up to minibatch_size, waiting at most max_latency seconds
+          for a micro-batch to fill up
+    so the pre-processing of the next proteins overlaps with the prediction of the previous
+    ones, and the proteins of concurrent requests (see serve()) share the micro-batches.
+
+    Usage::
+        >>> engine = InferenceEngine(model_dir="data/models/my_model",
+        >>>                          params_file="params_80ep_best.npz")
+        >>> results, failed = engine.predict(['1A0A', '/path/to/new_protein.pdb'])
+        >>> results['1A0A']['scores']
+        >>> engine.close()
+    """
+
+    def __init__(self, model_dir, params_file, minibatch_size=None, work_dir=None, n_workers=4,
+                 max_latency=0.05, pdb_mirror=None, threshold=0.5):
+        """
+        :param model_dir: the directory of the trained model, containing its config.yaml
+        :param params_file: the checkpoint in the model directory to load, e.g.
+            'params_80ep_best.npz'
+        :param minibatch_size: max. size of the prediction micro-batches, by default the
+            training minibatch_size of the model
+        :param work_dir: (optional) where the downloaded and the pre-processed proteins are
+            cached, by default <model_dir>/inference
+        :param n_workers: number of threads that download, load and pre-process the proteins
+        :param max_latency: max. time in seconds that the prediction worker waits for more
+            proteins before it predicts a micro-batch that is not full
+        :param pdb_mirror: (optional) local PDB mirror, see PDBDownloader. By default the
+            pdb_mirror of the model's config is used, if any.
+        :param threshold: score above which a protein is predicted to be in a class
+        """
+        self.config = get_config(os.path.join(model_dir, 'config.yaml'))
+        proteins_config = self.config['proteins']
+        training_config = self.config['training']
+        if training_config['network'] in ['sparse_network', 'graph_network']:
+            log.error("The inference engine only supports grid networks, not {}".format(
+                training_config['network']))
+            raise ValueError
+
+        self.n_classes = proteins_config['n_classes']
+        self.n_channels = proteins_config['n_channels']
+        self.grid_size = proteins_config['grid_side']
+        self.level_side = proteins_config.get('grid_level') or self.grid_size
+        # the side of the grids the model was trained on, recorded by train_enz_from_grids when
+        # the grids were cropped
+        self.input_side = proteins_config.get('input_side', self.level_side)
+        self.minibatch_size = minibatch_size or training_config['minibatch_size']
+        self.max_latency = max_latency
+        self.threshold = threshold
+        self.class_names = self._class_names()
+
+        # the proteins of the data set of the model are already processed
+        data_dir = self.config['data']['dir']
+        self.data_processed_dir = os.path.join(data_dir, "processed")
+        self.work_dir = work_dir or os.path.join(model_dir, "inference")
+        self.dirs = {'raw': os.path.join(self.work_dir, "raw"),
+                     'processed': os.path.join(self.work_dir, "processed"),
+                     'uploads': os.path.join(self.work_dir, "uploads")}
+        for d in self.dirs.values():
+            if not os.path.exists(d):
+                os.makedirs(d)
+        self.downloader = PDBDownloader(base_dir=self.dirs['raw'], n_workers=n_workers,
+                                        mirror=pdb_mirror or self.config['data'].get('pdb_mirror'))
+        self.processor = EnzymeDataProcessor(
+            from_dir=self.dirs['raw'], target_dir=self.dirs['processed'], protein_codes=dict(),
+            grid_size=self.grid_size, add_sidechain_channels=self.n_channels != 1,
+            grid_pyramid=[self.level_side] if self.level_side != self.grid_size else None)
+        self._grid_lock = threading.Lock()
+        self._protein_locks = defaultdict(threading.Lock)
+        self._protein_locks_lock = threading.Lock()
+
+        # build the model and compile (or load from the function cache) its prediction function
+        function_cache = None
+        if training_config.get('function_cache', True):
+            function_cache = FunctionCache(os.path.join(data_dir, "misc", "compiled"))
+        model_dir = os.path.normpath(model_dir)
+        self.model = GridsDisjointClassifier(name=os.path.basename(model_dir),
+                                             n_classes=self.n_classes,
+                                             network=get_network(training_config['network']),
+                                             grid_size=self.input_side,
+                                             n_channels=self.n_channels,
+                                             minibatch_size=self.minibatch_size,
+                                             learning_rate=training_config['learning_rate'],
+                                             augmentation='none',
+                                             function_cache=function_cache,
+                                             precision=training_config.get('precision',
+                                                                           'float32'))
+        # the params are loaded from the model directory itself (as ModelMonitor.load_model()
+        # does), which need not be under <data_dir>/models
+        with np.load(os.path.join(model_dir, params_file)) as f:
+            param_values = [f['arr_%d' % i] for i in range(len(f.files))]
+        lasagne.layers.set_all_param_values(self.model.get_output_layers(), param_values,
+                                            trainable=True)
+        self.prediction_function = self.model.get_prediction_function()
+
+        self._queue = Queue.Queue()
+        self._pool = ThreadPool(processes=n_workers)
+        self._worker = threading.Thread(target=self._predict_loop, name="prediction_worker")
+        self._worker.daemon = True
+        self._worker.start()
+        log.info("Inference engine for {} ready, input grids of side {}".format(
+            self.model.get_name(), self.input_side))
+
+    def _class_names(self):
+        """
+        :return: the names of the predicted classes, i.e. the columns of the labels (see
+            LabelFactory), if they can be derived from the enzyme_trees of the config, otherwise
+            None
+        """
+        depth = self.config['proteins']['prediction_depth']
+        trees = self.config['proteins'].get('enzyme_trees') or list()
+        names = sorted(set('.'.join(tree.split('.')[:depth]) for tree in trees
+                           if len(tree.split('.')) >= depth))
+        if len(names) != self.n_classes:
+            return None
+        return names
+
+    def predict(self, proteins, timeout=None, allow_files=True):
+        """
+        Scores the given proteins. Blocks until all of them are scored (or failed).
+
+        :param proteins: list of PDB codes (e.g. '1A0A') and / or paths to PDB files
+        :param timeout: (optional) max. time in seconds to wait for the predictions
+        :param allow_files: whether proteins may be paths to local PDB files. Must be False for
+            untrusted input (e.g. HTTP requests), then only PDB codes are accepted.
+        :return: a tuple (results, failed): results is a dict protein -> {'scores': list of the
+            sigmoid outputs for each class, 'classes': the classes with a score above the
+            threshold}, failed is a dict protein -> reason for the proteins that could not be
+            scored. Proteins given by a file are named by the path.
+        """
+        if isinstance(proteins, basestring):
+            log.error("proteins must be a list of PDB codes or files, not a single string")
+            raise ValueError
+        requests = list()
+        failed = dict()
+        codes = set()
+        for protein in sorted(set(proteins)):
+            if allow_files and os.path.isfile(protein):
+                requests.append((protein, protein, self._file_key(protein)))
+            elif len(protein) == 4 and protein.isalnum():
+                code = protein.upper()
+                requests.append((protein, None, code))
+                if self._find_processed(code) is None:
+                    codes.add(code)
+            else:
+                failed[protein] = "neither a PDB code nor an existing PDB file" if allow_files \
+                    else "not a PDB code"
+
+        # download the PDB files of the unknown codes, all at once
+        if len(codes) > 0:
+            _, not_downloaded = self.downloader.download(sorted(codes))
+            for name, _, key in list(requests):
+                if key in not_downloaded:
+                    failed[name] = "the PDB file could not be downloaded"
+                    requests.remove((name, None, key))
+
+        # load or pre-process the grids in the worker pool, each ready grid is queued for the
+        # prediction worker right away
+        pending = list()
+        for name, pdb_file, key in requests:
+            prediction = _PendingPrediction(name)
+            pending.append(prediction)
+            self._pool.apply_async(self._prepare, (prediction, pdb_file, key))
+
+        results = dict()
+        deadline = None if timeout is None else time.time() + timeout
+        for prediction in pending:
+            prediction.done.wait(None if deadline is None else max(0., deadline - time.time()))
+            if not prediction.done.is_set():
+                failed[prediction.name] = "timed out"
+            elif prediction.error is not None:
+                failed[prediction.name] = prediction.error
+            else:
+                results[prediction.name] = self._format(prediction.scores)
+        return results, failed
+
+    def predict_pdb_contents(self, contents, timeout=None):
+        """
+        Scores proteins given by the contents of their PDB files, e.g. uploaded to the server.
+
+        :param contents: dict name -> contents of the PDB file
+        :param timeout: see predict()
+        :return: see predict(), with the proteins named by the given names. Names with the same
+            contents share the prediction, but each of them gets an answer.
+        """
+        paths = defaultdict(list)
+        for name, content in contents.items():
+            if isinstance(content, unicode):
+                content = content.encode('utf-8')
+            path = os.path.join(self.dirs['uploads'],
+                                hashlib.sha1(content).hexdigest() + '.pdb')
+            if not os.path.exists(path):
+                tmp_path = "{}.{}.tmp".format(path, threading.current_thread().ident)
+                with open(tmp_path, 'w') as f:
+                    f.write(content)
+                os.rename(tmp_path, path)
+            paths[path].append(name)
+        results, failed = self.predict(paths.keys(), timeout=timeout)
+        return ({name: r for p, r in results.items() for name in paths[p]},
+                {name: r for p, r in failed.items() for name in paths[p]})
+
+    def close(self):
+        """
+        Stops the worker threads of the engine.
+        """
+        self._pool.close()
+        self._pool.join()
+        self._queue.put(None)
+        self._worker.join()
+
+    @staticmethod
+    def _file_key(pdb_file):
+        """
+        :return: the cache key of a PDB file, by its contents (so that a changed file is not
+            mistaken for a cached one)
+        """
+        with open(pdb_file, 'rb') as f:
+            return 'FILE_' + hashlib.sha1(f.read()).hexdigest()[:16]
+
+    def _find_processed(self, key):
+        """
+        :return: the directory with the grid of an already processed protein, or None
+        """
+        for processed_dir in [self.data_processed_dir, self.dirs['processed']]:
+            prot_dir = os.path.join(processed_dir, key)
+            if os.path.exists(os.path.join(prot_dir, "grid.memmap")):
+                return prot_dir
+        return None
+
+    def _prepare(self, prediction, pdb_file, key):
+        """
+        Runs in the worker pool: loads (or pre-processes) the grid of a protein, brings it to the
+        input shape of the model and queues it for the prediction worker.
+        """
+        try:
+            with self._protein_locks_lock:
+                protein_lock = self._protein_locks[key]
+            # the same new protein may be requested concurrently, it is processed only once
+            with protein_lock:
+                prot_dir = self._find_processed(key)
+                if prot_dir is None:
+                    if pdb_file is None:
+                        pdb_file = self.downloader.target_path(key)
+                    prot_dir = os.path.join(self.dirs['processed'], key)
+                    if self.processor.process_pdb_file(pdb_file, prot_dir,
+                                                       grid_lock=self._grid_lock) is None:
+                        prediction.fail("the PDB file could not be pre-processed")
+                        return
+            self._queue.put((self._load_input(prot_dir), prediction))
+        except Exception as e:
+            log.exception("Preparing {} failed".format(prediction.name))
+            prediction.fail(str(e))
+
+    def _load_input(self, prot_dir):
+        """
+        Loads the grid of a processed protein like the EnzymesGridFeeder does: at the grid level
+        of the model, cropped around the protein to the input side of the model.
+
+        :return: the grid, shaped (1, n_channels, input_side, input_side, input_side)
+        """
+        level_file = os.path.join(prot_dir, pyramid_grid_filename(self.grid_size,
+                                                                  self.level_side))
+        if os.path.exists(level_file):
+            grid = np.memmap(level_file, mode='r', dtype=floatX).reshape(
+                (1, -1) + (self.level_side,) * 3)
+        else:
+            grid = np.memmap(os.path.join(prot_dir, "grid.memmap"), mode='r',
+                             dtype=floatX).reshape((1, -1) + (self.grid_size,) * 3)
+            grid = block_average(grid, self.grid_size // self.level_side)
+        if self.input_side != self.level_side:
+            # the same (full resolution) box as in the training, see EnzymesGridFeeder
+            box = load_bounding_box(prot_dir, self.grid_size, self.level_side, dtype=floatX)
+            grid = crop_around_box(grid, box, self.input_side)
+        return np.array(grid[:, grid.shape[1] - self.n_channels:], dtype=self.model.input_dtype)
+
+    def _predict_loop(self):
+        """
+        The prediction worker: predicts the queued grids in micro-batches, until the engine is
+        closed.
+        """
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.time() + self.max_latency
+            while len(batch) < self.minibatch_size:
+                try:
+                    item = self._queue.get(timeout=max(0., deadline - time.time()))
+                except Queue.Empty:
+                    break
+                if item is None:
+                    # predict the collected grids before stopping
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+
+            grids = np.concatenate([grid for grid, _ in batch])
+            try:
+                scores = np.asarray(self.prediction_function(grids)).reshape(
+                    (len(batch), self.n_classes))
+            except Exception as e:
+                log.exception("Prediction of a micro-batch failed")
+                for _, prediction in batch:
+                    prediction.fail(str(e))
+                continue
+            for (_, prediction), protein_scores in zip(batch, scores):
+                prediction.resolve(protein_scores)
+
+    def _format(self, scores):
+        """
+        :return: the JSON serializable result of a protein
+        """
+        positive = [i for i, score in enumerate(scores) if score > self.threshold]
+        if self.class_names is not None:
+            positive = [self.class_names[i] for i in positive]
+        return {'scores': [float(score) for score in scores], 'classes': positive}
+
+
+class InferenceRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Handles the HTTP requests of the inference server (see serve()):
+        GET /health - the model name, its classes and the input side of the grids
+        POST /predict - scores the proteins in the JSON body
+            {"proteins": ["1A0A", ...], "pdb_files": {"name": "<contents of a PDB file>", ...}}
+            Only PDB codes are accepted in "proteins", the paths of local files are not, so
+            clients can not read or probe files on the server.
+            and responds with {"results": {protein: {"scores": [...], "classes": [...]}},
+                               "failed": {protein: reason}}
+    The engine is taken from the server.
+    """
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/health':
+            self._respond(404, {'error': 'unknown path {}'.format(self.path)})
+            return
+        self._respond(200, {'model': self.server.engine.model.get_name(),
+                            'classes': self.server.engine.class_names,
+                            'input_side': self.server.engine.input_side})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/predict':
+            self._respond(404, {'error': 'unknown path {}'.format(self.path)})
+            return
+        try:
+            length = int(self.headers.getheader('content-length', 0))
+            body = json.loads(self.rfile.read(length))
+            proteins = body.get('proteins', list())
+            pdb_files = body.get('pdb_files', dict())
+        except (ValueError, AttributeError):
+            self._respond(400, {'error': 'the body must be a JSON object'})
+            return
+        if not isinstance(proteins, list) or \
+                not all(isinstance(p, basestring) for p in proteins):
+            self._respond(400, {'error': '"proteins" must be a list of PDB codes'})
+            return
+        if not isinstance(pdb_files, dict) or \
+                not all(isinstance(c, basestring) for c in pdb_files.values()):
+            self._respond(400, {'error': '"pdb_files" must map names to PDB file contents'})
+            return
+
+        results, failed = self.server.engine.predict(proteins, allow_files=False)
+        if len(pdb_files) > 0:
+            file_results, file_failed = self.server.engine.predict_pdb_contents(pdb_files)
+            results.update(file_results)
+            failed.update(file_failed)
+        self._respond(200, {'results': results, 'failed': failed})
+
+    def _respond(self, status, content):
+        response = json.dumps(content)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        log.debug("{} - {}".format(self.address_string(), format % args))
+
+
+class _ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def serve(engine, host='127.0.0.1', port=8080):
+    """
+    Serves the inference engine over HTTP (see InferenceRequestHandler), until interrupted.
+    Every request is handled in its own thread, the proteins of concurrent requests are
+    predicted together in the micro-batches of the engine.
+
+    Usage::
+        >>> engine = InferenceEngine(model_dir="data/models/my_model",
+        >>>                          params_file="params_80ep_best.npz")
+        >>> serve(engine, port=8080)
+        $ curl -d '{"proteins": ["1A0A", "1A0B"]}' http://127.0.0.1:8080/predict
+
+    :param engine: the InferenceEngine
+    :param host: the interface to listen on, local only by default
+    :param port: the port to listen on
+    """
+    server = _ThreadedHTTPServer((host, port), InferenceRequestHandler)
+    server.engine = engine
+    log.info("Serving {} on http://{}:{}".format(engine.model.get_name(), host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        engine.close()
+
+
+if __name__ == "__main__":
+    import sys
+
+    # usage: python -m protfun.models.inference_engine <model_dir> <params_file> [port]
+    serve(InferenceEngine(model_dir=sys.argv[1], params_file=sys.argv[2]),
+          port=int(sys.argv[3]) if len(sys.argv) > 3 else 8080)
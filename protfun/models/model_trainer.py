@@ -1,24 +1,33 @@
+import copy
 import datetime
 import random
 import string
 import os
 import re
+import time
 import numpy as np
+import theano
 
 from protfun.utils import save_pickle
 from protfun.config import save_config
-from protfun.data_management.data_feed import EnzymesGridFeeder
+from protfun.data_management.data_feed import EnzymesGridFeeder, EnzymesSparseGridFeeder, \
+    EnzymesMolDataFeeder
 from protfun.data_management.data_manager import EnzymeDataManager
-from protfun.models import GridsDisjointClassifier
+from protfun.layers.grid_rotate_layer import RotationIndexBank
+from protfun.models import GridsDisjointClassifier, SparseDisjointClassifier, \
+    GraphDisjointClassifier
+from protfun.models.function_cache import FunctionCache
 from protfun.models.model_monitor import ModelMonitor
 from protfun.networks import get_network
-from protfun.utils.np_utils import pp_array
+from protfun.utils.np_utils import pp_array, CUBE_SYMMETRIES, apply_cube_symmetry
 from protfun.visualizer.netview import NetworkView
 from protfun.visualizer.progressview import ProgressView
 from protfun.utils.log import get_logger
 
 log = get_logger("model_trainer")
 
+floatX = theano.config.floatX
+
 
 class ModelTrainer(object):
     """
@@ -141,6 +150,10 @@ class ModelTrainer(object):
 
                 steps_before_validate += 1
 
+            # apply the gradients of the micro-batches left over at the end of the epoch
+            if hasattr(self.model, 'flush_gradients'):
+                self.model.flush_gradients()
+
             epoch_loss_means = np.mean(np.array(epoch_losses), axis=0)
             epoch_acc_means = np.mean(np.array(epoch_accs), axis=0)
             log.info("train: epoch {0} loss mean: {1} acc mean: {2}".format(e, epoch_loss_means,
@@ -218,6 +231,8 @@ class ModelTrainer(object):
         epoch_predictions = []
         epoch_targets = []
         proteins = []
+        minibatch_sizes = []
+        # every protein is evaluated exactly once, the last mini-batch may be smaller
         for prots, samples, targets in data_iter_function():
             output = self.model.validation_function(*(samples + targets))
             loss = output['loss']
@@ -230,31 +245,187 @@ class ModelTrainer(object):
             epoch_predictions.append(predictions)
             proteins.append(prots)
             epoch_targets.append(targets)
-
-        epoch_loss_means = np.mean(np.array(epoch_losses), axis=0)
-        epoch_acc_means = np.mean(np.array(epoch_accs), axis=0)
-        epoch_per_class_accs_means = np.mean(np.array(epoch_per_class_accs), axis=0)
+            minibatch_sizes.append(len(prots))
+
+        # the accuracies are weighted by the mini-batch sizes, the loss (a sum over the
+        # mini-batch) is reported per full mini-batch, as during training
+        weights = np.array(minibatch_sizes, dtype=np.float64)
+        epoch_loss_means = np.sum(np.array(epoch_losses), axis=0) / weights.sum() * \
+                           self.data_feeder.minibatch_size
+        epoch_acc_means = np.average(np.array(epoch_accs), axis=0, weights=weights)
+        epoch_per_class_accs_means = np.average(np.array(epoch_per_class_accs), axis=0,
+                                                weights=weights)
         log.info(
             "{0}: loss mean: {1} acc mean: {2}".format(mode, epoch_loss_means, epoch_acc_means))
         return epoch_loss_means, epoch_acc_means, epoch_per_class_accs_means, epoch_predictions, epoch_targets, proteins
 
-    def get_test_hidden_activations(self):
+    def test_time_augmentation(self, mode='test', n_rotations=24):
+        """
+        Tests the model with test-time augmentation: every protein is evaluated in n_rotations
+        fixed orientations (the first n_rotations rotations of the cube, starting with the
+        identity) and the sigmoid outputs are averaged over the orientations. The rotated copies
+        of the proteins are packed together into the mini-batches that are sent to the model.
+
+        :param mode: 'test' or 'val'
+        :param n_rotations: number of orientations per protein, between 1 and 24
+        :return: a dict with the accuracy, per class accuracies, predictions, targets and
+            proteins, as well as the throughput in proteins per second.
+        """
+        if not 1 <= n_rotations <= len(CUBE_SYMMETRIES):
+            log.error("n_rotations must be between 1 and {}".format(len(CUBE_SYMMETRIES)))
+            raise ValueError
+        if mode == 'test':
+            data_iter_function = self.data_feeder.iterate_test_data
+        elif mode == 'val':
+            data_iter_function = self.data_feeder.iterate_val_data
+        else:
+            log.error("Unknown mode {} when calling test_time_augmentation()".format(mode))
+            raise ValueError
+
+        predict = self.model.get_prediction_function()
+        symmetries = CUBE_SYMMETRIES[:n_rotations]
+        minibatch_size = self.data_feeder.minibatch_size
+        # how many proteins fit into a single mini-batch together with their rotated copies
+        prots_per_call = max(1, minibatch_size // n_rotations)
+
+        all_predictions = []
+        all_targets = []
+        proteins = []
+        elapsed = 0.0
+        for prots, samples, targets in data_iter_function():
+            grids = samples[0]
+            start = time.time()
+            for i in range(0, grids.shape[0], prots_per_call):
+                chunk = grids[i:i + prots_per_call]
+                packed = np.concatenate([apply_cube_symmetry(chunk, sym)[:, None]
+                                         for sym in symmetries], axis=1)
+                packed = packed.reshape((-1,) + chunk.shape[1:])
+                # with more rotations than minibatch_size, the copies of a single protein are
+                # split over several calls, so that no call is larger than a mini-batch
+                predictions = np.concatenate([predict(packed[j:j + minibatch_size])
+                                              for j in range(0, packed.shape[0],
+                                                             minibatch_size)])
+                all_predictions.append(
+                    predictions.reshape((chunk.shape[0], n_rotations, -1)).mean(axis=1))
+            elapsed += time.time() - start
+            all_targets.append(targets[0])
+            proteins += list(prots)
+
+        predictions = np.vstack(all_predictions)
+        targets = np.vstack(all_targets)
+        correct = np.equal(predictions > 0.5, targets)
+        result = {'n_rotations': n_rotations,
+                  'accuracy': np.mean(np.all(correct, axis=-1)),
+                  'per_class_accs': np.mean(correct, axis=0),
+                  'predictions': predictions,
+                  'targets': targets,
+                  'proteins': proteins,
+                  'proteins_per_sec': len(proteins) / max(elapsed, 1e-8)}
+        log.info("{0} with {1} rotations: acc mean: {2} proteins/s: {3:.2f}".format(
+            mode, n_rotations, result['accuracy'], result['proteins_per_sec']))
+        return result
+
+    def test_time_augmentation_report(self, mode='test', rotation_counts=(1, 4, 8, 24)):
+        """
+        Reports the throughput-vs-accuracy trade-off of test-time augmentation for different
+        numbers of rotations. The report is saved as tta_report.pickle under the model directory.
+
+        :param mode: 'test' or 'val'
+        :param rotation_counts: the numbers of rotations per protein to evaluate
+        :return: dict with keys the rotation counts and values the accuracy and throughput
         """
-        Get example activations of all hidden layers in the current model by running a forward
+        report = dict()
+        for n_rotations in rotation_counts:
+            result = self.test_time_augmentation(mode=mode, n_rotations=n_rotations)
+            report[n_rotations] = {'accuracy': result['accuracy'],
+                                   'per_class_accs': result['per_class_accs'],
+                                   'proteins_per_sec': result['proteins_per_sec']}
+        for n_rotations in rotation_counts:
+            log.info("TTA {0:>2} rotations: accuracy {1:.4f}, {2:.2f} proteins/s".format(
+                n_rotations, report[n_rotations]['accuracy'],
+                report[n_rotations]['proteins_per_sec']))
+        save_pickle(os.path.join(self.monitor.get_model_dir(), "tta_report.pickle"), report)
+        return report
+
+    def get_test_hidden_activations(self, layers=None):
+        """
+        Get example activations of the hidden layers in the current model by running a forward
         pass on a single mini-batch from the test set.
 
+        :param layers: (optional) the layers whose activations are computed, see
+            DisjointClassModel.get_layers(). If None, the activations of all layers are returned.
         :return: protein codes, targets (ground truths), activations, predictions
             for the single mini-batch from the test set that was used.
         """
         for prots, samples, targets in self.data_feeder.iterate_test_data():
             # do just a single minibatch
-            output = self.model.get_hidden_activations(*samples)
-            return prots, targets, output[:-1], output[-1]
+            if layers is None:
+                output = self.model.get_hidden_activations(*samples)
+                return prots, targets, output[:-1], output[-1]
+            activations = self.model.get_activation_function(layers)(*samples)
+            predictions = self.model.get_prediction_function()(*samples)
+            return prots, targets, activations, predictions
+        log.error("The test set is empty, no activations can be computed")
+        raise ValueError
+
+    def stream_test_hidden_activations(self, out_dir, layers=None, n_minibatches=1):
+        """
+        Saves the activations of the hidden layers for the first n_minibatches of the test set,
+        one layer at a time: for each layer, a function computing only that layer is compiled,
+        applied on all minibatches and the activations are written directly into
+        <out_dir>/<index>_<layer name>.npy. Thus only the activations of a single layer and
+        minibatch are ever held in memory.
+
+        :param out_dir: directory in which the .npy files are written
+        :param layers: (optional) the layers to be saved, see DisjointClassModel.get_layers().
+            All layers if None.
+        :param n_minibatches: number of test minibatches to compute the activations for
+        :return: protein codes, targets (ground truths), predictions and a dict with keys the
+            layer indices and values the paths of the .npy files
+        """
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+
+        # the inputs are small compared to the activations, keep them for all layers
+        minibatches = list()
+        for minibatch in self.data_feeder.iterate_test_data():
+            minibatches.append(minibatch)
+            if len(minibatches) == n_minibatches:
+                break
+        if len(minibatches) == 0:
+            log.error("The test set is empty, no activations can be computed")
+            raise ValueError
+        prots = [p for minibatch_prots, _, _ in minibatches for p in minibatch_prots]
+        targets = [np.vstack([t[i] for _, _, t in minibatches])
+                   for i in range(len(minibatches[0][2]))]
+        predict = self.model.get_prediction_function()
+        predictions = np.vstack([predict(*samples) for _, samples, _ in minibatches])
+
+        layer_files = dict()
+        for index, layer in self.model.get_layers(layers):
+            activation_function = self.model.get_activation_function([index], keep=False)
+            layer_file = os.path.join(out_dir, "{:02d}_{}.npy".format(
+                index, layer.name or type(layer).__name__))
+            activations = None
+            offset = 0
+            for _, samples, _ in minibatches:
+                output = activation_function(*samples)[0]
+                if activations is None:
+                    activations = np.lib.format.open_memmap(
+                        layer_file, mode='w+', dtype=output.dtype,
+                        shape=(len(prots),) + output.shape[1:])
+                activations[offset:offset + output.shape[0]] = output
+                offset += output.shape[0]
+            activations.flush()
+            del activations
+            layer_files[index] = layer_file
+            log.info("Saved the activations of layer {} to {}".format(index, layer_file))
+        return prots, targets, predictions, layer_files
 
 
 def _build_enz_feeder_model_trainer(config, model_name=None, start_epoch=0,
                                     force_download=False, force_memmaps=False,
-                                    force_grids=False, force_split=False):
+                                    force_grids=False, force_split=False, split_policy=None):
     """
     Helper function, that constructs a GridsDisjointClassifer model given a config, and constructs
     the respective EnzymesGridFeeder (provides the minibatches from the train / test / val. sets)
@@ -267,6 +438,7 @@ def _build_enz_feeder_model_trainer(config, model_name=None, start_epoch=0,
     :param force_memmaps: see EnzymeDataManager
     :param force_grids: see EnzymeDataManager
     :param force_split: see EnzymeDataManager
+    :param split_policy: see EnzymeDataManager, overrides the one in the config if given
     :return: data_feeder, model, model_trainer
     """
     add_sidechain_channels = not (config['proteins']['n_channels'] == 1)
@@ -279,15 +451,80 @@ def _build_enz_feeder_model_trainer(config, model_name=None, start_epoch=0,
                                      force_split=force_split,
                                      grid_size=config['proteins']['grid_side'],
                                      split_strategy=config['training']['split_strategy'],
-                                     add_sidechain_channels=add_sidechain_channels)
-
-    data_feeder = EnzymesGridFeeder(data_manager=data_manager,
-                                    minibatch_size=config['training']['minibatch_size'],
-                                    init_samples_per_class=config['training'][
-                                        'init_samples_per_class'],
-                                    prediction_depth=config['proteins']['prediction_depth'],
-                                    num_channels=config['proteins']['n_channels'],
-                                    grid_size=config['proteins']['grid_side'])
+                                     add_sidechain_channels=add_sidechain_channels,
+                                     grid_pyramid=config['proteins'].get('grid_pyramid'),
+                                     sparse_threshold=config['proteins'].get('sparse_threshold'),
+                                     incremental=config['data'].get('incremental', True),
+                                     collect_garbage=config['data'].get('collect_garbage',
+                                                                        False),
+                                     split_materialization=config['data'].get(
+                                         'split_materialization', 'link'),
+                                     split_policy=split_policy or config['training'].get(
+                                         'split_policy', 'confirm'),
+                                     split_seed=config['training'].get('split_seed'),
+                                     n_folds=config['training'].get('n_folds'),
+                                     pdb_mirror=config['data'].get('pdb_mirror'),
+                                     download_workers=config['data'].get('download_workers', 8),
+                                     ec2pdb_url=config['data'].get('ec2pdb_url'),
+                                     ec2pdb_mapping=config['data'].get('ec2pdb_mapping'))
+
+    # 'rotation' and 'cube' augment in the graph, 'cube_loader' augments in the data feeder
+    augmentation = config['training'].get('augmentation', 'rotation')
+    max_translation = config['training'].get('max_translation', 2)
+    # 'roll' wraps the translated grids around the borders, 'pad' fills them with zeros
+    translation_mode = config['training'].get('translation_mode', 'roll')
+    # 'mixed' feeds and augments the grids in float16
+    precision = config['training'].get('precision', 'float32')
+    # the sparse network is fed with the occupied voxels instead of the grids, which are always
+    # augmented in the data feeder
+    sparse = config['training']['network'] == 'sparse_network'
+    # the graph network is fed with the atoms and their radius graph, built in the data feeder
+    graph = config['training']['network'] == 'graph_network'
+    graph_radius = config['training'].get('graph_radius', 4.5)
+    if graph and config['proteins']['n_channels'] != 1:
+        # with side chain channels, the atoms are stored per channel and not as a single molecule
+        log.error("The graph_network can only be used with n_channels: 1")
+        raise ValueError
+    if graph:
+        data_feeder = EnzymesMolDataFeeder(
+            data_manager=data_manager,
+            minibatch_size=config['training']['minibatch_size'],
+            init_samples_per_class=config['training']['init_samples_per_class'],
+            prediction_depth=config['proteins']['prediction_depth'],
+            fold=config['training'].get('fold'),
+            graph=True,
+            radius=graph_radius,
+            max_neighbors=config['training'].get('max_neighbors', 16))
+    elif sparse:
+        data_feeder = EnzymesSparseGridFeeder(
+            data_manager=data_manager,
+            minibatch_size=config['training']['minibatch_size'],
+            init_samples_per_class=config['training']['init_samples_per_class'],
+            prediction_depth=config['proteins']['prediction_depth'],
+            num_channels=config['proteins']['n_channels'],
+            grid_size=config['proteins']['grid_side'],
+            n_levels=config['training'].get('sparse_levels', 4),
+            threshold=config['proteins'].get('sparse_threshold', 0.),
+            augment=augmentation != 'none',
+            max_translation=max_translation,
+            grid_level=config['proteins'].get('grid_level'),
+            fold=config['training'].get('fold'))
+    else:
+        data_feeder = EnzymesGridFeeder(data_manager=data_manager,
+                                        minibatch_size=config['training']['minibatch_size'],
+                                        init_samples_per_class=config['training'][
+                                            'init_samples_per_class'],
+                                        prediction_depth=config['proteins']['prediction_depth'],
+                                        num_channels=config['proteins']['n_channels'],
+                                        grid_size=config['proteins']['grid_side'],
+                                        augment=augmentation == 'cube_loader',
+                                        max_translation=max_translation,
+                                        translation_mode=translation_mode,
+                                        crop_buckets=config['proteins'].get('crop_buckets'),
+                                        crop_coverage=config['proteins'].get('crop_coverage', 1.0),
+                                        grid_level=config['proteins'].get('grid_level'),
+                                        fold=config['training'].get('fold'),
+                                        dtype='float16' if precision == 'mixed' else floatX)
     if model_name is None:
         current_time = datetime.datetime.now()
         suffix = ''.join(random.choice(string.ascii_lowercase) for _ in xrange(10))
@@ -298,20 +535,78 @@ def _build_enz_feeder_model_trainer(config, model_name=None, start_epoch=0,
                                                                  current_time.year,
                                                                  current_time.hour,
                                                                  current_time.minute)
+
+    # reuse the compiled functions of models with the same network, shapes and hyperparameters
+    function_cache = None
+    if config['training'].get('function_cache', True):
+        function_cache = FunctionCache(os.path.join(data_manager.dirs['misc'], 'compiled'))
+
+    if graph:
+        model = GraphDisjointClassifier(name=model_name,
+                                        n_classes=config['proteins']['n_classes'],
+                                        network=get_network(config['training']['network']),
+                                        radius=graph_radius,
+                                        learning_rate=config['training']['learning_rate'],
+                                        function_cache=function_cache,
+                                        accumulation_steps=config['training'].get(
+                                            'accumulation_steps', 1))
+        trainer = ModelTrainer(model=model, data_feeder=data_feeder, first_epoch=start_epoch)
+        return data_feeder, model, trainer
+
+    # the grids may be coarser or cropped to a smaller side than the pre-processed one
+    input_side = data_feeder.get_input_side()
+
+    # optionally rotate with a precomputed (and cached) bank of rotation index tables
+    rotation_bank = None
+    bank_config = config['training'].get('rotation_bank')
+    if bank_config is not None and (sparse or augmentation != 'rotation'):
+        log.warning("rotation_bank is only used with the 'rotation' augmentation of the grid "
+                    "models, ignoring it")
+    elif bank_config is not None:
+        rotation_bank = RotationIndexBank.load_or_precompute(
+            cache_dir=data_manager.dirs['misc'],
+            grid_side=input_side,
+            n_rotations=bank_config.get('n_rotations', 64),
+            cube_symmetries_only=bank_config.get('cube_symmetries_only', False),
+            seed=bank_config.get('seed', 0))
+
+    if sparse:
+        model = SparseDisjointClassifier(name=model_name,
+                                         n_classes=config['proteins']['n_classes'],
+                                         network=get_network(config['training']['network']),
+                                         n_channels=config['proteins']['n_channels'],
+                                         n_levels=config['training'].get('sparse_levels', 4),
+                                         learning_rate=config['training']['learning_rate'],
+                                         function_cache=function_cache,
+                                         accumulation_steps=config['training'].get(
+                                             'accumulation_steps', 1))
+        trainer = ModelTrainer(model=model, data_feeder=data_feeder, first_epoch=start_epoch)
+        return data_feeder, model, trainer
+
     model = GridsDisjointClassifier(name=model_name,
                                     n_classes=config['proteins']['n_classes'],
                                     network=get_network(config['training']['network']),
-                                    grid_size=config['proteins']['grid_side'],
+                                    grid_size=input_side,
                                     n_channels=config['proteins']['n_channels'],
                                     minibatch_size=config['training']['minibatch_size'],
-                                    learning_rate=config['training']['learning_rate'])
+                                    learning_rate=config['training']['learning_rate'],
+                                    rotation_bank=rotation_bank,
+                                    augmentation='none' if augmentation == 'cube_loader'
+                                    else augmentation,
+                                    max_translation=max_translation,
+                                    translation_mode=translation_mode,
+                                    function_cache=function_cache,
+                                    accumulation_steps=config['training'].get(
+                                        'accumulation_steps', 1),
+                                    precision=precision,
+                                    loss_scale=config['training'].get('loss_scale', 1.))
     trainer = ModelTrainer(model=model, data_feeder=data_feeder, first_epoch=start_epoch)
     return data_feeder, model, trainer
 
 
 def train_enz_from_grids(config, model_name=None, start_epoch=0,
                          force_download=False, force_memmaps=False,
-                         force_grids=False, force_split=False):
+                         force_grids=False, force_split=False, split_policy=None):
     """
     Utility function to train a GridsDisjointClassifier model on the train set, consisting of
     already precomputed electron density grids. The model need not exist, but if it does exist
@@ -326,14 +621,21 @@ def train_enz_from_grids(config, model_name=None, start_epoch=0,
     :param force_memmaps: see EnzymeDataManager
     :param force_grids: see EnzymeDataManager
     :param force_split: see EnzymeDataManager
+    :param split_policy: see EnzymeDataManager, e.g. 'auto' for unattended runs
     """
-    _, model, trainer = _build_enz_feeder_model_trainer(config, model_name=model_name,
-                                                        start_epoch=start_epoch,
-                                                        force_download=force_download,
-                                                        force_memmaps=force_memmaps,
-                                                        force_grids=force_grids,
-                                                        force_split=force_split)
-    save_config(config, os.path.join(trainer.monitor.get_model_dir(), "config.yaml"))
+    data_feeder, model, trainer = _build_enz_feeder_model_trainer(config, model_name=model_name,
+                                                                  start_epoch=start_epoch,
+                                                                  force_download=force_download,
+                                                                  force_memmaps=force_memmaps,
+                                                                  force_grids=force_grids,
+                                                                  force_split=force_split,
+                                                                  split_policy=split_policy)
+    # when the grids are cropped, their side depends on the data set, so it is recorded for
+    # the inference on new proteins (see InferenceEngine)
+    saved_config = copy.deepcopy(config)
+    if hasattr(data_feeder, 'get_input_side'):
+        saved_config['proteins']['input_side'] = data_feeder.get_input_side()
+    save_config(saved_config, os.path.join(trainer.monitor.get_model_dir(), "config.yaml"))
     if start_epoch != 0:
         trainer.monitor.load_model("params_{}ep_best.npz".format(start_epoch),
                                    network=trainer.model.get_output_layers())
@@ -341,7 +643,32 @@ def train_enz_from_grids(config, model_name=None, start_epoch=0,
     return model.get_name()
 
 
-def test_enz_from_grids(config, model_name, params_file, mode='test'):
+def cross_validate_enz_from_grids(config, split_policy=None):
+    """
+    Utility function to run a cross-validation sweep: trains one GridsDisjointClassifier model
+    for each of the config['training']['n_folds'] folds of the train and validation proteins.
+    The data is set up only once per fold from the cached split, folds and labels, nothing is
+    copied.
+
+    :param config: the contents of a config.yaml, specifying the details for the training. The
+        fold of each model is recorded in its saved config.yaml.
+    :param split_policy: see EnzymeDataManager
+    :return: list of the names of the trained models, one for each fold
+    """
+    n_folds = config['training'].get('n_folds')
+    if n_folds is None:
+        log.error("Set training.n_folds in the config for a cross-validation")
+        raise ValueError
+    model_names = list()
+    for fold in range(n_folds):
+        fold_config = copy.deepcopy(config)
+        fold_config['training']['fold'] = fold
+        log.info("Training on cross-validation fold {}/{}".format(fold + 1, n_folds))
+        model_names.append(train_enz_from_grids(fold_config, split_policy=split_policy))
+    return model_names
+
+
+def test_enz_from_grids(config, model_name, params_file, mode='test', tta_rotations=None):
     """
     Utility function to test a GridsDisjointClassifer model on the test (or optionally validation)
     set. The model must already exist (and must have been trained).
@@ -355,18 +682,25 @@ def test_enz_from_grids(config, model_name, params_file, mode='test'):
     :param params_file: file with parameter weights (from a previous training) that should be
         loaded into the model before it gets tested.
     :param mode: whether to test on the test set ('test') or validation set ('val')
+    :param tta_rotations: (optional) if given, the predictions are averaged over that many
+        fixed rotations of each protein (see ModelTrainer.test_time_augmentation)
     """
     _, model, trainer = _build_enz_feeder_model_trainer(config,
                                                         model_name=model_name)
     trainer.monitor.load_model(params_filename=params_file, network=model.get_output_layers())
-    if mode == 'test':
+    if tta_rotations is not None:
+        result = trainer.test_time_augmentation(mode=mode, n_rotations=tta_rotations)
+        test_predictions, test_targets, proteins = \
+            result['predictions'], result['targets'], result['proteins']
+    elif mode == 'test':
         _, _, _, test_predictions, test_targets, proteins = trainer.test()
     else:  # mode == 'val'
         _, _, _, test_predictions, test_targets, proteins = trainer._test(mode='val')
 
-    # make the shapes to be (N x n_classes)
-    test_predictions = np.asarray(test_predictions).reshape((-1, config['proteins']['n_classes']))
-    test_targets = np.asarray(test_targets).reshape((-1, config['proteins']['n_classes']))
+    # make the shapes to be (N x n_classes), the last mini-batch may be smaller than the others
+    n_classes = config['proteins']['n_classes']
+    test_predictions = np.vstack([np.asarray(p).reshape((-1, n_classes)) for p in test_predictions])
+    test_targets = np.vstack([np.asarray(t).reshape((-1, n_classes)) for t in test_targets])
 
     save_pickle(os.path.join(trainer.monitor.get_model_dir(), "{}_predictions.pickle".format(mode)),
                 test_predictions)
@@ -376,7 +710,7 @@ def test_enz_from_grids(config, model_name, params_file, mode='test'):
                 proteins)
 
 
-def get_hidden_activations(config, model_name, params_file):
+def get_hidden_activations(config, model_name, params_file, layers=None):
     """
     Utility function to get the hidden activations of the hidden layers in a GridsDisjointClassifier
     model. The model must have already been trained. The hidden activations are produced for a
@@ -387,15 +721,41 @@ def get_hidden_activations(config, model_name, params_file):
     :param model_name: name of the model (should be unique)
     :param params_file: file with parameter weights (from a previous training) that should be
         loaded into the model before the hidden activations are extracted.
+    :param layers: (optional) indices or names of the layers whose activations are extracted,
+        see DisjointClassModel.get_layers(). All layers if None.
     :return: protein codes, targets (ground truths), activations, predictions
         for the single mini-batch from the test set that was used to get the hidden activations.
     """
     _, model, trainer = _build_enz_feeder_model_trainer(config, model_name=model_name)
     trainer.monitor.load_model(params_filename=params_file, network=model.get_output_layers())
-    prots, targets, activations, preds = trainer.get_test_hidden_activations()
+    prots, targets, activations, preds = trainer.get_test_hidden_activations(layers=layers)
     return prots, targets, preds, activations
 
 
+def stream_hidden_activations(config, model_name, params_file, out_dir, layers=None,
+                              n_minibatches=1):
+    """
+    Utility function to save the hidden activations of a trained GridsDisjointClassifier model
+    to disk, one layer at a time (see ModelTrainer.stream_test_hidden_activations). Use it for
+    models whose activations for all layers do not fit in memory.
+
+    :param config: the contents of config.yaml for the model. Must match the configuration with
+        which the model was originally trained.
+    :param model_name: name of the model (should be unique)
+    :param params_file: file with parameter weights (from a previous training) that should be
+        loaded into the model before the hidden activations are extracted.
+    :param out_dir: directory in which a .npy file is written for each layer
+    :param layers: (optional) indices or names of the layers, all layers if None
+    :param n_minibatches: number of test minibatches to compute the activations for
+    :return: protein codes, targets (ground truths), predictions and a dict with keys the
+        layer indices and values the paths of the .npy files
+    """
+    _, model, trainer = _build_enz_feeder_model_trainer(config, model_name=model_name)
+    trainer.monitor.load_model(params_filename=params_file, network=model.get_output_layers())
+    return trainer.stream_test_hidden_activations(out_dir=out_dir, layers=layers,
+                                                  n_minibatches=n_minibatches)
+
+
 def get_best_params(config, model_name):
     """
     Utility function to get the parameters file of the model which achieved best accuracy.
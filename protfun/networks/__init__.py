@@ -6,6 +6,8 @@ from protfun.networks.shallow_net import shallow_network
 from protfun.networks.regularized_net import regularized_net
 from protfun.networks.heavy_regularized_net import heavy_regularized_net
 from protfun.networks.l2_network import l2_network
+from protfun.networks.sparse_network import sparse_network
+from protfun.networks.graph_network import graph_network
 
 networks = {
     "standard_network": standard_network,
@@ -15,7 +17,9 @@ networks = {
     "shallow_network": shallow_network,
     "regularized_network": regularized_net,
     "heavy_regularized_network": heavy_regularized_net,
-    "l2_network": l2_network
+    "l2_network": l2_network,
+    "sparse_network": sparse_network,
+    "graph_network": graph_network
 }
 
 
@@ -0,0 +1,44 @@
+import lasagne
+
+from protfun.layers.graph_layer import RadiusGraphConvLayer
+from protfun.layers.sparse_conv_layer import SparseGlobalPoolLayer
+
+
+def graph_network(input, n_outputs, last_nonlinearity, radius=4.5):
+    """
+    graph_network is a message passing network on the radius graph of the atoms of the proteins:
+    the atom features are embedded, refined by 4 RadiusGraphConvLayers and averaged over each
+    protein, before fully connected layers are applied. No grids are involved, the cost of the
+    network scales with the number of atoms.
+
+    Usage::
+        >>> from protfun.models import GraphDisjointClassifier
+        >>> model = GraphDisjointClassifier(name="graph", n_classes=2, network=graph_network,
+        >>>                                 n_atom_features=2)
+
+    :param input: a dict of lasagne input layers, as defined by GraphDisjointClassifier:
+        'atoms' - the features of the atoms (N x n_atom_features)
+        'senders', 'receivers', 'distances' - the edges of the radius graph
+        'segments' - the protein index of each atom
+        'counts' - the number of atoms of each protein
+    :param n_outputs: number of output units in the last layer
+    :param last_nonlinearity: what the non-linearity in the last layer should be
+    :param radius: the cutoff radius the graph was built with (see EnzymesMolDataFeeder)
+    :return: the last lasagne layer of the network, and L2 regularization terms
+            if there are any (otherwise 0).
+    """
+    network = lasagne.layers.DenseLayer(incoming=input['atoms'], num_units=64,
+                                        nonlinearity=lasagne.nonlinearities.leaky_rectify)
+    for _ in range(4):
+        network = RadiusGraphConvLayer(incoming=network, senders=input['senders'],
+                                       receivers=input['receivers'],
+                                       distances=input['distances'], num_units=64,
+                                       radius=radius,
+                                       nonlinearity=lasagne.nonlinearities.leaky_rectify)
+    network = SparseGlobalPoolLayer(incoming=network, segments=input['segments'],
+                                    counts=input['counts'])
+    network = lasagne.layers.DenseLayer(incoming=network, num_units=128,
+                                        nonlinearity=lasagne.nonlinearities.leaky_rectify)
+    output = lasagne.layers.DenseLayer(incoming=network, num_units=n_outputs,
+                                       nonlinearity=last_nonlinearity)
+    return output, 0
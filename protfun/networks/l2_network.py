@@ -1,5 +1,5 @@
 import lasagne
-import lasagne.layers.dnn
+from protfun.layers.conv_layers import conv3d, max_pool3d
 
 from lasagne.regularization import regularize_layer_params_weighted, l2
 
@@ -49,25 +49,25 @@ def add_shallow_conv_maxpool(network):
     regularization = 0
     filter_size = (3, 3, 3)
 
-    network = lasagne.layers.dnn.Conv3DDNNLayer(incoming=network, pad='same',
-                                                num_filters=32,
-                                                filter_size=filter_size,
-                                                nonlinearity=lasagne.nonlinearities.leaky_rectify)
+    network = conv3d(incoming=network, pad='same',
+                     num_filters=32,
+                     filter_size=filter_size,
+                     nonlinearity=lasagne.nonlinearities.leaky_rectify)
     l2_penalty = regularize_layer_params_weighted({network: 0.2}, l2)
     regularization += l2_penalty
-    network = lasagne.layers.dnn.MaxPool3DDNNLayer(incoming=network,
-                                                   pool_size=(2, 2, 2),
-                                                   stride=2)
+    network = max_pool3d(incoming=network,
+                         pool_size=(2, 2, 2),
+                         stride=2)
 
-    network = lasagne.layers.dnn.Conv3DDNNLayer(incoming=network, pad='same',
-                                                num_filters=64,
-                                                filter_size=filter_size,
-                                                nonlinearity=lasagne.nonlinearities.leaky_rectify)
+    network = conv3d(incoming=network, pad='same',
+                     num_filters=64,
+                     filter_size=filter_size,
+                     nonlinearity=lasagne.nonlinearities.leaky_rectify)
     l2_penalty = regularize_layer_params_weighted({network: 0.2}, l2)
     regularization += l2_penalty
-    network = lasagne.layers.dnn.MaxPool3DDNNLayer(incoming=network,
-                                                   pool_size=(2, 2, 2),
-                                                   stride=2)
+    network = max_pool3d(incoming=network,
+                         pool_size=(2, 2, 2),
+                         stride=2)
 
     return network, regularization
 
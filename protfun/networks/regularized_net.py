@@ -1,5 +1,5 @@
 import lasagne
-import lasagne.layers.dnn
+from protfun.layers.conv_layers import conv3d, max_pool3d
 
 
 def regularized_net(input, n_outputs, last_nonlinearity):
@@ -38,23 +38,23 @@ def regularized_net(input, n_outputs, last_nonlinearity):
 def add_shallow_conv_maxpool(network):
     filter_size = (3, 3, 3)
 
-    network = lasagne.layers.dnn.Conv3DDNNLayer(incoming=network, pad='same',
-                                                num_filters=32,
-                                                filter_size=filter_size,
-                                                nonlinearity=lasagne.nonlinearities.leaky_rectify)
+    network = conv3d(incoming=network, pad='same',
+                     num_filters=32,
+                     filter_size=filter_size,
+                     nonlinearity=lasagne.nonlinearities.leaky_rectify)
     network = lasagne.layers.DropoutLayer(incoming=network, p=0.4)
-    network = lasagne.layers.dnn.MaxPool3DDNNLayer(incoming=network,
-                                                   pool_size=(2, 2, 2),
-                                                   stride=2)
+    network = max_pool3d(incoming=network,
+                         pool_size=(2, 2, 2),
+                         stride=2)
 
-    network = lasagne.layers.dnn.Conv3DDNNLayer(incoming=network, pad='same',
-                                                num_filters=64,
-                                                filter_size=filter_size,
-                                                nonlinearity=lasagne.nonlinearities.leaky_rectify)
+    network = conv3d(incoming=network, pad='same',
+                     num_filters=64,
+                     filter_size=filter_size,
+                     nonlinearity=lasagne.nonlinearities.leaky_rectify)
     network = lasagne.layers.DropoutLayer(incoming=network, p=0.4)
-    network = lasagne.layers.dnn.MaxPool3DDNNLayer(incoming=network,
-                                                   pool_size=(2, 2, 2),
-                                                   stride=2)
+    network = max_pool3d(incoming=network,
+                         pool_size=(2, 2, 2),
+                         stride=2)
 
     return network
 
@@ -1,5 +1,5 @@
 import lasagne
-import lasagne.layers.dnn
+from protfun.layers.conv_layers import conv3d, max_pool3d
 
 
 def small_dense_network(input, n_outputs, last_nonlinearity):
@@ -50,26 +50,26 @@ def dense_net_block(network, depth=6, num_filters=16):
         network = lasagne.layers.NonlinearityLayer(incoming=network, nonlinearity=lasagne.nonlinearities.leaky_rectify)
 
         # add  bottleneck convolution
-        network = lasagne.layers.dnn.Conv3DDNNLayer(incoming=network, pad='same',
-                                                    num_filters=4 * num_filters,
-                                                    filter_size=(1, 1, 1),
-                                                    nonlinearity=lasagne.nonlinearities.identity)
+        network = conv3d(incoming=network, pad='same',
+                         num_filters=4 * num_filters,
+                         filter_size=(1, 1, 1),
+                         nonlinearity=lasagne.nonlinearities.identity)
 
         network = lasagne.layers.BatchNormLayer(incoming=network)
         network = lasagne.layers.NonlinearityLayer(incoming=network, nonlinearity=lasagne.nonlinearities.leaky_rectify)
 
         # add the proper convolution
-        network = lasagne.layers.dnn.Conv3DDNNLayer(incoming=network, pad='same',
-                                                    num_filters=num_filters,
-                                                    filter_size=(3, 3, 3),
-                                                    nonlinearity=lasagne.nonlinearities.identity)
+        network = conv3d(incoming=network, pad='same',
+                         num_filters=num_filters,
+                         filter_size=(3, 3, 3),
+                         nonlinearity=lasagne.nonlinearities.identity)
     return network
 
 
 def transition_layers(network, num_filters=16):
-    network = lasagne.layers.dnn.Conv3DDNNLayer(incoming=network, pad='same',
-                                                num_filters=num_filters,
-                                                filter_size=(1, 1, 1),
-                                                nonlinearity=lasagne.nonlinearities.identity)
-    network = lasagne.layers.dnn.MaxPool3DDNNLayer(incoming=network, pool_size=(2, 2, 2), stride=2)
+    network = conv3d(incoming=network, pad='same',
+                     num_filters=num_filters,
+                     filter_size=(1, 1, 1),
+                     nonlinearity=lasagne.nonlinearities.identity)
+    network = max_pool3d(incoming=network, pool_size=(2, 2, 2), stride=2)
     return network
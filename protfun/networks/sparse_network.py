@@ -0,0 +1,47 @@
+import lasagne
+
+from protfun.layers.sparse_conv_layer import SparseConv3DLayer, SparsePool3DLayer, \
+    SparseGlobalPoolLayer
+
+
+def sparse_network(input, n_outputs, last_nonlinearity):
+    """
+    sparse_network is the sparse voxel counterpart of the standard_network: pairs of 3x3x3
+    convolutions followed by 2x2x2 max-pooling on each resolution level, but computed only at the
+    occupied voxels of the proteins (see SparseConv3DLayer). The features of the coarsest level
+    are averaged over each protein and fed into fully connected layers. The cost of the network
+    thus scales with the volume of the proteins and not with the volume of the grids.
+
+    Usage::
+        >>> from protfun.models import SparseDisjointClassifier
+        >>> model = SparseDisjointClassifier(name="sparse", n_classes=2, network=sparse_network,
+        >>>                                  n_channels=1, n_levels=4)
+
+    :param input: a dict of lasagne input layers, as defined by SparseDisjointClassifier:
+        'features' - the features of the occupied voxels (N x channels)
+        'neighbors' - list of the neighbor map layers, one for each resolution level
+        'children' - list of the children map layers, from each level to the next coarser one
+        'segments' - the protein index of each site of the coarsest level
+        'counts' - the number of sites of each protein at the coarsest level
+    :param n_outputs: number of output units in the last layer
+    :param last_nonlinearity: what the non-linearity in the last layer should be
+    :return: the last lasagne layer of the network, and L2 regularization terms
+            if there are any (otherwise 0).
+    """
+    network = input['features']
+    n_levels = len(input['neighbors'])
+    for level in range(n_levels):
+        if level > 0:
+            network = SparsePool3DLayer(incoming=network, children=input['children'][level - 1])
+        for _ in range(2):
+            network = SparseConv3DLayer(incoming=network, neighbors=input['neighbors'][level],
+                                        num_filters=2 ** (4 + level),
+                                        nonlinearity=lasagne.nonlinearities.leaky_rectify)
+    network = SparseGlobalPoolLayer(incoming=network, segments=input['segments'],
+                                    counts=input['counts'])
+    for _ in range(2):
+        network = lasagne.layers.DenseLayer(incoming=network, num_units=256,
+                                            nonlinearity=lasagne.nonlinearities.leaky_rectify)
+    output = lasagne.layers.DenseLayer(incoming=network, num_units=n_outputs,
+                                       nonlinearity=last_nonlinearity)
+    return output, 0
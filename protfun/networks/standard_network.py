@@ -1,5 +1,5 @@
 import lasagne
-import lasagne.layers.dnn
+from protfun.layers.conv_layers import conv3d, max_pool3d
 
 
 def standard_network(input, n_outputs, last_nonlinearity):
@@ -39,23 +39,23 @@ def standard_network(input, n_outputs, last_nonlinearity):
 def add_deep_conv_maxpool(network):
     filter_size = (3, 3, 3)
 
-    network = lasagne.layers.dnn.Conv3DDNNLayer(incoming=network, pad='same',
-                                                num_filters=32,
-                                                filter_size=filter_size,
-                                                nonlinearity=lasagne.nonlinearities.leaky_rectify)
-    network = lasagne.layers.dnn.MaxPool3DDNNLayer(incoming=network,
-                                                   pool_size=(2, 2, 2),
-                                                   stride=2)
+    network = conv3d(incoming=network, pad='same',
+                     num_filters=32,
+                     filter_size=filter_size,
+                     nonlinearity=lasagne.nonlinearities.leaky_rectify)
+    network = max_pool3d(incoming=network,
+                         pool_size=(2, 2, 2),
+                         stride=2)
 
     for i in range(0, 6):
-        network = lasagne.layers.dnn.Conv3DDNNLayer(incoming=network, pad='same',
-                                                    num_filters=2 ** (5 + i // 2),
-                                                    filter_size=filter_size,
-                                                    nonlinearity=lasagne.nonlinearities.leaky_rectify)
+        network = conv3d(incoming=network, pad='same',
+                         num_filters=2 ** (5 + i // 2),
+                         filter_size=filter_size,
+                         nonlinearity=lasagne.nonlinearities.leaky_rectify)
         if i % 2 == 1:
-            network = lasagne.layers.dnn.MaxPool3DDNNLayer(incoming=network,
-                                                           pool_size=(2, 2, 2),
-                                                           stride=2)
+            network = max_pool3d(incoming=network,
+                                 pool_size=(2, 2, 2),
+                                 stride=2)
     return network
 
 
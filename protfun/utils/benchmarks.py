@@ -0,0 +1,219 @@
+import time
+import numpy as np
+import theano
+import lasagne
+
+from protfun.utils.log import get_logger
+
+log = get_logger("benchmarks")
+
+floatX = theano.config.floatX
+intX = np.int32
+
+
+def model_memory_mb(model, inputs):
+    """
+    Measures the memory of a single model, independently of the other models in the process:
+    the params of the network and the activations of all its layers (including the input) for
+    the given mini-batch. The optimizer state and the temporary buffers of the backward pass
+    are not included.
+
+    :param model: a DisjointClassModel with a defined forward pass
+    :param inputs: the input mini-batch(es) of the model
+    :return: the memory in MB
+    """
+    params = lasagne.layers.get_all_params(model.get_output_layers())
+    params_bytes = sum(p.get_value(borrow=True).nbytes for p in params)
+    activations = model.get_activation_function(keep=False)(*inputs)
+    return (params_bytes + sum(a.nbytes for a in activations)) / 2. ** 20
+
+
+def time_function(function, inputs, n_calls):
+    """
+    Calls a (compiled) function n_calls times on the same inputs, after one warm-up call.
+
+    :return: the mean wall time per call in seconds
+    """
+    function(*inputs)
+    start = time.time()
+    for _ in range(n_calls):
+        function(*inputs)
+    return (time.time() - start) / n_calls
+
+
+def benchmark_precision(network_names=('standard_network', 'dense_network'), grid_size=32,
+                        n_channels=1, n_classes=2, minibatch_size=4, n_steps=10, seed=0):
+    """
+    Benchmarks the 'float32' against the 'mixed' precision of GridsDisjointClassifier on
+    synthetic grids, for each of the given networks:
+        * memory: bytes of an input mini-batch, and the memory of the model's params and of
+          the activations of all its layers for a mini-batch (see model_memory_mb). The
+          resident memory of the process is not used, as it only grows over the models.
+        * throughput: proteins per second for the train and the validation function
+        * parity: both models start from the same weights and are trained on the same
+          mini-batches, then the max. absolute difference of their (sigmoid) predictions and the
+          fraction of equal thresholded predictions on held out grids are reported
+
+    Usage::
+        >>> results = benchmark_precision(network_names=['standard_network'], grid_size=32)
+        >>> results['standard_network']['mixed']['train_proteins_per_sec']
+
+    :param network_names: names of the networks to benchmark (see protfun.networks)
+    :param grid_size: number of points on each side of the synthetic grids
+    :param n_channels: number of channels of the synthetic grids
+    :param n_classes: number of classes
+    :param minibatch_size: -
+    :param n_steps: number of timed calls, and of training steps for the parity check
+    :param seed: seed for the synthetic data and the initial weights
+    :return: dict network name -> precision -> measurements
+    """
+    from protfun.models.disjoint_class_model import GridsDisjointClassifier
+    from protfun.networks import get_network
+
+    rng = np.random.RandomState(seed)
+    shape = (minibatch_size, n_channels, grid_size, grid_size, grid_size)
+    train_grids = [rng.rand(*shape).astype(np.float32) for _ in range(n_steps)]
+    train_targets = [rng.randint(0, 2, size=(minibatch_size, n_classes)).astype(intX)
+                     for _ in range(n_steps)]
+    test_grids = rng.rand(*shape).astype(np.float32)
+    test_targets = rng.randint(0, 2, size=(minibatch_size, n_classes)).astype(intX)
+
+    results = dict()
+    for network_name in network_names:
+        results[network_name] = dict()
+        initial_params = None
+        predictions = dict()
+        for precision in ['float32', 'mixed']:
+            lasagne.random.set_rng(np.random.RandomState(seed))
+            model = GridsDisjointClassifier(name="benchmark_{}_{}".format(network_name,
+                                                                          precision),
+                                            n_classes=n_classes,
+                                            network=get_network(network_name),
+                                            grid_size=grid_size, n_channels=n_channels,
+                                            minibatch_size=minibatch_size,
+                                            augmentation='none', precision=precision)
+            if initial_params is None:
+                initial_params = lasagne.layers.get_all_param_values(model.get_output_layers())
+            else:
+                lasagne.layers.set_all_param_values(model.get_output_layers(), initial_params)
+            dtype = model.input_dtype
+
+            # throughput, measured before the training for the parity check
+            val_time = time_function(model.validation_function,
+                                     [test_grids.astype(dtype), test_targets], n_steps)
+            # training for the parity check, timed as well. The functions are compiled on first
+            # use, so a warm-up step (done by both precisions, to keep the same updates) compiles
+            # the train function before the timer starts
+            model.train_function(train_grids[0].astype(dtype), train_targets[0])
+            start = time.time()
+            for grids, targets in zip(train_grids, train_targets):
+                model.train_function(grids.astype(dtype), targets)
+            train_time = (time.time() - start) / n_steps
+
+            predictions[precision] = model.get_prediction_function()(test_grids.astype(dtype))
+            results[network_name][precision] = {
+                'input_bytes': test_grids.astype(dtype).nbytes,
+                'model_memory_mb': model_memory_mb(model, [test_grids.astype(dtype)]),
+                'train_proteins_per_sec': minibatch_size / train_time,
+                'val_proteins_per_sec': minibatch_size / val_time}
+
+        diff = np.abs(predictions['float32'] - predictions['mixed'])
+        agreement = np.mean(np.equal(predictions['float32'] > 0.5, predictions['mixed'] > 0.5))
+        results[network_name]['parity'] = {'max_abs_diff': float(diff.max()),
+                                           'prediction_agreement': float(agreement)}
+
+        for precision in ['float32', 'mixed']:
+            r = results[network_name][precision]
+            log.info("{0} {1:>7}: input {2:.1f} MB, params + activations {3:.1f} MB, "
+                     "train {4:.2f} proteins/s, val {5:.2f} proteins/s".format(
+                network_name, precision, r['input_bytes'] / 2. ** 20, r['model_memory_mb'],
+                r['train_proteins_per_sec'], r['val_proteins_per_sec']))
+        log.info("{0} parity: max abs. difference of the predictions {1:.2e}, "
+                 "agreement {2:.3f}".format(network_name,
+                                            results[network_name]['parity']['max_abs_diff'],
+                                            results[network_name]['parity'][
+                                                'prediction_agreement']))
+    return results
+
+
+def benchmark_layers(network_names=None, grid_size=32, n_channels=1, n_classes=2,
+                     minibatch_size=4, n_calls=5, seed=0):
+    """
+    Benchmarks every layer of the grid networks in isolation, on synthetic grids and with the
+    current convolution backend (see protfun.layers.conv_layers): the input of each layer is
+    computed once, then the forward pass and the forward + backward pass (the gradients w.r.t.
+    the input and the parameters of the layer) are timed. On a CPU-only machine this shows
+    where the training time of a network goes.
+
+    Usage::
+        >>> from protfun.layers.conv_layers import set_conv_backend
+        >>> set_conv_backend('cpu')
+        >>> results = benchmark_layers(network_names=['standard_network'], grid_size=32)
+        >>> results['standard_network'][0]['forward_proteins_per_sec']
+
+    :param network_names: names of the grid networks to benchmark (see protfun.networks), by
+        default all registered networks that take grids as input
+    :param grid_size: number of points on each side of the synthetic grids
+    :param n_channels: number of channels of the synthetic grids
+    :param n_classes: number of outputs of the networks
+    :param minibatch_size: -
+    :param n_calls: number of timed calls of each function
+    :param seed: seed for the synthetic grids and the weights
+    :return: dict network name -> list of measurements, one for each layer (in the order of the
+        network), with the keys 'name', 'output_shape', 'forward_proteins_per_sec',
+        'backward_proteins_per_sec'
+    """
+    from theano import tensor as T
+    from protfun.layers.conv_layers import get_conv_backend
+    from protfun.networks import networks, get_network
+
+    if network_names is None:
+        # the sparse and the graph networks take a dict of inputs instead of grids
+        network_names = sorted(name for name in networks
+                               if name not in ['sparse_network', 'graph_network'])
+
+    rng = np.random.RandomState(seed)
+    grids = rng.rand(minibatch_size, n_channels, grid_size, grid_size, grid_size).astype(floatX)
+
+    results = dict()
+    for network_name in network_names:
+        lasagne.random.set_rng(np.random.RandomState(seed))
+        input_layer = lasagne.layers.InputLayer(
+            shape=(None, n_channels, grid_size, grid_size, grid_size),
+            input_var=T.TensorType(floatX, (False,) * 5)('grids'))
+        output_layer, _ = get_network(network_name)(input_layer, n_outputs=n_classes,
+                                                    last_nonlinearity=lasagne.nonlinearities.sigmoid)
+        layers = lasagne.layers.get_all_layers(output_layer)[1:]
+        # the inputs of all layers, computed once
+        all_outputs = theano.function([input_layer.input_var],
+                                      lasagne.layers.get_output([input_layer] + layers,
+                                                                deterministic=True))(grids)
+        values = dict(zip([input_layer] + layers, all_outputs))
+
+        results[network_name] = list()
+        for i, layer in enumerate(layers):
+            incomings = getattr(layer, 'input_layers', None) or [layer.input_layer]
+            input_vars = [T.TensorType(floatX, (False,) * values[l].ndim)() for l in incomings]
+            output = lasagne.layers.get_output(layer, inputs=dict(zip(incomings, input_vars)),
+                                               deterministic=True)
+            params = layer.get_params(trainable=True)
+            gradients = T.grad(output.sum(), wrt=input_vars + params)
+            inputs = [values[l] for l in incomings]
+            forward_time = time_function(theano.function(input_vars, output), inputs, n_calls)
+            backward_time = time_function(theano.function(input_vars, gradients), inputs,
+                                          n_calls)
+            result = {'name': '{:02d}_{}'.format(i + 1, layer.__class__.__name__),
+                      'output_shape': values[layer].shape,
+                      'forward_proteins_per_sec': minibatch_size / forward_time,
+                      'backward_proteins_per_sec': minibatch_size / backward_time}
+            results[network_name].append(result)
+            log.info("{0} ({1}) {2:<28} {3:<24} forward {4:8.1f} proteins/s, "
+                     "forward + backward {5:8.1f} proteins/s".format(
+                network_name, get_conv_backend(), result['name'], str(result['output_shape']),
+                result['forward_proteins_per_sec'], result['backward_proteins_per_sec']))
+    return results
+
+
+if __name__ == "__main__":
+    benchmark_precision()
+    benchmark_layers()
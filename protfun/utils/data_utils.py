@@ -1,5 +1,7 @@
 import cPickle
+import errno
 import os
+import shutil
 
 from protfun.utils.log import get_logger
 
@@ -118,3 +120,106 @@ def construct_hierarchical_tree(data_dict, prediction_depth=4):
                           for key in keys_at_max_hdepth}
 
     return tree_at_max_hdepth
+
+
+def pyramid_grid_filename(grid_size, level_side):
+    """
+    Name of the file in which a processed protein's grid is stored, for a level of the
+    resolution pyramid.
+
+    :param grid_size: number of points on the side of the full resolution grid
+    :param level_side: number of points on the side of the grid at the desired level
+    :return: the filename (not full path) of the grid memmap
+    """
+    if level_side == grid_size:
+        return "grid.memmap"
+    return "grid_{}.memmap".format(level_side)
+
+
+def sparse_voxels_filename(level_side):
+    """
+    Name of the file in which the occupied voxels of a processed protein's grid are stored (see
+    protfun.utils.sparse_voxels.occupied_voxels), for a level of the resolution pyramid.
+
+    :param level_side: number of points on the side of the grid the voxels are taken from
+    :return: the filename (not full path) of the .npz file
+    """
+    return "voxels_{}.npz".format(level_side)
+
+
+# ioctl request code of FICLONE (Linux), clones a file by sharing its extents (copy-on-write)
+_FICLONE = 0x40049409
+LINK_METHODS = ('hardlink', 'reflink', 'symlink', 'copy')
+
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+            except IOError:
+                fdst.close()
+                os.remove(dst)
+                raise OSError(errno.EOPNOTSUPP, "reflinks are not supported")
+
+
+def _link_file(src, dst, method):
+    if method == 'hardlink':
+        os.link(src, dst)
+    elif method == 'reflink':
+        _reflink(src, dst)
+    elif method == 'symlink':
+        os.symlink(os.path.abspath(src), dst)
+    else:
+        shutil.copy2(src, dst)
+
+
+def link_tree(src_dir, dst_dir, methods=LINK_METHODS):
+    """
+    Materializes a copy of the (flat or nested) directory src_dir at dst_dir without copying
+    the file contents where the filesystem allows it. For each file the first method that works
+    out of methods is used: a hardlink, a reflink (copy-on-write clone), a symlink, or a plain
+    copy. Everything happens in-process, i.e. no shell is spawned.
+
+    Note that hard- and symlinked files share their contents with src_dir, so the linked files
+    must not be modified in place.
+
+    Usage::
+        >>> methods = LINK_METHODS
+        >>> for prot_code in ['1A0A', '1A0B']:
+        >>>     # pass on the method that worked, so that failing methods are not tried again
+        >>>     used = link_tree("data/processed/" + prot_code, "data/train/" + prot_code,
+        >>>                      methods=methods)
+        >>>     methods = LINK_METHODS[LINK_METHODS.index(used):]
+
+    :param src_dir: the directory to be materialized
+    :param dst_dir: the target directory, it is created if it does not exist
+    :param methods: an ordered sequence of the methods from LINK_METHODS to try
+    :return: the method that was used for the last linked file (or methods[0] if the
+        directory is empty)
+    :raises: OSError if no method works
+    """
+    methods = list(methods)
+    if not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+    for name in os.listdir(src_dir):
+        src = os.path.join(src_dir, name)
+        dst = os.path.join(dst_dir, name)
+        if os.path.isdir(src):
+            used = link_tree(src, dst, methods=methods)
+            methods = methods[methods.index(used):]
+            continue
+        if os.path.lexists(dst):
+            os.remove(dst)
+        while True:
+            try:
+                _link_file(src, dst, methods[0])
+                break
+            except OSError:
+                if len(methods) == 1:
+                    raise
+                log.debug("Could not {} {}, falling back to {}".format(methods[0], src,
+                                                                      methods[1]))
+                methods = methods[1:]
+    return methods[0]
@@ -1,3 +1,4 @@
+import os
 import re
 import numpy as np
 import contextlib
@@ -27,3 +28,175 @@ def pp_array(arr):
     with printoptions(precision=3, suppress=True):
         pretyfied_arr = str(re.sub(r'\ +', '|', str(arr)))
     return pretyfied_arr
+
+
+def _proper_cube_symmetries():
+    """
+    Enumerates the 24 proper rotations of the cube as (axes permutation, axes flips) pairs.
+    A pair describes the grid transformation np.transpose(grid, perm) followed by reversing
+    every axis for which flips is True. Only the pairs with determinant +1 are kept, i.e. the
+    reflections of the cube are left out.
+    """
+    import itertools
+    symmetries = []
+    for perm in itertools.permutations(range(3)):
+        for flips in itertools.product((False, True), repeat=3):
+            if int(round(np.linalg.det(symmetry_matrix(perm, flips)))) == 1:
+                symmetries.append((perm, flips))
+    return symmetries
+
+
+def symmetry_matrix(perm, flips):
+    """
+    Computes the integer 3x3 matrix R of a cube symmetry, such that the value of the transformed
+    grid at the (centered) index q is the value of the original grid at the (centered) index R q.
+
+    :param perm: a permutation of the three spatial axes, e.g. (1, 0, 2)
+    :param flips: three booleans, whether the respective (permuted) axis is reversed
+    :return: the 3x3 matrix as an np.int32 array
+    """
+    matrix = np.zeros((3, 3), dtype=np.int32)
+    for axis in range(3):
+        matrix[perm[axis], axis] = -1 if flips[axis] else 1
+    return matrix
+
+
+# the 24 rotations of the cube, the first one is always the identity
+CUBE_SYMMETRIES = _proper_cube_symmetries()
+
+
+def apply_cube_symmetry(grid, symmetry):
+    """
+    Applies one of the 24 rotations of the cube (see CUBE_SYMMETRIES) to the last three (spatial)
+    axes of grid. The result is a strided view of the input, i.e. no data is copied and no
+    interpolation takes place.
+
+    Usage::
+        >>> grids = np.zeros((8, 1, 64, 64, 64))
+        >>> rotated = apply_cube_symmetry(grids[0], CUBE_SYMMETRIES[5])
+
+    :param grid: an array with at least 3 dimensions, the last three being spatial
+    :param symmetry: an (axes permutation, axes flips) pair
+    :return: the rotated view of grid
+    """
+    perm, flips = symmetry
+    offset = grid.ndim - 3
+    view = np.transpose(grid, tuple(range(offset)) + tuple(offset + p for p in perm))
+    slices = [slice(None)] * offset + [slice(None, None, -1) if f else slice(None)
+                                       for f in flips]
+    return view[tuple(slices)]
+
+
+def translate_grid(grid, shift, mode='roll'):
+    """
+    Translates the last three (spatial) axes of grid by an integer number of voxels.
+
+    :param grid: an array with at least 3 dimensions, the last three being spatial
+    :param shift: three integer shifts, one per spatial axis
+    :param mode: 'roll' - voxels shifted over the border re-enter on the opposite side
+                 'pad' - voxels shifted over the border are dropped and the vacated ones are 0
+    :return: the translated grid (a new array)
+    """
+    offset = grid.ndim - 3
+    if mode == 'roll':
+        return np.roll(np.roll(np.roll(grid, shift[0], axis=offset),
+                               shift[1], axis=offset + 1),
+                       shift[2], axis=offset + 2)
+    elif mode == 'pad':
+        translated = np.zeros_like(grid)
+        src = [slice(None)] * offset
+        dst = [slice(None)] * offset
+        for s, size in zip(shift, grid.shape[offset:]):
+            s = int(s)
+            src.append(slice(max(0, -s), size - max(0, s)))
+            dst.append(slice(max(0, s), size - max(0, -s)))
+        translated[tuple(dst)] = grid[tuple(src)]
+        return translated
+    else:
+        raise ValueError("Unknown translation mode {}".format(mode))
+
+
+def bounding_box(grid, threshold=0.01):
+    """
+    Determines the tight bounding box of the occupied voxels in a (multi-channel) 3D grid.
+    A voxel is occupied if its value in any of the channels exceeds threshold.
+
+    :param grid: an array with at least 3 dimensions, the last three being spatial
+    :param threshold: min. value for a voxel to count as occupied
+    :return: np.int32 array [min_0, min_1, min_2, max_0, max_1, max_2] (max. inclusive), the whole
+        grid if no voxel is occupied
+    """
+    spatial = grid.reshape((-1,) + grid.shape[-3:]).max(axis=0)
+    occupied = spatial > threshold
+    if not occupied.any():
+        return np.array([0, 0, 0] + [s - 1 for s in spatial.shape], dtype=np.int32)
+    mins, maxs = [], []
+    for axis in range(3):
+        other_axes = tuple(a for a in range(3) if a != axis)
+        occupied_indices = np.where(occupied.any(axis=other_axes))[0]
+        mins.append(occupied_indices[0])
+        maxs.append(occupied_indices[-1])
+    return np.array(mins + maxs, dtype=np.int32)
+
+
+def load_bounding_box(prot_dir, grid_size, level_side, dtype=np.float32):
+    """
+    Loads the bounding box of a processed protein, in the voxel coordinates of a grid pyramid
+    level. The box is taken from the full resolution grid (bbox.memmap, recorded during the
+    pre-processing, or computed from grid.memmap for older data) and scaled down to the level,
+    so that a protein is cropped at the same place for every level.
+
+    :param prot_dir: the directory of the processed protein
+    :param grid_size: number of points on each side of the full resolution grid
+    :param level_side: number of points on each side of the level, dividing grid_size
+    :param dtype: dtype of grid.memmap
+    :return: np.int32 array [min_0, min_1, min_2, max_0, max_1, max_2] (max. inclusive)
+    """
+    bbox_file = os.path.join(prot_dir, 'bbox.memmap')
+    if os.path.exists(bbox_file):
+        box = np.array(np.memmap(bbox_file, mode='r', dtype=np.int32))
+    else:
+        box = bounding_box(np.memmap(os.path.join(prot_dir, 'grid.memmap'), mode='r',
+                                     dtype=dtype).reshape((-1,) + (grid_size,) * 3))
+    factor = grid_size // level_side
+    if factor > 1:
+        box = np.concatenate([box[:3] // factor, box[3:] // factor]).astype(np.int32)
+    return box
+
+
+def crop_around_box(grid, box, side):
+    """
+    Crops a cube with the given side out of the last three (spatial) axes of grid, centered
+    on the bounding box (as far as the borders of the grid allow). The result is a view.
+
+    :param grid: an array with at least 3 dimensions, the last three being spatial
+    :param box: a bounding box as returned by bounding_box()
+    :param side: number of points on each side of the cropped cube
+    :return: the cropped view of grid
+    """
+    box = np.asarray(box)
+    center = (box[:3] + box[3:]) // 2
+    starts = np.clip(center - side // 2, 0, np.array(grid.shape[-3:]) - side)
+    return grid[..., starts[0]:starts[0] + side,
+                starts[1]:starts[1] + side,
+                starts[2]:starts[2] + side]
+
+
+def block_average(grid, factor):
+    """
+    Downsamples the last three (spatial) axes of grid by averaging non-overlapping blocks of
+    factor ** 3 voxels.
+
+    :param grid: an array with at least 3 dimensions, the last three being spatial; the spatial
+        sides must be divisible by factor
+    :param factor: the integer downsampling factor
+    :return: the downsampled grid
+    """
+    spatial_shape = grid.shape[-3:]
+    if any(side % factor != 0 for side in spatial_shape):
+        raise ValueError("Grid sides {} are not divisible by {}".format(spatial_shape, factor))
+    blocks_shape = grid.shape[:-3]
+    for side in spatial_shape:
+        blocks_shape += (side // factor, factor)
+    offset = grid.ndim - 3
+    return grid.reshape(blocks_shape).mean(axis=(offset + 1, offset + 3, offset + 5))
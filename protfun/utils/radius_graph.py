@@ -0,0 +1,105 @@
+import numpy as np
+
+from protfun.utils.sparse_voxels import KERNEL_OFFSETS
+
+
+def radius_graph(coords, radius, max_neighbors=None):
+    """
+    Finds all pairs of atoms closer than radius, using a cell list: the atoms are binned into
+    cubic cells with side radius, so the neighbors of an atom can only be in the 27 cells around
+    its own. The cost is thus linear in the number of atoms (for a bounded density of atoms),
+    instead of quadratic.
+
+    Usage::
+        >>> senders, receivers, distances = radius_graph(coords, radius=4.5, max_neighbors=16)
+
+    :param coords: the coordinates of the atoms (N x 3)
+    :param radius: the cutoff distance
+    :param max_neighbors: (optional) only the max_neighbors nearest neighbors of each atom are
+        kept
+    :return: int32 arrays of the senders and the receivers of the (directed) edges, and the
+        float32 lengths of the edges. The edges are sorted by receiver, an atom is never its
+        own neighbor.
+    """
+    n_atoms = coords.shape[0]
+    if n_atoms == 0:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), \
+            np.zeros(0, dtype=np.float32)
+    coords = coords.astype(np.float64)
+    # the cells are shifted by one, so that the neighboring cells of all atoms have valid indices
+    cells = np.floor((coords - coords.min(axis=0)) / radius).astype(np.int64) + 1
+    dims = cells.max(axis=0) + 2
+    keys = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+    order = np.argsort(keys, kind='mergesort')
+    sorted_keys = keys[order]
+
+    senders, receivers = [], []
+    for offset in KERNEL_OFFSETS:
+        neighbor_keys = keys + (offset[0] * dims[1] + offset[1]) * dims[2] + offset[2]
+        start = np.searchsorted(sorted_keys, neighbor_keys, side='left')
+        counts = np.searchsorted(sorted_keys, neighbor_keys, side='right') - start
+        total = counts.sum()
+        if total == 0:
+            continue
+        # position of each candidate within the run of its cell
+        within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        senders.append(order[np.repeat(start, counts) + within])
+        receivers.append(np.repeat(np.arange(n_atoms), counts))
+    senders = np.concatenate(senders)
+    receivers = np.concatenate(receivers)
+
+    distances = np.sqrt(np.sum((coords[senders] - coords[receivers]) ** 2, axis=1))
+    keep = (distances <= radius) & (senders != receivers)
+    senders, receivers, distances = senders[keep], receivers[keep], distances[keep]
+
+    # sort by receiver and distance, then keep only the nearest neighbors of each receiver
+    order = np.lexsort((distances, receivers))
+    senders, receivers, distances = senders[order], receivers[order], distances[order]
+    if max_neighbors is not None:
+        counts = np.bincount(receivers, minlength=n_atoms)
+        rank = np.arange(receivers.shape[0]) - np.repeat(np.cumsum(counts) - counts, counts)
+        keep = rank < max_neighbors
+        senders, receivers, distances = senders[keep], receivers[keep], distances[keep]
+    return senders.astype(np.int32), receivers.astype(np.int32), distances.astype(np.float32)
+
+
+def build_graph_inputs(molecules, radius, max_neighbors=None):
+    """
+    Builds the inputs of a graph network (see protfun.networks.graph_network) for a mini-batch of
+    molecules. The atoms of all molecules are concatenated into one graph without edges between
+    the molecules.
+
+    :param molecules: list of (coords, atom_features) tuples, one for each molecule, where
+        atom_features is a (n_atoms x n_features) array
+    :param radius: cutoff distance of the edges
+    :param max_neighbors: (optional) max. number of neighbors of each atom
+    :return: list [atom_features, senders, receivers, distances, segments, counts], where
+        segments holds the molecule index of each atom and counts the number of atoms of each
+        molecule
+    """
+    features, senders, receivers, distances, segments = [], [], [], [], []
+    offset = 0
+    for i, (coords, atom_features) in enumerate(molecules):
+        s, r, d = radius_graph(coords, radius, max_neighbors)
+        features.append(atom_features)
+        senders.append(s + offset)
+        receivers.append(r + offset)
+        distances.append(d)
+        segments.append(np.full(coords.shape[0], i, dtype=np.int32))
+        offset += coords.shape[0]
+    counts = np.array([coords.shape[0] for coords, _ in molecules], dtype=np.float32)
+    return [np.vstack(features), np.concatenate(senders), np.concatenate(receivers),
+            np.concatenate(distances), np.concatenate(segments), counts]
+
+
+if __name__ == "__main__":
+    # compare with a brute force search on random atoms
+    rng = np.random.RandomState(0)
+    atoms = rng.rand(2000, 3) * 30.
+    s, r, d = radius_graph(atoms, radius=4.5)
+    pairwise = np.sqrt(np.sum((atoms[:, None] - atoms[None]) ** 2, axis=-1))
+    expected = np.argwhere((pairwise <= 4.5) & ~np.eye(len(atoms), dtype=bool))
+    assert set(zip(r, s)) == set(map(tuple, expected))
+    s, r, d = radius_graph(atoms, radius=4.5, max_neighbors=8)
+    assert np.bincount(r).max() <= 8
+    print("{} edges within 4.5A, {} with max. 8 neighbors".format(len(expected), len(s)))
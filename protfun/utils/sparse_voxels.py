@@ -0,0 +1,162 @@
+import itertools
+import numpy as np
+
+# the 27 offsets of a 3x3x3 kernel, in the order of the kernel weights of SparseConv3DLayer
+KERNEL_OFFSETS = np.array(list(itertools.product([-1, 0, 1], repeat=3)), dtype=np.int64)
+
+
+def occupied_voxels(grid, threshold=0.):
+    """
+    Extracts the occupied voxels of a protein grid, i.e. the voxels where any channel exceeds
+    the threshold.
+
+    :param grid: the grid of a single protein, shaped (1, channels, side, side, side) or
+        (channels, side, side, side)
+    :param threshold: voxels with all channels <= threshold are considered empty
+    :return: the int16 coordinates (N x 3) and the float32 channel values (N x channels) of the
+        occupied voxels, in C order of the grid
+    """
+    grid = grid.reshape(grid.shape[-4:])
+    mask = np.any(grid > threshold, axis=0)
+    coords = np.argwhere(mask).astype(np.int16)
+    values = grid[:, mask].T.astype(np.float32)
+    return coords, values
+
+
+def voxel_keys(batch_ids, coords, side):
+    """
+    Encodes (sample, x, y, z) into a single int64 key per site; for sites in C order the keys are
+    sorted, so a site can be looked up with a binary search over the keys.
+    """
+    coords = coords.astype(np.int64)
+    return ((batch_ids.astype(np.int64) * side + coords[:, 0]) * side + coords[:, 1]) * side + \
+        coords[:, 2]
+
+
+def neighbor_map(keys, batch_ids, coords, side):
+    """
+    Builds the neighbor map of the active sites for a 3x3x3 convolution: for each site and each
+    of the 27 kernel offsets, the index of the active site at that offset, or len(keys) (the
+    index of the zero padding row) if there is none. The neighbors are found by looking up their
+    keys in the sorted keys of the active sites.
+
+    :param keys: the sorted keys of the active sites (see voxel_keys)
+    :param batch_ids: the sample index of each site in the mini-batch
+    :param coords: the coordinates of the sites (N x 3)
+    :param side: the side of the grid the coordinates are in
+    :return: an int32 array of shape (N x 27)
+    """
+    n_sites = keys.shape[0]
+    neighbors = np.empty((n_sites, len(KERNEL_OFFSETS)), dtype=np.int32)
+    coords = coords.astype(np.int64)
+    for k, offset in enumerate(KERNEL_OFFSETS):
+        shifted = coords + offset
+        inside = np.all((shifted >= 0) & (shifted < side), axis=1)
+        shifted_keys = voxel_keys(batch_ids, np.clip(shifted, 0, side - 1), side)
+        found = np.searchsorted(keys, shifted_keys)
+        found_clipped = np.minimum(found, n_sites - 1)
+        hit = inside & (found < n_sites) & (keys[found_clipped] == shifted_keys)
+        neighbors[:, k] = np.where(hit, found, n_sites)
+    return neighbors
+
+
+def downsample_sites(batch_ids, coords, side):
+    """
+    Computes the active sites at half the resolution (2x2x2 blocks with at least one active site)
+    and for each of them the indices of its (up to 8) children, len(coords) for missing children.
+
+    :return: batch_ids, coords and side of the coarse sites, and the int32 children map (M x 8)
+    """
+    coarse_side = (side + 1) // 2
+    coarse_coords = coords.astype(np.int64) // 2
+    fine_to_coarse_keys = voxel_keys(batch_ids, coarse_coords, coarse_side)
+    coarse_keys, first, inverse = np.unique(fine_to_coarse_keys, return_index=True,
+                                            return_inverse=True)
+    slots = (coords[:, 0] % 2) * 4 + (coords[:, 1] % 2) * 2 + (coords[:, 2] % 2)
+    children = np.full((coarse_keys.shape[0], 8), coords.shape[0], dtype=np.int32)
+    children[inverse, slots] = np.arange(coords.shape[0], dtype=np.int32)
+    return batch_ids[first], coarse_coords[first], coarse_side, children
+
+
+def build_sparse_inputs(voxel_lists, side, n_levels):
+    """
+    Builds the inputs of a sparse network (see protfun.networks.sparse_network) for a mini-batch
+    of proteins given as lists of occupied voxels. The sites of all proteins are concatenated,
+    and for each of the n_levels resolution levels a neighbor map is built, as well as a
+    children map between consecutive levels.
+
+    Usage::
+        >>> voxels = [occupied_voxels(grid) for grid in grids]
+        >>> inputs = build_sparse_inputs(voxels, side=64, n_levels=4)
+
+    :param voxel_lists: list of (coords, values) tuples, one for each protein
+    :param side: side of the grid the coordinates are in
+    :param n_levels: number of resolution levels
+    :return: list [features, neighbors_0, children_1, neighbors_1, ..., neighbors_<n_levels-1>,
+        segments, counts], where features are the values of the sites (N x channels), segments
+        holds the sample index of each site at the coarsest level and counts the number of
+        coarsest level sites of each sample
+    """
+    coords = np.vstack([c for c, _ in voxel_lists]).astype(np.int64)
+    values = np.vstack([v for _, v in voxel_lists])
+    batch_ids = np.concatenate([np.full(c.shape[0], i, dtype=np.int64)
+                                for i, (c, _) in enumerate(voxel_lists)])
+    # sort the sites by key, so that the neighbors can be looked up with a binary search
+    keys = voxel_keys(batch_ids, coords, side)
+    order = np.argsort(keys, kind='mergesort')
+    keys, coords, batch_ids, values = keys[order], coords[order], batch_ids[order], values[order]
+
+    inputs = [values, neighbor_map(keys, batch_ids, coords, side)]
+    for _ in range(1, n_levels):
+        batch_ids, coords, side, children = downsample_sites(batch_ids, coords, side)
+        keys = voxel_keys(batch_ids, coords, side)
+        inputs += [children, neighbor_map(keys, batch_ids, coords, side)]
+    counts = np.bincount(batch_ids, minlength=len(voxel_lists)).astype(values.dtype)
+    inputs += [batch_ids.astype(np.int32), counts]
+    return inputs
+
+
+def transform_voxels(coords, side, symmetry=None, translation=None):
+    """
+    Applies a rotation of the cube (see protfun.utils.np_utils.CUBE_SYMMETRIES) and a
+    translation to the voxel coordinates of a protein. The translation wraps around the borders,
+    as np.roll does for the dense grids.
+
+    :param coords: the voxel coordinates (N x 3)
+    :param side: side of the grid
+    :param symmetry: (optional) (axes permutation, axes flips) pair
+    :param translation: (optional) integer shift for each axis
+    :return: the transformed coordinates
+    """
+    coords = coords.astype(np.int64)
+    if symmetry is not None:
+        perm, flips = symmetry
+        coords = coords[:, list(perm)]
+        for axis, flip in enumerate(flips):
+            if flip:
+                coords[:, axis] = side - 1 - coords[:, axis]
+    if translation is not None:
+        coords = (coords + np.asarray(translation, dtype=np.int64)) % side
+    return coords.astype(np.int16)
+
+
+if __name__ == "__main__":
+    # compare the neighbor lookup and the pooling with a brute force search on random proteins
+    rng = np.random.RandomState(0)
+    side = 16
+    grids = [(rng.rand(1, 2, side, side, side) > 0.9) * rng.rand(1, 2, side, side, side)
+             for _ in range(3)]
+    voxels = [occupied_voxels(g) for g in grids]
+    inputs = build_sparse_inputs(voxels, side, n_levels=2)
+    features, neighbors = inputs[0], inputs[1]
+    all_coords = np.vstack([np.hstack([np.full((c.shape[0], 1), i), c])
+                            for i, (c, _) in enumerate(voxels)])
+    lookup = {tuple(site): None for site in all_coords}
+    keys = sorted(lookup)
+    index = {site: i for i, site in enumerate(keys)}
+    for i, site in enumerate(keys):
+        for k, offset in enumerate(KERNEL_OFFSETS):
+            nb = (site[0],) + tuple(np.array(site[1:]) + offset)
+            assert neighbors[i, k] == index.get(nb, len(keys))
+    print("{} sites, {} at the coarser level, counts per protein: {}".format(
+        features.shape[0], inputs[2].shape[0], inputs[-1]))
@@ -3,7 +3,7 @@ import re
 import numpy as np
 from sklearn.metrics import roc_curve
 
-from protfun.models import get_hidden_activations, get_best_params
+from protfun.models import stream_hidden_activations, get_best_params
 from protfun.utils import save_pickle, load_pickle
 from protfun.visualizer.molview import MoleculeView
 from protfun.visualizer.progressview import ProgressView
@@ -87,11 +87,12 @@ def create_performance_plots(config, model_name, n_classes):
     log.info("Saved ROC plots for: {}".format(model_name))
 
 
-def save_hidden_activations(config, model_name):
+def save_hidden_activations(config, model_name, layers=None, n_minibatches=1):
     """
     Save activations from the hidden layers of an already trained model for a small set of samples
-    from the test set. The activations are saved under the model's directory:
-        * activations.pickle - the activations of the hidden layers
+    from the test set. The activations are computed and saved one layer at a time, so the
+    activations of all layers need not fit in memory. They are saved under the model's directory:
+        * activations/<index>_<layer name>.npy - the activations of each of the hidden layers
         * activations_targets.pickle - the ground truth target classes for the chosen samples
         * activations_preds.pickle - the predictions (scores) for the chosen samples
         * activations_prots.pickle - the protein codes of the chosen samples
@@ -100,6 +101,8 @@ def save_hidden_activations(config, model_name):
         model. You can load it from file with protfun.config.get_config(file_path)
     :param model_name: name (model id) of the model to create diagrams for. Corresponds to the name
         of the model directory under <data_dir>/models
+    :param layers: (optional) indices or names of the layers to save, all layers if None
+    :param n_minibatches: number of test minibatches to save the activations for
     """
 
     model_dir = os.path.join(config["data"]["dir"], "models", model_name)
@@ -107,10 +110,10 @@ def save_hidden_activations(config, model_name):
     config["training"]["minibatch_size"] = 4
 
     best_params_file = get_best_params(config, model_name)
-    prots, targets, preds, activations = get_hidden_activations(config=config,
-                                                                model_name=model_name,
-                                                                params_file=best_params_file)
-    save_pickle(file_path=os.path.join(model_dir, "activations.pickle"), data=activations)
+    prots, targets, preds, _ = stream_hidden_activations(
+        config=config, model_name=model_name, params_file=best_params_file,
+        out_dir=os.path.join(model_dir, "activations"), layers=layers,
+        n_minibatches=n_minibatches)
     save_pickle(file_path=os.path.join(model_dir, "activations_targets.pickle"), data=targets)
     save_pickle(file_path=os.path.join(model_dir, "activations_preds.pickle"), data=preds)
     save_pickle(file_path=os.path.join(model_dir, "activations_prots.pickle"), data=prots)